@@ -93,6 +93,9 @@ def _lookupPathInDict(myDict, path):
 
 class LookingGlass(object):
 
+    # no instance attributes, so that subclasses can use __slots__
+    __slots__ = ()
+
     def _getLGMap(self):
         """not to be overridden: calls getLGMap, on each of the super classes
            and merge the result in a dict
@@ -0,0 +1,248 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An I/O reactor: a single thread waits for events on many sockets (with
+epoll where available, select otherwise), and calls the handler registered
+for each socket when it becomes readable or writable.
+
+Handlers are objects with onReadable() and onWritable() methods, called from
+the thread of the reactor: they must not block. Timers are run by a
+TimerWheel, and callLater() has the callback run by the thread of the
+reactor too, so that handlers do not have to care about concurrency between
+I/O events and their timers.
+"""
+
+import errno
+
+import logging
+
+import os
+
+import select
+
+import traceback
+
+from collections import deque
+
+from threading import Thread, Lock
+
+from bagpipe.bgp.common.timer_wheel import sharedTimerWheel
+
+log = logging.getLogger(__name__)
+
+
+class _EpollPoller(object):
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def _mask(self, read, write):
+        return ((read and select.EPOLLIN or 0) |
+                (write and select.EPOLLOUT or 0))
+
+    def register(self, fd, read, write):
+        self._epoll.register(fd, self._mask(read, write))
+
+    def modify(self, fd, read, write):
+        self._epoll.modify(fd, self._mask(read, write))
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self):
+        '''returns a list of (fd, readable, writable) tuples'''
+        events = []
+        for (fd, mask) in self._epoll.poll():
+            # errors and hang-ups are reported as readable, so that they are
+            # noticed when reading
+            events.append((fd, bool(mask & (select.EPOLLIN | select.EPOLLERR |
+                                            select.EPOLLHUP)),
+                           bool(mask & select.EPOLLOUT)))
+        return events
+
+
+class _SelectPoller(object):
+
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+
+    def register(self, fd, read, write):
+        self.modify(fd, read, write)
+
+    def modify(self, fd, read, write):
+        for (fds, enabled) in ((self._readers, read), (self._writers, write)):
+            if enabled:
+                fds.add(fd)
+            else:
+                fds.discard(fd)
+
+    def unregister(self, fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+
+    def poll(self):
+        (readable, writable, _) = select.select(self._readers, self._writers,
+                                                [])
+        return ([(fd, True, fd in writable) for fd in readable] +
+                [(fd, False, True) for fd in writable if fd not in readable])
+
+
+class Reactor(object):
+
+    def __init__(self, name="Reactor"):
+        self.name = name
+        if hasattr(select, 'epoll'):
+            self._poller = _EpollPoller()
+        else:
+            self._poller = _SelectPoller()
+        # dict: fd -> handler
+        self._handlers = dict()
+
+        # calls to do in the thread of the reactor, see callFromThread; a
+        # byte written in the pipe interrupts the poller
+        self._calls = deque()
+        self._callsLock = Lock()
+        (self._wakeupRead, self._wakeupWrite) = os.pipe()
+        self._poller.register(self._wakeupRead, True, False)
+
+        self._stopping = False
+        self._thread = Thread(target=self._run, name=name)
+        self._thread.setDaemon(True)
+
+        # statistics
+        self._wakeupCount = 0
+        self._ioEventCount = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.callFromThread(self._stop)
+        self._thread.join()
+
+    def _stop(self):
+        self._stopping = True
+
+    def callFromThread(self, callback, *args):
+        '''has callback(*args) called by the thread of the reactor (can be
+        called from any thread)'''
+        with self._callsLock:
+            wakeup = not self._calls
+            self._calls.append((callback, args))
+        if wakeup:
+            os.write(self._wakeupWrite, 'x')
+
+    def callLater(self, delay, callback, *args):
+        '''has callback(*args) called by the thread of the reactor after
+        delay seconds, returns a timer that can be cancelled'''
+        return sharedTimerWheel().schedule(delay, self.callFromThread,
+                                           callback, *args)
+
+    def register(self, fd, handler, read=True, write=False):
+        self.callFromThread(self._register, fd, handler, read, write)
+
+    def modify(self, fd, handler, read=True, write=False):
+        self.callFromThread(self._modify, fd, handler, read, write)
+
+    def unregister(self, fd, handler):
+        '''stops calling handler for events on fd (does nothing if another
+        handler was registered since for fd)'''
+        self.callFromThread(self._unregister, fd, handler)
+
+    def _register(self, fd, handler, read, write):
+        if fd in self._handlers:
+            log.warning("Registering %s for fd %d, replacing %s", handler,
+                        fd, self._handlers[fd])
+            self._poller.unregister(fd)
+        self._handlers[fd] = handler
+        self._poller.register(fd, read, write)
+
+    def _modify(self, fd, handler, read, write):
+        if self._handlers.get(fd) is handler:
+            self._poller.modify(fd, read, write)
+
+    def _unregister(self, fd, handler):
+        if self._handlers.get(fd) is not handler:
+            return
+        del self._handlers[fd]
+        try:
+            self._poller.unregister(fd)
+        except (IOError, OSError, ValueError) as e:
+            # fd possibly already closed
+            log.debug("Could not unregister fd %d: %s", fd, e)
+
+    def _runCalls(self):
+        os.read(self._wakeupRead, 4096)
+        with self._callsLock:
+            calls = self._calls
+            self._calls = deque()
+        for (callback, args) in calls:
+            self._call(callback, *args)
+
+    def _call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            log.error("Exception in %s: %s", callback, e)
+            log.error("%s", traceback.format_exc())
+
+    def _run(self):
+        log.debug("%s started", self.name)
+        while not self._stopping:
+            try:
+                events = self._poller.poll()
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self._wakeupCount += 1
+            for (fd, readable, writable) in events:
+                if fd == self._wakeupRead:
+                    self._runCalls()
+                    continue
+                self._ioEventCount += 1
+                # the handler is looked up again before each call, as a call
+                # may unregister it
+                if writable and fd in self._handlers:
+                    self._call(self._handlers[fd].onWritable)
+                if readable and fd in self._handlers:
+                    self._call(self._handlers[fd].onReadable)
+        log.debug("%s stopped", self.name)
+
+    def getStats(self):
+        return {
+            "poller": self._poller.__class__.__name__.strip('_'),
+            "handlers": len(self._handlers),
+            "wakeups": self._wakeupCount,
+            "io_events": self._ioEventCount
+        }
+
+
+_sharedReactor = None
+_sharedReactorLock = Lock()
+
+
+def sharedReactor():
+    '''returns the Reactor shared by all the components of bagpipe-bgp,
+    started on first use'''
+    global _sharedReactor
+    with _sharedReactorLock:
+        if _sharedReactor is None:
+            _sharedReactor = Reactor()
+            _sharedReactor.start()
+        return _sharedReactor
@@ -0,0 +1,191 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A hashed timer wheel, to run callbacks after a delay without a thread for
+each timer (as threading.Timer does).
+
+Timers are stored in a fixed number of slots, each slot corresponding to a
+tick of the wheel: a timer expiring n ticks from now is stored in the slot
+n ticks ahead of the current one, along with the number of rounds the wheel
+has to do before the timer expires. A single thread advances the wheel at
+each tick, and runs the callbacks of the timers expiring.
+
+Callbacks are run by the thread of the wheel, and thus must be short (e.g.
+enqueue an event for a worker).
+"""
+
+import logging
+
+import math
+
+import time
+
+import traceback
+
+from threading import Thread, Event, Lock
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TICK = 0.1
+DEFAULT_SLOT_COUNT = 512
+
+
+class WheelTimer(object):
+
+    """A timer scheduled in a TimerWheel, returned by TimerWheel.schedule"""
+
+    __slots__ = ('wheel', 'deadline', 'callback', 'args', 'slot', 'rounds')
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.slot = None
+        self.rounds = 0
+
+    def cancel(self):
+        '''cancels the timer, does nothing if it already expired or was
+        cancelled'''
+        self.wheel._cancel(self)
+
+    def __repr__(self):
+        return "[WheelTimer: %s at %.3f]" % (self.callback, self.deadline)
+
+
+class TimerWheel(object):
+
+    def __init__(self, tick=DEFAULT_TICK, slotCount=DEFAULT_SLOT_COUNT,
+                 name="TimerWheel"):
+        self.tick = tick
+        self.name = name
+        self._slots = [set() for _ in range(slotCount)]
+        self._lock = Lock()
+        self._stopEvent = Event()
+        self._thread = Thread(target=self._run, name=name)
+        self._thread.setDaemon(True)
+
+        # tick n is due at _startTime + n * tick
+        self._startTime = time.time()
+        self._currentTick = 0
+
+        # statistics
+        self._pendingCount = 0
+        self._firedCount = 0
+        self._cancelledCount = 0
+        self._lastLag = 0
+        self._maxLag = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopEvent.set()
+        self._thread.join()
+
+    def schedule(self, delay, callback, *args):
+        '''
+        Returns a WheelTimer that will call callback(*args) after delay
+        seconds (rounded up to the next tick of the wheel)
+        '''
+        timer = WheelTimer(self, time.time() + delay, callback, args)
+        with self._lock:
+            targetTick = max(self._currentTick + 1, int(math.ceil(
+                (timer.deadline - self._startTime) / self.tick)))
+            timer.rounds = ((targetTick - self._currentTick - 1) /
+                            len(self._slots))
+            timer.slot = self._slots[targetTick % len(self._slots)]
+            timer.slot.add(timer)
+            self._pendingCount += 1
+        return timer
+
+    def _cancel(self, timer):
+        with self._lock:
+            if timer.slot is None:
+                return
+            timer.slot.discard(timer)
+            timer.slot = None
+            self._pendingCount -= 1
+            self._cancelledCount += 1
+
+    def _run(self):
+        log.debug("%s started", self.name)
+        while not self._stopEvent.isSet():
+            delay = (self._startTime + (self._currentTick + 1) * self.tick -
+                     time.time())
+            if delay > 0:
+                self._stopEvent.wait(delay)
+                continue
+            self._fire(self._advance())
+        log.debug("%s stopped", self.name)
+
+    def _advance(self):
+        '''moves the wheel to its next tick, and returns the timers
+        expiring'''
+        with self._lock:
+            self._currentTick += 1
+            slot = self._slots[self._currentTick % len(self._slots)]
+            expired = []
+            for timer in slot:
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    expired.append(timer)
+            for timer in expired:
+                slot.remove(timer)
+                timer.slot = None
+            self._pendingCount -= len(expired)
+            return expired
+
+    def _fire(self, timers):
+        for timer in timers:
+            lag = max(0, time.time() - timer.deadline)
+            self._lastLag = lag
+            self._maxLag = max(self._maxLag, lag)
+            self._firedCount += 1
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                log.error("Exception in timer callback %s: %s",
+                          timer.callback, e)
+                log.error("%s", traceback.format_exc())
+
+    def getStats(self):
+        return {
+            "tick": self.tick,
+            "slots": len(self._slots),
+            "pending_timers": self._pendingCount,
+            "fired_timers": self._firedCount,
+            "cancelled_timers": self._cancelledCount,
+            "last_lag": self._lastLag,
+            "max_lag": self._maxLag
+        }
+
+
+_sharedTimerWheel = None
+_sharedTimerWheelLock = Lock()
+
+
+def sharedTimerWheel():
+    '''returns the TimerWheel shared by all the components of bagpipe-bgp,
+    started on first use'''
+    global _sharedTimerWheel
+    with _sharedTimerWheelLock:
+        if _sharedTimerWheel is None:
+            _sharedTimerWheel = TimerWheel()
+            _sharedTimerWheel.start()
+        return _sharedTimerWheel
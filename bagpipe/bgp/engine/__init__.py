@@ -36,6 +36,8 @@ route table manager (singleton)
 
 import logging
 
+import weakref
+
 from bagpipe.exabgp.structure.address import AFI, SAFI
 from bagpipe.exabgp.message.update.attribute.communities import RouteTarget
 from bagpipe.exabgp.message.update.attribute import AttributeID
@@ -59,6 +61,9 @@ class RouteEntry(LookingGlass):
 
 """
 
+    __slots__ = ('source', 'afi', 'safi', 'nlri', 'attributes',
+                 'routeTargets', 'matchKeys', 'filtered')
+
     def __init__(self, afi, safi, routeTargets, nlri, attributes, source):
         assert(isinstance(afi, AFI))
         assert(isinstance(safi, SAFI))
@@ -70,22 +75,28 @@ class RouteEntry(LookingGlass):
         self.attributes = attributes
         # a list of exabgp.message.update.attribute.communities.RouteTarget:
         self.routeTargets = routeTargets
-
-    def __cmp__(self, other):
-        if (isinstance(other, RouteEntry) and
+        # cache for the match keys of this route, see
+        # RouteTableManager._matchKeysFor
+        self.matchKeys = None
+        # cache for the filtered view of this route, see
+        # tracker_worker.filteredRouteEntry
+        self.filtered = None
+
+    def __eq__(self, other):
+        return (isinstance(other, RouteEntry) and
                 self.afi == other.afi and
                 self.safi == other.safi and
                 self.source == other.source and
                 self.nlri == other.nlri and
-                self.attributes.sameValuesAs(other.attributes)):
-            return 0
-        else:
-            return -1
+                self.attributes.fingerprint() ==
+                other.attributes.fingerprint())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
-    def __hash__(self):  # FIXME: improve for better performance ?
-        return hash("%d/%d %s %d %s" % (self.afi, self.safi, self.source,
-                                        hash(self.nlri), hash(self.attributes)
-                                        ))
+    def __hash__(self):
+        return hash((self.afi, self.safi, self.source, self.nlri,
+                     self.attributes.fingerprint()))
 
     def __repr__(self):
         fromString = " from:%s" % self.source if self.source else ""
@@ -140,6 +151,8 @@ class RouteEvent(object):
     type2name = {ADVERTISE: "Advertise",
                  WITHDRAW: "Withdraw"}
 
+    __slots__ = ('type', 'routeEntry', 'source', 'replacedRoute')
+
     def __init__(self, eventType, routeEntry, source=None):
         assert(eventType in RouteEvent.type2name.keys())
         assert(isinstance(routeEntry, RouteEntry))
@@ -170,6 +183,71 @@ class RouteEvent(object):
                                                self.source)
 
 
+class RouteTargetList(list):
+
+    """A list of RouteTarget that can be stored in an InternStore"""
+
+    __slots__ = ('__weakref__',)
+
+
+def attributesKey(attributes):
+    """Returns a key identifying the values of a set of attributes, or None
+    if these attributes can't be interned
+    """
+    if AttributeID.MP_REACH_NLRI in attributes:
+        return None
+    return attributes.fingerprint()
+
+
+def routeTargetsKey(routeTargets):
+    return tuple(rt.community for rt in routeTargets)
+
+
+class InternStore(object):
+
+    """Stores a single instance of each distinct value (e.g. a set of BGP
+attributes, or a list of Route Targets), so that identical values can be
+shared by all the RouteEntry using them.
+
+Values are only weakly referenced by the store, and are forgotten as soon
+as no route uses them anymore.
+"""
+
+    def __init__(self, keyFunction, valueFactory=None):
+        # keyFunction returns the key identifying a value, or None if the
+        # value can't be interned; valueFactory, if any, converts a value
+        # into something that supports weak references
+        self._keyFunction = keyFunction
+        self._valueFactory = valueFactory
+        self._values = weakref.WeakValueDictionary()
+        self.lookups = 0
+        self.hits = 0
+
+    def intern(self, value):
+        if value is None:
+            return value
+        key = self._keyFunction(value)
+        if key is None:
+            return value
+        self.lookups += 1
+        interned = self._values.get(key)
+        if interned is not None:
+            self.hits += 1
+            return interned
+        if self._valueFactory is not None:
+            value = self._valueFactory(value)
+        self._values[key] = value
+        return value
+
+    def __len__(self):
+        return len(self._values)
+
+    def getStats(self):
+        return {"values": len(self),
+                "lookups": self.lookups,
+                "hits": self.hits}
+
+
 class _SubUnsubCommon(object):
 
     def __init__(self, afi, safi, routeTarget, worker=None):
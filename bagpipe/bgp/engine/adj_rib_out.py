@@ -0,0 +1,111 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The Adj-RIB-Out of a BGP peer: the routes currently advertised to the
+peer, as last sent.
+
+It is used to avoid sending the peer what it already knows (the
+advertisement of a route with unchanged attributes, the withdraw of a route
+never advertised), and to send again all the routes advertised to the peer
+when it asks for them (route refresh).
+"""
+
+import logging
+
+from collections import OrderedDict
+
+from bagpipe.bgp.engine import RouteEvent
+
+log = logging.getLogger(__name__)
+
+
+class AdjRibOut(object):
+
+    def __init__(self):
+        # (afi, safi, nlri) -> (RouteEntry, packed NLRI, attributes
+        #                       fingerprint), as last advertised
+        self._routes = dict()
+
+        # statistics
+        self._suppressedAdvertiseCount = 0
+        self._droppedWithdrawCount = 0
+
+    def filterEvents(self, events):
+        '''
+        Returns the route events that need to be sent to the peer, among
+        the given list of route events (in the order they were received),
+        and updates the Adj-RIB-Out accordingly: for a given NLRI only the
+        last event is kept, and it is dropped if it would not change what
+        the peer knows.
+        '''
+        lastEvents = OrderedDict()
+        for event in events:
+            entry = event.routeEntry
+            lastEvents[(entry.afi, entry.safi, entry.nlri)] = event
+
+        result = []
+        for (key, event) in lastEvents.iteritems():
+            sent = self._routes.get(key)
+            if event.type == RouteEvent.ADVERTISE:
+                entry = event.routeEntry
+                # labels are part of the packed NLRI, but not of the key
+                state = (entry, entry.nlri.pack(),
+                         entry.attributes.fingerprint())
+                if sent is not None and sent[1:] == state[1:]:
+                    log.debug("Suppressing unchanged advertisement: %s",
+                              entry)
+                    self._suppressedAdvertiseCount += 1
+                    continue
+                self._routes[key] = state
+            elif event.type == RouteEvent.WITHDRAW:
+                if sent is None:
+                    log.debug("Dropping withdraw of a route not advertised: "
+                              "%s", event.routeEntry)
+                    self._droppedWithdrawCount += 1
+                    continue
+                del self._routes[key]
+            result.append(event)
+        return result
+
+    def advertiseEvents(self, afi=None, safi=None):
+        '''
+        Returns route events advertising again all the routes of the
+        Adj-RIB-Out, or only those of the afi/safi family if specified
+        '''
+        return [RouteEvent(RouteEvent.ADVERTISE, entry)
+                for ((entryAfi, entrySafi, _), (entry, _, _))
+                in self._routes.iteritems()
+                if ((afi is None or entryAfi == afi) and
+                    (safi is None or entrySafi == safi))]
+
+    def clear(self):
+        '''to be called when the session goes down'''
+        self._routes.clear()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def getStats(self):
+        routeCounts = dict()
+        for (afi, safi, _) in self._routes.keys():
+            family = "%s/%s" % (afi, safi)
+            routeCounts[family] = routeCounts.get(family, 0) + 1
+        return {
+            "routes": routeCounts,
+            "suppressed_advertisements": self._suppressedAdvertiseCount,
+            "dropped_withdraws": self._droppedWithdrawCount
+        }
@@ -21,14 +21,19 @@ import socket
 import logging
 
 from bagpipe.bgp.engine.route_table_manager import RouteTableManager, \
-    WorkerCleanupEvent
+    ShardedRouteTableManager, WorkerCleanupEvent
 from bagpipe.bgp.engine.bgp_peer_worker import BGPPeerWorker
 from bagpipe.bgp.engine.exabgp_peer_worker import ExaBGPPeerWorker
+from bagpipe.bgp.engine.flow_control import sharedFlowControl, \
+    DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK
+from bagpipe.bgp.engine.encode_cache import sharedEncodeCache
 from bagpipe.bgp.engine import RouteEvent, RouteEntry, \
     Subscription, Unsubscription
 
 from bagpipe.bgp.common.looking_glass import LookingGlass, LGMap
 from bagpipe.bgp.common.utils import getBoolean
+from bagpipe.bgp.common.timer_wheel import sharedTimerWheel
+from bagpipe.bgp.common.reactor import sharedReactor
 from bagpipe.bgp.common import logDecorator
 
 from bagpipe.exabgp.message.update.route import Route
@@ -52,7 +57,31 @@ class Manager(LookingGlass):
         self.config['enable_rtc'] = getBoolean(self.config.get('enable_rtc',
                                                                True))
 
-        self.routeTableManager = RouteTableManager()
+        # when the queues of the route table manager or of VPN instances
+        # reach the high watermark, the reception of routes from BGP peers is
+        # paused until they go down to the low watermark (0 disables it)
+        self.config['queue_high_watermark'] = int(self.config.get(
+            'queue_high_watermark', DEFAULT_HIGH_WATERMARK))
+        self.config['queue_low_watermark'] = int(self.config.get(
+            'queue_low_watermark', DEFAULT_LOW_WATERMARK))
+        sharedFlowControl().setWatermarks(self.config['queue_high_watermark'],
+                                          self.config['queue_low_watermark'])
+
+        # ask BGP peers to send their routes again each time a route target
+        # starts being imported by a VPN instance (disabled by default: the
+        # route table manager keeps all the routes received from peers, and
+        # with RTC peers send the routes of a new route target anyway)
+        self.config['refresh_on_import'] = getBoolean(self.config.get(
+            'refresh_on_import', False))
+
+        # the work of the route table manager can be split between
+        # multiple threads (defaults to a single one)
+        self.config['rtm_shards'] = int(self.config.get('rtm_shards', 1))
+        if self.config['rtm_shards'] > 1:
+            self.routeTableManager = ShardedRouteTableManager(
+                self.config['rtm_shards'])
+        else:
+            self.routeTableManager = RouteTableManager()
         self.routeTableManager.start()
 
         if 'local_address' not in self.config:
@@ -105,6 +134,12 @@ class Manager(LookingGlass):
         # subscriptions -- currently ok since VPNInstance._stop() calls
         # unsubscribe
 
+    def requestRouteRefresh(self, afi, safi):
+        '''asks the established BGP peers for their routes of a family'''
+        for peer in self.peers.itervalues():
+            if isinstance(peer, BGPPeerWorker) and peer.isEstablished():
+                peer.requestRouteRefresh(afi, safi)
+
     def getLocalAddress(self):
         try:
             return self.config['local_address']
@@ -125,13 +160,19 @@ class Manager(LookingGlass):
 
         self.routeTableManager.enqueue(subscription)
 
-        # synthesize a RouteEvent for a RouteTarget constraint route
-        if (self.config['enable_rtc'] and not isinstance(subscription.worker,
-                                                         BGPPeerWorker)):
+        if isinstance(subscription.worker, BGPPeerWorker):
+            return
+
+        firstWorkerForSubscription = self._trackedSubscriptionsAddWorker(
+            subscription)
 
-            firstWorkerForSubscription = self._trackedSubscriptionsAddWorker(
-                subscription)
+        # only a route target newly imported can bring routes that peers did
+        # not send us yet
+        if self.config['refresh_on_import'] and firstWorkerForSubscription:
+            self.requestRouteRefresh(subscription.afi, subscription.safi)
 
+        # synthesize a RouteEvent for a RouteTarget constraint route
+        if self.config['enable_rtc']:
             # FIXME: not excellent to hardcode this here
             if ((subscription.safi in (SAFI.mpls_vpn, SAFI.evpn))
                     and firstWorkerForSubscription):
@@ -151,12 +192,13 @@ class Manager(LookingGlass):
 
         self.routeTableManager.enqueue(unsubscription)
 
-        if (self.config['enable_rtc'] and not isinstance(unsubscription.worker,
-                                                         BGPPeerWorker)):
+        if isinstance(unsubscription.worker, BGPPeerWorker):
+            return
 
-            wasLastWorkerForSubscription = \
-                self._trackedSubscriptionsRemoveWorker(unsubscription)
+        wasLastWorkerForSubscription = \
+            self._trackedSubscriptionsRemoveWorker(unsubscription)
 
+        if self.config['enable_rtc']:
             # FIXME: not excellent to hardcode this here
             if ((unsubscription.safi in (SAFI.mpls_vpn, SAFI.evpn))
                     and wasLastWorkerForSubscription):
@@ -219,7 +261,13 @@ class Manager(LookingGlass):
         return {"peers":   (LGMap.COLLECTION,
                             (self.getLGPeerList, self.getLGPeerPathItem)),
                 "routes":  (LGMap.FORWARD, self.routeTableManager),
-                "workers": (LGMap.FORWARD, self.routeTableManager), }
+                "workers": (LGMap.FORWARD, self.routeTableManager),
+                "timers":  (LGMap.SUBITEM, sharedTimerWheel().getStats),
+                "reactor": (LGMap.SUBITEM, sharedReactor().getStats),
+                "flow_control": (LGMap.SUBITEM,
+                                 sharedFlowControl().getStats),
+                "encode_cache": (LGMap.SUBITEM,
+                                 sharedEncodeCache().getStats)}
 
     def getEstablishedPeersCount(self):
         return reduce(lambda count, peer: count +
@@ -17,26 +17,83 @@
 
 from abc import ABCMeta, abstractmethod
 
-from threading import Thread, Event, Timer
+from threading import Thread, Event
 
 import time
-from time import sleep
+
+import random
 
 import logging
 import traceback
 
+from collections import OrderedDict
+
 from bagpipe.bgp.engine.worker import Worker
 from bagpipe.bgp.engine import RouteEvent
+from bagpipe.bgp.engine.adj_rib_out import AdjRibOut
 
 from bagpipe.bgp.common.looking_glass import LookingGlassLocalLogger
+from bagpipe.bgp.common.timer_wheel import sharedTimerWheel
 
 Init = "InitEvent"
 ReInit = "ReInit"
+Reconnect = "Reconnect"
 SendKeepAlive = "Send KeepAlive"
 KeepAliveReceived = "KeepAlive-received"
 
+# events processed before any pending route event
+CONTROL_EVENTS = (Init, ReInit, Reconnect, SendKeepAlive, KeepAliveReceived)
+
 DEFAULT_HOLDTIME = 180
 
+# delay before connecting again after a failure, in seconds: doubled at each
+# failed attempt up to RECONNECT_MAX_DELAY, and reduced by a random jitter of
+# up to 25% (as suggested by RFC 4271 for its timers) so that peers failing
+# at the same time do not all retry at the same time
+RECONNECT_MIN_DELAY = 5
+RECONNECT_MAX_DELAY = 120
+RECONNECT_JITTER = 0.25
+
+# maximum number of route events processed at once to build UPDATE messages
+MAX_ROUTE_EVENTS_BATCH = 1000
+
+
+class FamilyEvent(object):
+
+    '''Base class for the events concerning an (afi, safi) family'''
+
+    __slots__ = ('family',)
+
+    def __init__(self, family):
+        self.family = family
+
+    def __repr__(self):
+        return "%s(%s/%s)" % ((self.__class__.__name__,) + self.family)
+
+
+class MRAIExpired(FamilyEvent):
+
+    '''
+    Event signaling the end of the minimum route advertisement interval of
+    an address family (see BGPPeerWorker._paceRouteEvents)
+    '''
+
+    __slots__ = ()
+
+
+class RouteRefreshRequested(FamilyEvent):
+
+    '''Event signaling that the peer asked for our routes of a family'''
+
+    __slots__ = ()
+
+
+class SendRouteRefresh(FamilyEvent):
+
+    '''Event asking to send the peer a request for its routes of a family'''
+
+    __slots__ = ()
+
 
 class FSM(object):
 
@@ -116,14 +173,44 @@ class BGPPeerWorker(Worker, Thread, LookingGlassLocalLogger):
         # on value advertized by peer
         self._setHoldTime(DEFAULT_HOLDTIME)
 
-        # used to stop receiveThread
+        # set when the session is down, or stopped: the keepalive timers
+        # expiring then do nothing
         self._stopLoops = Event()
         # used to track that we've been told to stop:
         self.shouldStop = False
 
+        # keepalive timers are run by a timer wheel shared by all peers
+        self.timerWheel = sharedTimerWheel()
         self.sendKATimer = None
         self.KAReceptionTimer = None
 
+        # reconnection state, see _reinitiate
+        self._reconnectAttempts = 0
+        self._reconnectDelay = None
+        self._reconnectTime = None
+        self._reconnectTimer = None
+        self._purgedEventCount = 0
+
+        # routes advertised to the peer during the current session
+        self.adjRibOut = AdjRibOut()
+
+        # minimum route advertisement interval, in seconds, for each
+        # (afi, safi) family: its subclasses can set these from the config
+        # (no interval for a family means that its route changes are sent
+        # immediately)
+        self.mraiIntervals = dict()
+        self.mraiWithdrawBypass = True
+        # family -> timer of the interval running
+        self._mraiTimers = dict()
+        # family -> route events held until the end of the interval, last
+        # event only for each (afi, safi, nlri)
+        self._mraiPending = dict()
+        self._mraiHeldCount = 0
+        self._mraiSuppressedCount = 0
+
+        # families for which a SendRouteRefresh event is queued
+        self._refreshToSend = set()
+
         LookingGlassLocalLogger.__init__(
             self, self.peerAddress.replace(".", "-"))
 
@@ -136,6 +223,15 @@ class BGPPeerWorker(Worker, Thread, LookingGlassLocalLogger):
         Worker.stop(self)
         self._stopLoops.set()
         self.shouldStop = True
+        self._cancelKeepAliveTimers()
+        if self._reconnectTimer is not None:
+            self._reconnectTimer.cancel()
+        self._resetMRAI()
+
+    def _laneFor(self, event):
+        if event in CONTROL_EVENTS:
+            return Worker.CONTROL_LANE
+        return Worker.ROUTES_LANE
 
     def _setHoldTime(self, holdtime):
         '''
@@ -155,14 +251,40 @@ class BGPPeerWorker(Worker, Thread, LookingGlassLocalLogger):
         elif event == ReInit:
             self._reinitiate()
 
+        elif event == Reconnect:
+            self._reconnect()
+
         elif isinstance(event, RouteEvent):
             if (self.fsm.state == FSM.Established):
-                self._send(self._updateForRouteEvent(event))
+                # route events pending in our queue are processed together
+                # so that they can be packed in as few UPDATEs as possible
+                (events, nextEvent) = self._drainQueue(
+                    RouteEvent, MAX_ROUTE_EVENTS_BATCH - 1)
+                self._sendRouteEvents(
+                    self._paceRouteEvents([event] + events))
+                if nextEvent is Worker.stopEvent:
+                    self._pleaseStop.set()
+                elif nextEvent is not None:
+                    self._onEvent(nextEvent)
             else:
-                # FIXME: this is possibly not correct yet: why did we received
-                # this event  ? what do we do with it ?
-                raise Exception(
-                    "cannot process routeEvent in '%s' state" % self.fsm.state)
+                # the session went down after this event was queued: our
+                # subscriptions are being removed, and the routes will be
+                # advertised again once the session is re-established
+                self.log.debug("Ignoring route event in '%s' state: %s",
+                               self.fsm.state, event)
+                self._purgedEventCount += 1
+
+        elif isinstance(event, MRAIExpired):
+            self._onMRAIExpired(event.family)
+
+        elif isinstance(event, RouteRefreshRequested):
+            if (self.fsm.state == FSM.Established):
+                self._onRouteRefreshRequested(*event.family)
+
+        elif isinstance(event, SendRouteRefresh):
+            self._refreshToSend.discard(event.family)
+            if (self.fsm.state == FSM.Established):
+                self._sendRouteRefresh(*event.family)
 
         elif event == SendKeepAlive:
             self._send(self._keepAliveMessageData())
@@ -182,7 +304,8 @@ class BGPPeerWorker(Worker, Thread, LookingGlassLocalLogger):
 
     def _initiateConnectionAndThreads(self):
         self._resetLocalLGLogs()
-        # initiate connection
+        # initiate connection, the BGP handshake is then done asynchronously
+        # (see _openExchanged)
 
         self.fsm.state = FSM.Connect
 
@@ -207,89 +330,204 @@ class BGPPeerWorker(Worker, Thread, LookingGlassLocalLogger):
             # many times we already tried
             return
 
+    def _openExchanged(self):
+        '''
+        To be called by subclasses once Open messages have been exchanged
+        with the peer, to start the keepalive timers
+        '''
         self._stopLoops.clear()
 
         self.initSendKeepAliveTimer()
         self.initKeepAliveReceptionTimer()
 
-        # spawns a receive thread
-        self.receiveThread = Thread(target=self._receiveLoop,
-                                    name="%s:receiveLoop" % self.name)
-        self.receiveThread.start()
-
     def _toEstablished(self):
         self.fsm.state = FSM.Established
+        self._reconnectAttempts = 0
 
     def _toIdle(self):
         pass
 
     def _reinitiate(self):
+        if self._reconnectTimer is not None:
+            # e.g. an error detected while a keepalive expiry was pending
+            self.log.debug("Reconnection already scheduled, ignoring ReInit")
+            return
+
         self.log.info("Re-initiating")
 
         self.fsm.state = FSM.Idle
 
         self._stopLoops.set()
 
-        if self.sendKATimer:
-            self.sendKATimer.cancel()
-        if self.KAReceptionTimer:
-            self.KAReceptionTimer.cancel()
+        self._cancelKeepAliveTimers()
 
         self.bgpManager.cleanup(self)
 
         self._toIdle()
 
-        # TODO(tmmorin): read BGP specs to get the retries timers right
-        # TODO(tmmorin): replace with a timer that injects an event, so that we
-        # avoid sleeping which make us miss any stop event
-        sleep(10)
-
+        # routes will be advertised again on the next session
+        self.adjRibOut.clear()
+        self._resetMRAI()
+
+        # the route events queued for the session that went down are
+        # obsolete, including route refresh requests to send
+        purgedCount = self._queue.purge(Worker.ROUTES_LANE)
+        self._refreshToSend.clear()
+        if purgedCount:
+            self.log.info("Purged %d pending route event(s)", purgedCount)
+            self._purgedEventCount += purgedCount
+
+        self._scheduleReconnect()
+
+    def _scheduleReconnect(self):
+        self._reconnectAttempts += 1
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY *
+                    2 ** min(self._reconnectAttempts - 1, 16))
+        delay *= 1 - random.uniform(0, RECONNECT_JITTER)
+        self.log.info("Reconnecting in %.1fs (attempt %d)", delay,
+                      self._reconnectAttempts)
+        self._reconnectDelay = delay
+        self._reconnectTime = time.time() + delay
+        # the timer only enqueues an event, so that a stop event is not
+        # delayed while we wait
+        self._reconnectTimer = self.timerWheel.schedule(delay, self.enqueue,
+                                                        Reconnect)
+
+    def _reconnect(self):
+        self._reconnectTimer = None
+        self._reconnectTime = None
+        if self.shouldStop:
+            return
         self._initiateConnectionAndThreads()
 
+    def _sendRouteEvents(self, events):
+        # route events not changing what the peer knows are not sent
+        events = self.adjRibOut.filterEvents(events)
+        if events:
+            self._sendAll(self._updatesForRouteEvents(events))
+
+    # Minimum route advertisement interval #####
+
+    def _paceRouteEvents(self, events):
+        '''
+        Returns the route events to send now, among the given list of route
+        events.
+
+        Once route changes of a family with a minimum route advertisement
+        interval are sent, the route events of this family are held until
+        the interval ends, only the last one being kept for a given NLRI:
+        the intermediate states of a flapping route are then not sent.
+        Withdraws are not held if mraiWithdrawBypass is set.
+        '''
+        result = []
+        startedFamilies = set()
+        for event in events:
+            entry = event.routeEntry
+            family = (entry.afi, entry.safi)
+            if not self.mraiIntervals.get(family):
+                result.append(event)
+                continue
+
+            key = (entry.afi, entry.safi, entry.nlri)
+            pending = self._mraiPending.get(family)
+            if (event.type == RouteEvent.WITHDRAW and
+                    self.mraiWithdrawBypass):
+                if pending is not None and key in pending:
+                    del pending[key]
+                    self._mraiSuppressedCount += 1
+                result.append(event)
+            elif family in self._mraiTimers:
+                if pending is None:
+                    pending = self._mraiPending[family] = OrderedDict()
+                if pending.pop(key, None) is not None:
+                    self._mraiSuppressedCount += 1
+                pending[key] = event
+                self._mraiHeldCount += 1
+            else:
+                result.append(event)
+                startedFamilies.add(family)
+
+        for family in startedFamilies:
+            self._startMRAITimer(family)
+        return result
+
+    def _startMRAITimer(self, family):
+        # the timer only enqueues an event, processed after the route events
+        # already queued
+        self._mraiTimers[family] = self.timerWheel.schedule(
+            self.mraiIntervals[family], self.enqueue, MRAIExpired(family))
+
+    def _onMRAIExpired(self, family):
+        if self._mraiTimers.pop(family, None) is None:
+            # interval of a previous session
+            return
+        pending = self._mraiPending.pop(family, None)
+        if not pending:
+            return
+        self.log.debug("End of %s/%s advertisement interval, sending %d "
+                       "route event(s)", family[0], family[1], len(pending))
+        self._sendRouteEvents(pending.values())
+        self._startMRAITimer(family)
+
+    def _resetMRAI(self):
+        for timer in self._mraiTimers.itervalues():
+            timer.cancel()
+        self._mraiTimers.clear()
+        self._mraiPending.clear()
+
+    def _resendAdjRibOut(self, afi=None, safi=None):
+        '''
+        Sends again to the peer all the routes advertised to it, or only
+        those of the afi/safi family if specified
+        '''
+        events = self.adjRibOut.advertiseEvents(afi, safi)
+        self.log.info("Sending again %d route(s) of the Adj-RIB-Out",
+                      len(events))
+        if events:
+            self._sendAll(self._updatesForRouteEvents(events))
+
+    # Route refresh #####
+
+    def requestRouteRefresh(self, afi, safi):
+        '''
+        Asks the peer to send again its routes of the afi/safi family (e.g.
+        because the routes we import changed)
+        '''
+        if (afi, safi) in self._refreshToSend:
+            # a request is already pending
+            return
+        self._refreshToSend.add((afi, safi))
+        self.enqueue(SendRouteRefresh((afi, safi)))
+
+    def _onRouteRefreshRequested(self, afi, safi):
+        '''
+        Sends again our routes of the afi/safi family, as asked by the peer:
+        can be overridden by subclasses
+        '''
+        self._resendAdjRibOut(afi, safi)
+
+    def _sendRouteRefresh(self, afi, safi):
+        '''
+        Sends the peer a request for its routes of the afi/safi family: to be
+        overridden by subclasses supporting route refresh
+        '''
+        self.log.warning("Route refresh not supported, not asking the peer "
+                         "for its %s/%s routes", afi, safi)
+
     def isEstablished(self):
         return (self.fsm.state == FSM.Established)
 
-    def _receiveLoop(self):
-        self.log.info("Start receive loop")
-        while not self._stopLoops.isSet():
-            try:
-                loopResult = self._receiveLoopFun()
-                if loopResult == 0:
-                    self.log.info(
-                        "receiveLoopFun returned 0, aborting receiveLoop")
-                    break
-                elif loopResult == 2:
-                    self.log.warning("receiveLoopFun returned 2 (error), "
-                                     "aborting receiveLoop and reinitializing")
-                    # FIXME: use (Worker.)enqueueHighPriority so that
-                    # ReInit is treated before other events
-                    self.enqueue(ReInit)
-                    break
-                else:
-                    # everything went fine
-                    pass
-            except Exception as e:
-                self.log.error("Error: %s (=> aborting receiveLoop and "
-                               "reinitializing)", e)
-                if self.log.isEnabledFor(logging.WARNING):
-                    self.log.warning("%s", traceback.format_exc())
-                # FIXME: use (Worker.)enqueueHighPriority so that
-                # ReInit is treated before other events
-                self.enqueue(ReInit)
-                break
-
-        self.log.info("End receive loop")
-
     # Sending keep-alive's #####
 
     def initSendKeepAliveTimer(self):
         self.log.debug("Init sendKA timer (%ds)", self.katPeriod)
-        self.sendKATimer = Timer(
-            self.katPeriod, BGPPeerWorker.sendKeepAliveTrigger, [self])
-        self.sendKATimer.name = "%s:sendKATimer" % self.name
-        self.sendKATimer.start()
+        self.sendKATimer = self.timerWheel.schedule(
+            self.katPeriod, self.sendKeepAliveTrigger)
 
     def sendKeepAliveTrigger(self):
+        if self._stopLoops.isSet():
+            # stopped or re-initiating, the timer will be set again if needed
+            return
         self.log.debug("Trigger send KeepAlive")
         self.enqueue(SendKeepAlive)
         self.initSendKeepAliveTimer()
@@ -299,40 +537,50 @@ class BGPPeerWorker(Worker, Thread, LookingGlassLocalLogger):
     def initKeepAliveReceptionTimer(self):
         self.log.debug(
             "Init Keepalive reception timer (%ds)", self.katExpiryTime)
-        self.KAReceptionTimer = Timer(
-            self.katExpiryTime, BGPPeerWorker.onKeepAliveExpired, [self])
-        self.KAReceptionTimer.start()
+        self.KAReceptionTimer = self.timerWheel.schedule(
+            self.katExpiryTime, self.onKeepAliveExpired)
 
     def onKeepAliveReceived(self):
         self.log.debug("Keepalive received")
         self.KAReceptionTimer.cancel()
         self.initKeepAliveReceptionTimer()
 
+    def _cancelKeepAliveTimers(self):
+        if self.sendKATimer:
+            self.sendKATimer.cancel()
+        if self.KAReceptionTimer:
+            self.KAReceptionTimer.cancel()
+
     def onKeepAliveExpired(self):
+        if self._receivePaused():
+            # keepalives from the peer are not read while the reception is
+            # paused, this does not tell that the peer is down
+            self.log.warning("KeepAlive expired while the reception of "
+                             "messages is paused, waiting longer")
+            self.initKeepAliveReceptionTimer()
+            return
         self.log.error("KeepAlive expired, re-init")
         self.fsm.state = FSM.Idle
         self.enqueue(ReInit)
 
+    def _receivePaused(self):
+        '''
+        Returns True if messages from the peer are currently not read (see
+        flow_control), can be overridden by subclasses
+        '''
+        return False
+
     # Abstract methods
 
     @abstractmethod
     def _initiateConnection(self):
         '''
         Abstract method.
-        The implementation will initiated the connection to the BGP peer, do
-        the initial BGP handshake (send Open, receive Open, send first
-        KeepAlive, receive first KeepAlive) and track the intermediate
-        FSM states (OpenSent, OpenConfirm).
-        '''
-        pass
-
-    @abstractmethod
-    def _receiveLoopFun(self):
-        '''
-        Return codes:
-        - 0: we decided to stop based on stopLoop being set
-        - 1: everything went fine, pursue
-        - 2: there was an error
+        The implementation will initiate the connection to the BGP peer,
+        without blocking; it will then do the initial BGP handshake (send
+        Open, receive Open, send first KeepAlive, receive first KeepAlive),
+        call _openExchanged, and track the intermediate FSM states (OpenSent,
+        OpenConfirm), enqueuing ReInit if the handshake fails.
         '''
         pass
 
@@ -344,8 +592,21 @@ class BGPPeerWorker(Worker, Thread, LookingGlassLocalLogger):
     def _send(self, data):
         pass
 
+    def _sendAll(self, messages):
+        '''
+        Sends a list of messages to the peer: can be overridden by subclasses
+        to send them with as few writes as possible
+        '''
+        for data in messages:
+            self._send(data)
+
     @abstractmethod
-    def _updateForRouteEvent(self, event):
+    def _updatesForRouteEvents(self, events):
+        '''
+        Abstract method.
+        Returns a list of messages to send to the peer, to reflect the
+        given list of route events (in the order they were received).
+        '''
         pass
 
     # Looking glass hooks ###
@@ -359,5 +620,24 @@ class BGPPeerWorker(Worker, Thread, LookingGlassLocalLogger):
                 "last_transition_time": time.strftime(
                     '%Y-%m-%d %H:%M:%S',
                     time.localtime(self.fsm.lastTransitionTime))
+            },
+            "reconnect": {
+                "failed_attempts": self._reconnectAttempts,
+                "last_delay": self._reconnectDelay,
+                "next_attempt_in": (
+                    None if self._reconnectTime is None
+                    else max(0, self._reconnectTime - time.time())),
+                "purged_route_events": self._purgedEventCount
+            },
+            "adj_rib_out": self.adjRibOut.getStats(),
+            "mrai": {
+                "intervals": dict(("%s/%s" % family, interval)
+                                  for (family, interval)
+                                  in self.mraiIntervals.iteritems()),
+                "withdraw_bypass": self.mraiWithdrawBypass,
+                "pending_route_events": sum(
+                    len(pending) for pending in self._mraiPending.values()),
+                "held_route_events": self._mraiHeldCount,
+                "suppressed_route_events": self._mraiSuppressedCount
             }
         }
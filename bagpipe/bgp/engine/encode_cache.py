@@ -0,0 +1,90 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A cache of the path attributes packed in UPDATE messages, shared by all
+the BGP peers: the same route sent to several peers has its attributes
+packed once for each distinct encoding context (ASN4 support, local and
+peer AS), rather than once for each peer.
+
+NLRIs need no such cache, as they keep their packed form once computed.
+"""
+
+import logging
+
+from collections import OrderedDict
+
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 10000
+
+
+class EncodeCache(object):
+
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE):
+        self.maxSize = maxSize
+        self._lock = Lock()
+        # least recently used first
+        self._packed = OrderedDict()
+
+        # statistics
+        self._hitCount = 0
+        self._missCount = 0
+        self._evictionCount = 0
+
+    def packedAttributes(self, attributes, asn4, localAS, peerAS,
+                         nextHop=True):
+        '''
+        Returns attributes.bgp_announce(asn4, localAS, peerAS, nextHop),
+        computed once for all attributes having the same values
+        '''
+        key = (attributes.fingerprint(), asn4, localAS, peerAS, nextHop)
+        with self._lock:
+            packed = self._packed.pop(key, None)
+            if packed is not None:
+                self._hitCount += 1
+                self._packed[key] = packed
+                return packed
+            self._missCount += 1
+
+        packed = attributes.bgp_announce(asn4, localAS, peerAS, nextHop)
+
+        with self._lock:
+            self._packed[key] = packed
+            while len(self._packed) > self.maxSize:
+                self._packed.popitem(last=False)
+                self._evictionCount += 1
+        return packed
+
+    def getStats(self):
+        with self._lock:
+            return {
+                "size": len(self._packed),
+                "max_size": self.maxSize,
+                "hits": self._hitCount,
+                "misses": self._missCount,
+                "evictions": self._evictionCount
+            }
+
+
+_sharedEncodeCache = EncodeCache()
+
+
+def sharedEncodeCache():
+    '''returns the EncodeCache shared by all the BGP peers'''
+    return _sharedEncodeCache
@@ -16,20 +16,26 @@
 # limitations under the License.
 
 
-import traceback
+import logging
+
+import time
 
-import select
+import traceback
 
 import socket
 
-from time import sleep
+from collections import OrderedDict
 
 from bagpipe.bgp.engine.bgp_peer_worker import BGPPeerWorker, \
-    KeepAliveReceived, SendKeepAlive, FSM, InitiateConnectionException, \
-    OpenWaitTimeout, StoppedException
+    KeepAliveReceived, SendKeepAlive, ReInit, FSM, \
+    InitiateConnectionException, RouteRefreshRequested
 from bagpipe.bgp.engine import RouteEvent
+from bagpipe.bgp.engine.flow_control import sharedFlowControl
+from bagpipe.bgp.engine.encode_cache import sharedEncodeCache
 
 from bagpipe.bgp.common.looking_glass import LookingGlass
+from bagpipe.bgp.common.reactor import sharedReactor
+from bagpipe.bgp.common.utils import getBoolean
 
 from bagpipe.exabgp.network.connection import Connection
 from bagpipe.exabgp.network.protocol import Protocol, Failure
@@ -39,13 +45,27 @@ from bagpipe.exabgp.structure.address import AFI, SAFI
 
 from bagpipe.exabgp.message.update.attribute.communities import RouteTarget
 from bagpipe.exabgp.message.nop import NOP
-from bagpipe.exabgp.message.open import Open, RouterID, Capabilities
+from bagpipe.exabgp.message.open import Open, RouterID, Capabilities, \
+    RouteRefresh as RouteRefreshCapability, EnhancedRouteRefresh
+from bagpipe.exabgp.message.refresh import RouteRefresh
 from bagpipe.exabgp.message.update import Update
 from bagpipe.exabgp.message.keepalive import KeepAlive
 from bagpipe.exabgp.message.notification import Notification
-from bagpipe.exabgp.message.update.route import Route
+from bagpipe.exabgp.message.update.route import Route, ReceivedRoute
 from bagpipe.exabgp.message.update.attribute.id import AttributeID
 
+# maximum size of a BGP message, including headers
+BGP_MAX_MESSAGE_SIZE = 4096
+
+# time allowed to connect to the peer and receive its Open, in seconds
+OPEN_WAIT_TIMEOUT = 10
+
+# config options giving the minimum route advertisement interval of each
+# family, in seconds (the 'mrai' option gives the default for all families)
+MRAI_OPTIONS = {(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn)): 'mrai_ipvpn',
+                (AFI(AFI.l2vpn), SAFI(SAFI.evpn)): 'mrai_evpn',
+                (AFI(AFI.ipv4), SAFI(SAFI.rtc)): 'mrai_rtc'}
+
 
 class FakePeer(object):
 
@@ -94,12 +114,42 @@ class MyBGPProtocol(Protocol):
             o.capabilities[Capabilities.MULTIPROTOCOL_EXTENSIONS].append(
                 (AFI(AFI.ipv4), SAFI(SAFI.rtc)))
 
+        # route refresh (RFC 2918) and enhanced route refresh (RFC 7313)
+        o.capabilities[Capabilities.ROUTE_REFRESH] = RouteRefreshCapability()
+        o.capabilities[Capabilities.ENHANCED_ROUTE_REFRESH] = \
+            EnhancedRouteRefresh()
+
         if not self.connection.write(o.message()):
             raise Exception("Error while sending open")
 
         return o
 
 
+class _ConnectionHandler(object):
+
+    '''Reactor handler for the connection of an ExaBGPPeerWorker'''
+
+    def __init__(self, worker, connection):
+        self.worker = worker
+        self.connection = connection
+        self.fd = connection.io.fileno()
+        # set to False once the worker is done with the connection
+        self.active = True
+
+    def onWritable(self):
+        if self.active:
+            self.worker._onConnectionEvent(
+                self.connection, self.worker._onConnectionWritable)
+
+    def onReadable(self):
+        if self.active:
+            self.worker._onConnectionEvent(
+                self.connection, self.worker._onConnectionReadable)
+
+    def __repr__(self):
+        return "[ConnectionHandler of %s]" % self.worker.name
+
+
 class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
 
     enabledFamilies = [(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn)),
@@ -112,13 +162,67 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
         self.localAddress = self.config['local_address']
         self.peerAddress = peerAddress
 
+        # connect, Open exchange and reads are done by the thread of the
+        # reactor
+        self.reactor = sharedReactor()
         self.connection = None
+        self._connectionHandler = None
+        self._openWaitTimer = None
+        self._sentOpen = None
+
+        # reading from the socket is paused while the event queues of the
+        # components processing the routes received are congested
+        self.flowControl = sharedFlowControl()
+        self._readPaused = False
+
+        # attributes are packed once for all the peers
+        self.encodeCache = sharedEncodeCache()
+        self._readPausedSince = None
 
         self.rtc_active = False
         self._activeFamilies = []
 
+        # route refresh, as negotiated with the peer
+        self._routeRefresh = False
+        self._enhancedRefresh = False
+        # with enhanced route refresh, family -> NLRIs of the routes received
+        # from the peer, and of those not received again yet since the
+        # beginning of a route refresh (BoRR)
+        self._receivedNLRIs = dict()
+        self._staleNLRIs = dict()
+        self._refreshStats = {'requests_received': 0, 'requests_sent': 0,
+                              'stale_routes_swept': 0}
+
+        # messages are sent from an output buffer, flushed at the end of each
+        # batch of messages with as few writes as possible, optionally with
+        # TCP_CORK set during the writes
+        self.tcpCork = getBoolean(self.config.get('tcp_cork', False))
+
+        # successive changes of routes are paced (see
+        # BGPPeerWorker._paceRouteEvents), not by default
+        defaultMRAI = float(self.config.get('mrai', 0))
+        for (family, option) in MRAI_OPTIONS.iteritems():
+            interval = float(self.config.get(option, defaultMRAI))
+            if interval > 0:
+                self.mraiIntervals[family] = interval
+        self.mraiWithdrawBypass = getBoolean(
+            self.config.get('mrai_withdraw_bypass', True))
+
+        self._resetReceiveStats()
+
+    def _resetReceiveStats(self):
+        self._receiveStats = {'wakeups': 0, 'bytes': 0, 'messages': 0,
+                              'pauses': 0, 'paused_time': 0}
+        self._sendStats = {'messages': 0, 'flushes': 0}
+
     def _toIdle(self):
+        self.flowControl.removeListener(self._onCongestion)
+        self._closeConnection()
+        if self._readPaused:
+            self._setReadPaused(False)
         self._activeFamilies = []
+        self._receivedNLRIs.clear()
+        self._staleNLRIs.clear()
 
     def _initiateConnection(self):
         self.log.debug("Initiate ExaBGP connection to %s from %s",
@@ -126,6 +230,8 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
 
         self.rtc_active = False
 
+        self._resetReceiveStats()
+
         neighbor = Neighbor()
         neighbor.router_id = RouterID(self.config['local_address'])
         neighbor.local_as = self.config['my_as']
@@ -139,7 +245,8 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
         local = FakeLocal(self.localAddress)
 
         try:
-            self.connection = Connection(peer, local, None, None)
+            self.connection = Connection(peer, local, None, None,
+                                         blocking=False)
         except Failure as e:
             raise InitiateConnectionException(repr(e))
 
@@ -147,45 +254,153 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
         self.protocol = MyBGPProtocol(peer, self.connection)
         self.protocol.connect()
 
+        self._openWaitTimer = self.timerWheel.schedule(
+            OPEN_WAIT_TIMEOUT, self._onOpenWaitTimeout, self.connection)
+
+        # the socket will be writable once connected, the handshake is then
+        # done by _onConnectionWritable and _onConnectionReadable, called by
+        # the reactor
+        self._connectionHandler = _ConnectionHandler(self, self.connection)
+        self.reactor.register(self._connectionHandler.fd,
+                              self._connectionHandler, read=True, write=True)
+
+    def _onOpenWaitTimeout(self, connection):
+        if (connection is self.connection and
+                self.fsm.state in (FSM.Connect, FSM.OpenSent)):
+            # FIXME: we should send a Notification when needed
+            self.log.warning("No Open received after %ds, re-init",
+                             OPEN_WAIT_TIMEOUT)
+            self._connectionFailed()
+
+    def _connectionFailed(self):
+        # stop processing events on the connection, it will be closed
+        # when re-initiating
+        self._connectionHandler.active = False
+        self.reactor.unregister(self._connectionHandler.fd,
+                                self._connectionHandler)
+        self._openWaitTimer.cancel()
+        self.enqueue(ReInit)
+
+    def _closeConnection(self):
+        connection = self.connection
+        if connection is None:
+            return
+        self.connection = None
+        self._connectionHandler.active = False
+        self.reactor.unregister(self._connectionHandler.fd,
+                                self._connectionHandler)
+        self._openWaitTimer.cancel()
+        connection.close()
+
+    def _onConnectionEvent(self, connection, callback):
+        # (called by the thread of the reactor)
+        if connection is not self.connection:
+            # stale event, for a connection we closed since
+            return
+        try:
+            callback(connection)
+            return
+        except Notification as e:
+            self.log.error("Peer notified us about an error: %s", e)
+        except Failure as e:
+            self.log.warning("Protocol failure: %s", e)
+        except socket.error as e:
+            self.log.warning("Socket error: %s", e)
+        except Exception as e:
+            self.log.error("Error while processing BGP connection event: %s",
+                           e)
+            if self.log.isEnabledFor(logging.WARNING):
+                self.log.warning("%s", traceback.format_exc())
+        self._connectionFailed()
+
+    def _onConnectionWritable(self, connection):
+        if self.fsm.state != FSM.Connect:
+            # the output buffer could not be sent at once
+            if connection.flush(self.tcpCork) == 0:
+                self._updateInterest()
+            return
+
+        connection.connected()
+
         # this is highly similar to exabgp.network.peer._run
 
-        o = self.protocol.new_open(
+        self._sentOpen = self.protocol.new_open(
             False, False, self.config, ExaBGPPeerWorker.enabledFamilies)
 
-        self.log.debug("Send open: [%s]", o)
+        self.log.debug("Send open: [%s]", self._sentOpen)
         self.fsm.state = FSM.OpenSent
 
-        count = 0
         self.log.debug("Wait for open...")
-        while not self.shouldStop:
-            # FIXME: we should time-out here, at some point
-            message = self.protocol.read_open(o, None)
-
-            count += 1
-            if isinstance(message, NOP):
-                # TODO(tmmorin): check compliance with BGP specs...
-                if count > 20:
-                    self.connection.close()
-                    # FIXME: this should be moved to
-                    # BGPPeerWorker in a more generic way
-                    # (+ send Notify when needed)
-                    raise OpenWaitTimeout("%ds" % int(20 * 0.5))
-                sleep(0.5)
-                continue
-
-            self.log.debug("Read message: %s", message)
-
-            if isinstance(message, Open):
-                break
+        self.reactor.modify(self._connectionHandler.fd,
+                            self._connectionHandler, read=True)
+
+    def _onConnectionReadable(self, connection):
+        if self.fsm.state == FSM.Connect:
+            # a failed connection attempt is reported as readable
+            self._onConnectionWritable(connection)
+            return
+
+        bytesReceived = connection.bytes_received
+        # all the complete messages received are processed at once
+        messages = self.protocol.read_messages()
+
+        self._receiveStats['wakeups'] += 1
+        self._receiveStats['bytes'] += (connection.bytes_received -
+                                        bytesReceived)
+        self._receiveStats['messages'] += len(messages)
+
+        for message in messages:
+            if self.fsm.state == FSM.OpenSent:
+                self._onOpenReceived(message)
             else:
-                self.log.error("Received unexpected message: %s", message)
-                # FIXME
+                self._processReceivedMessage(message)
+
+    def _onCongestion(self, congested):
+        # (called with the lock of the FlowControl held)
+        self.reactor.callFromThread(self._updateReading)
+
+    def _updateReading(self):
+        # (called by the thread of the reactor)
+        handler = self._connectionHandler
+        if (handler is None or not handler.active or
+                self.fsm.state != FSM.Established):
+            return
+        paused = self.flowControl.isCongested()
+        if paused == self._readPaused:
+            return
+        self._setReadPaused(paused)
+        self._updateInterest()
+
+    def _updateInterest(self):
+        # (called by the thread of the reactor)
+        handler = self._connectionHandler
+        if handler is None or not handler.active:
+            return
+        self.reactor.modify(
+            handler.fd, handler, read=not self._readPaused,
+            write=handler.connection.pending_output() > 0)
+
+    def _setReadPaused(self, paused):
+        self._readPaused = paused
+        if paused:
+            self.log.info("Pausing the reception of messages (flow control)")
+            self._receiveStats['pauses'] += 1
+            self._readPausedSince = time.time()
+        else:
+            self.log.info("Resuming the reception of messages")
+            self._receiveStats['paused_time'] += (time.time() -
+                                                  self._readPausedSince)
+            self._readPausedSince = None
 
-        if self.shouldStop:
-            raise StoppedException()
+    def _receivePaused(self):
+        return self._readPaused
 
-        # An Open was received
-        received_open = message
+    def _onOpenReceived(self, message):
+        self.log.debug("Read message: %s", message)
+
+        # raises a Notify if message is not an Open we can accept
+        received_open = self.protocol.check_open(self._sentOpen, message)
+        self._openWaitTimer.cancel()
 
         self._setHoldTime(received_open.hold_time)
 
@@ -222,9 +437,19 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
         if len(self._activeFamilies) == 0:
             self.log.error("No family was negotiated for VPN routes")
 
+        capabilities = received_open.capabilities
+        self._routeRefresh = (
+            capabilities.announced(Capabilities.ROUTE_REFRESH) or
+            capabilities.announced(Capabilities.CISCO_ROUTE_REFRESH))
+        self._enhancedRefresh = (
+            self._routeRefresh and
+            capabilities.announced(Capabilities.ENHANCED_ROUTE_REFRESH))
+        self.log.info("Route refresh: %s, enhanced route refresh: %s",
+                      self._routeRefresh, self._enhancedRefresh)
+
         # proceed BGP session
 
-        self.connection.io.setblocking(1)
+        self._openExchanged()
 
         self.enqueue(SendKeepAlive)
 
@@ -244,6 +469,9 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
     def _toEstablished(self):
         BGPPeerWorker._toEstablished(self)
 
+        self.flowControl.addListener(self._onCongestion)
+        self._updateReading()
+
         if self.rtc_active:
             # subscribe to RTC routes, to be able to propagate them from
             # internal workers to this peer
@@ -254,34 +482,8 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
             for (afi, safi) in self._activeFamilies:
                 self._subscribe(afi, safi)
 
-    def _receiveLoopFun(self):
-
-        select.select([self.connection.io], [], [], 5)
-
-        if not self._queue.empty():
-            if self._stopLoops.isSet():
-                self.log.info("stopLoops is set -> Close connection and"
-                              " Finish receive Loop")
-                self.connection.close()
-                return 0
-
-        try:
-            message = self.protocol.read_message()
-        except Notification as e:
-            self.log.error("Peer notified us about an error: %s", e)
-            return 2
-        except Failure as e:
-            self.log.warning("Protocol failure: %s", e)
-            return 2
-        except socket.error as e:
-            self.log.warning("Socket error: %s", e)
-            return 2
-        except Exception as e:
-            self.log.error("Error while reading BGP message: %s", e)
-            raise
-
+    def _processReceivedMessage(self, message):
         if message.TYPE in (NOP.TYPE):
-            # we arrived here because select call timed-out
             return 1
         elif message.TYPE == Update.TYPE:
             if (self.fsm.state != FSM.Established):
@@ -292,6 +494,11 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
                 self._toEstablished()
             self.enqueue(KeepAliveReceived)
             self.log.debug("Received message: %s", message)
+        elif message.TYPE == RouteRefresh.TYPE:
+            if (self.fsm.state != FSM.Established):
+                raise Exception("Route refresh received but not in "
+                                "Established state")
+            self._processRouteRefresh(message)
         else:
             self.log.warning("Received unexpected message: %s", message)
 
@@ -324,6 +531,16 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
         else:
             self._pushEvent(RouteEvent(RouteEvent.WITHDRAW, routeEntry))
 
+        if self._enhancedRefresh:
+            family = (route.nlri.afi, route.nlri.safi)
+            stale = self._staleNLRIs.get(family, ())
+            if stale:
+                stale.discard(route.nlri)
+            if route.action == "announce":
+                self._receivedNLRIs.setdefault(family, set()).add(route.nlri)
+            else:
+                self._receivedNLRIs.get(family, set()).discard(route.nlri)
+
         # TODO(tmmorin): move RTC code out-of the peer-specific code
         if (route.nlri.afi, route.nlri.safi) == (AFI(AFI.ipv4),
                                                  SAFI(SAFI.rtc)):
@@ -342,40 +559,197 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
                     else:  # withdraw
                         self._unsubscribe(afi, safi, route.nlri.route_target)
 
+    def _processRouteRefresh(self, message):
+        self.log.info("Received message: %s", message)
+        family = (message.afi, message.safi)
+        if family not in self._activeFamilies:
+            self.log.warning("Ignoring route refresh for a family not "
+                             "negotiated: %s", message)
+            return
+
+        if message.subtype == RouteRefresh.REQUEST:
+            self._refreshStats['requests_received'] += 1
+            # (the Adj-RIB-Out belongs to the thread of the worker)
+            self.enqueue(RouteRefreshRequested(family))
+        elif not self._enhancedRefresh:
+            self.log.warning("Ignoring route refresh, enhanced route refresh "
+                             "was not negotiated: %s", message)
+        elif message.subtype == RouteRefresh.BEGIN:
+            # the routes not sent again before the end of the route refresh
+            # are stale
+            self._staleNLRIs[family] = set(
+                self._receivedNLRIs.get(family, ()))
+        elif message.subtype == RouteRefresh.END:
+            stale = self._staleNLRIs.pop(family, None)
+            if stale is None:
+                self.log.warning("End of route refresh without a beginning, "
+                                 "ignoring: %s", message)
+                return
+            if stale:
+                self.log.info("Withdrawing %d stale route(s) at the end of "
+                              "route refresh", len(stale))
+            for nlri in stale:
+                self._processReceivedRoute(ReceivedRoute(nlri, "withdraw"))
+            self._refreshStats['stale_routes_swept'] += len(stale)
+        else:
+            self.log.warning("Ignoring route refresh with unknown subtype: "
+                             "%s", message)
+
+    def _onRouteRefreshRequested(self, afi, safi):
+        self.log.info("Route refresh requested by the peer for %s/%s",
+                      afi, safi)
+        if not self._enhancedRefresh:
+            BGPPeerWorker._onRouteRefreshRequested(self, afi, safi)
+            return
+        # the routes are sent between BoRR and EoRR markers, for the peer to
+        # remove the routes not sent again
+        events = self.adjRibOut.advertiseEvents(afi, safi)
+        self.log.info("Sending again %d route(s) of the Adj-RIB-Out",
+                      len(events))
+        self._sendAll([RouteRefresh(afi, safi, RouteRefresh.BEGIN).message()]
+                      + self._updatesForRouteEvents(events) +
+                      [RouteRefresh(afi, safi, RouteRefresh.END).message()])
+
+    def _sendRouteRefresh(self, afi, safi):
+        if not self._routeRefresh:
+            self.log.warning("Peer does not support route refresh, not "
+                             "asking for its %s/%s routes", afi, safi)
+            return
+        if (afi, safi) not in self._activeFamilies:
+            self.log.debug("No route refresh for %s/%s, family not "
+                           "negotiated", afi, safi)
+            return
+        self.log.info("Asking the peer for its %s/%s routes", afi, safi)
+        self._refreshStats['requests_sent'] += 1
+        self._send(RouteRefresh(afi, safi).message())
+
     def _send(self, data):
-        # (error if state not the right one for sending updates)
-        self.log.debug("Sending %d bytes on socket to peer %s",
-                       len(data), self.peerAddress)
+        self._sendAll([data])
+
+    def _sendAll(self, messages):
+        connection = self.connection
+        if connection is None:
+            # the session went down
+            return
+        for data in messages:
+            connection.queue(data)
+            self._sendStats['messages'] += 1
+        self.log.debug("Sending %d message(s), %d bytes pending, to peer %s",
+                       len(messages), connection.pending_output(),
+                       self.peerAddress)
+        self._sendStats['flushes'] += 1
         try:
-            self.connection.write(data)
-        except Exception as e:
-            self.log.error("Was not able to send data: %s", e)
+            pending = connection.flush(self.tcpCork)
+        except Failure as e:
+            self.log.warning("Error while sending to peer: %s", e)
+            if connection is self.connection:
+                self._connectionFailed()
+            return
+        if pending:
+            # the reactor will tell us when we can send the rest
+            self.reactor.callFromThread(self._updateInterest)
 
     def _keepAliveMessageData(self):
         return KeepAlive().message()
 
-    def _updateForRouteEvent(self, event):
-        r = Route(event.routeEntry.nlri)
-        if event.type == event.ADVERTISE:
-            self.log.info("Generate UPDATE message: %s", r)
-            r.attributes = event.routeEntry.attributes
+    def _attributesGroupKey(self, afi, safi, attributes):
+        # routes can share an UPDATE if they have the same family, and if
+        # the attributes and next-hop that would be encoded are the same
+        # (the packed attributes are the last item of the key)
+        nextHop = ''
+        if AttributeID.NEXT_HOP in attributes:
+            nextHop = attributes[AttributeID.NEXT_HOP].next_hop.pack()
+        return (afi, safi, nextHop,
+                self.encodeCache.packedAttributes(
+                    attributes, False, self.config['my_as'],
+                    self.config['my_as'], not Update.mp_family(afi, safi)))
+
+    def _chunkRoutes(self, routes, firstMessage):
+        '''
+        Splits routes in lists of routes that will each fit in a message,
+        based on the size of a message carrying only the first route
+        '''
+        # one byte of margin for the MP_(UN)REACH_NLRI attribute switching
+        # to the extended length encoding
+        overhead = len(firstMessage) - len(routes[0].nlri.pack()) + 1
+        chunk = []
+        size = overhead
+        for route in routes:
+            nlriSize = len(route.nlri.pack())
+            if chunk and size + nlriSize > BGP_MAX_MESSAGE_SIZE:
+                yield chunk
+                chunk = []
+                size = overhead
+            chunk.append(route)
+            size += nlriSize
+        if chunk:
+            yield chunk
+
+    def _updatesForRouteEvents(self, events):
+        # for a given NLRI, only the last event matters, as it would
+        # override previous ones on the peer side
+        lastEvents = OrderedDict()
+        for event in events:
+            entry = event.routeEntry
+            lastEvents[(entry.afi, entry.safi, entry.nlri)] = event
+
+        withdrawGroups = OrderedDict()
+        advertiseGroups = OrderedDict()
+        groupKeys = {}
+        for ((afi, safi, nlri), event) in lastEvents.iteritems():
+            r = Route(nlri)
+            if event.type == event.ADVERTISE:
+                attributes = event.routeEntry.attributes
+                r.attributes = attributes
+                try:
+                    key = groupKeys[id(attributes)]
+                except KeyError:
+                    try:
+                        key = self._attributesGroupKey(afi, safi, attributes)
+                    except Exception as e:
+                        self.log.error("Exception while generating message "
+                                       "for route %s: %s", r, e)
+                        self.log.warning("%s", traceback.format_exc())
+                        continue
+                    groupKeys[id(attributes)] = key
+                advertiseGroups.setdefault(key, []).append(r)
+            elif event.type == event.WITHDRAW:
+                withdrawGroups.setdefault((afi, safi), []).append(r)
+
+        messages = []
+
+        for routes in withdrawGroups.itervalues():
+            firstMessage = Update(routes[:1]).withdraw(
+                False, self.config['my_as'], self.config['my_as'])
+            for chunk in self._chunkRoutes(routes, firstMessage):
+                self.log.info("Generate WITHDRAW message for %d route(s): "
+                              "%s", len(chunk), chunk)
+                messages.append(Update(chunk).withdraw(
+                    False, self.config['my_as'], self.config['my_as']))
+
+        for (key, routes) in advertiseGroups.iteritems():
+            packedAttributes = key[-1]
             try:
-                return Update([r]).update(False, self.config['my_as'],
-                                          self.config['my_as'])
+                firstMessage = Update(routes[:1]).update(
+                    False, self.config['my_as'], self.config['my_as'],
+                    packedAttributes)
+                for chunk in self._chunkRoutes(routes, firstMessage):
+                    self.log.info("Generate UPDATE message for %d route(s): "
+                                  "%s", len(chunk), chunk)
+                    messages.append(Update(chunk).update(
+                        False, self.config['my_as'], self.config['my_as'],
+                        packedAttributes))
             except Exception as e:
                 self.log.error("Exception while generating message for "
-                               "route %s: %s", r, e)
+                               "routes %s: %s", routes, e)
                 self.log.warning("%s", traceback.format_exc())
-                return ''
 
-        elif event.type == event.WITHDRAW:
-            self.log.info("Generate WITHDRAW message: %s", r)
-            return Update([r]).withdraw(False, self.config['my_as'],
-                                        self.config['my_as'])
+        self.log.debug("%d route event(s) resulted in %d message(s)",
+                       len(events), len(messages))
+        return messages
 
     def stop(self):
-        if self.connection is not None:
-            self.connection.close()
+        self._closeConnection()
         BGPPeerWorker.stop(self)
 
     # Looking Glass ###############
@@ -389,4 +763,33 @@ class ExaBGPPeerWorker(BGPPeerWorker, LookingGlass):
             "rtc": {"active": self.rtc_active,
                     "enabled": self.config['enable_rtc']},
             "active_families": [repr(f) for f in self._activeFamilies],
+            "receive": self._getLGReceiveStats(),
+            "send": self._getLGSendStats(),
+            "route_refresh": dict(self._refreshStats,
+                                  negotiated=self._routeRefresh,
+                                  enhanced=self._enhancedRefresh,
+                                  refreshes_in_progress=[
+                                      "%s/%s" % family for family
+                                      in self._staleNLRIs.keys()]),
         }
+
+    def _getLGReceiveStats(self):
+        stats = dict(self._receiveStats)
+        stats['paused'] = self._readPaused
+        wakeups = max(stats['wakeups'], 1)
+        stats['bytes_per_wakeup'] = stats['bytes'] / wakeups
+        stats['messages_per_wakeup'] = stats['messages'] / wakeups
+        return stats
+
+    def _getLGSendStats(self):
+        stats = dict(self._sendStats)
+        stats['tcp_cork'] = self.tcpCork
+        connection = self.connection
+        if connection is not None:
+            stats['bytes'] = connection.bytes_sent
+            stats['writes'] = connection.writes
+            stats['partial_writes'] = connection.partial_writes
+            stats['pending_bytes'] = connection.pending_output()
+            stats['messages_per_write'] = (stats['messages'] /
+                                           max(connection.writes, 1))
+        return stats
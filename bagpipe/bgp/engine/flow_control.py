@@ -0,0 +1,205 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Flow control between the BGP peers and the components processing the
+routes they receive (route table manager, VPN instances).
+
+The length of the event queues of these components is tracked against a
+high and a low watermark: a queue becomes congested when its length reaches
+the high watermark, and stays congested until its length goes down to the
+low watermark. While any queue is congested, the listeners of the
+FlowControl are told to stop producing events: BGP peers then stop reading
+from their socket, so that TCP flow control slows down the peers sending
+routes faster than we can process them.
+
+Queues are not bounded in the sense that a put would block when they are
+full: the route table manager and the workers enqueue events in each
+other's queues, and blocking them could deadlock.
+"""
+
+import logging
+
+import time
+
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HIGH_WATERMARK = 20000
+DEFAULT_LOW_WATERMARK = 5000
+
+
+class QueueWatermarks(object):
+
+    """Tracks the length of a queue against the watermarks of a FlowControl
+    (see LanesQueue.setWatermarks)"""
+
+    def __init__(self, flowControl, name):
+        self.flowControl = flowControl
+        self.name = name
+        self.congested = False
+        self._congestedSince = None
+
+        # statistics
+        self._maxLength = 0
+        self._congestionCount = 0
+        self._congestedTime = 0
+
+    def update(self, length):
+        # (called by the queue, with its lock held, each time its length
+        # changes)
+        if length > self._maxLength:
+            self._maxLength = length
+        if self.congested:
+            if length <= self.flowControl.lowWatermark:
+                self._setCongested(False)
+        elif 0 < self.flowControl.highWatermark <= length:
+            self._setCongested(True)
+
+    def release(self):
+        '''called when the queue is not tracked anymore'''
+        if self.congested:
+            self._setCongested(False)
+
+    def _setCongested(self, congested):
+        self.congested = congested
+        if congested:
+            self._congestionCount += 1
+            self._congestedSince = time.time()
+        else:
+            self._congestedTime += time.time() - self._congestedSince
+            self._congestedSince = None
+        self.flowControl._congestionChanged(self, congested)
+
+    def getStats(self):
+        congestedTime = self._congestedTime
+        if self._congestedSince is not None:
+            congestedTime += time.time() - self._congestedSince
+        return {
+            "congested": self.congested,
+            "max_length": self._maxLength,
+            "high_watermark_crossings": self._congestionCount,
+            "congested_time": congestedTime
+        }
+
+
+class FlowControl(object):
+
+    def __init__(self, highWatermark=DEFAULT_HIGH_WATERMARK,
+                 lowWatermark=DEFAULT_LOW_WATERMARK):
+        self.setWatermarks(highWatermark, lowWatermark)
+        self._lock = Lock()
+        # QueueWatermarks of the congested queues
+        self._congested = set()
+        self._listeners = []
+
+        # statistics
+        self._stallCount = 0
+        self._stalledSince = None
+        self._stallTime = 0
+        self._maxStallTime = 0
+
+    def setWatermarks(self, highWatermark, lowWatermark):
+        '''a highWatermark of 0 disables flow control'''
+        if highWatermark and not (0 <= lowWatermark < highWatermark):
+            raise Exception("the low watermark (%d) must be lower than the "
+                            "high watermark (%d)" % (lowWatermark,
+                                                     highWatermark))
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+
+    def watch(self, component):
+        '''tracks the length of the event queue of component (a Worker or a
+        RouteTableManager), until the queue is given other watermarks'''
+        component._queue.setWatermarks(QueueWatermarks(self,
+                                                       component.name))
+
+    def addListener(self, callback):
+        '''
+        callback(congested) will be called each time the queues, as a
+        whole, become congested or stop being congested: it is called with
+        the lock of this object held, and thus must not block
+        '''
+        with self._lock:
+            self._listeners.append(callback)
+
+    def removeListener(self, callback):
+        with self._lock:
+            try:
+                self._listeners.remove(callback)
+            except ValueError:
+                pass
+
+    def isCongested(self):
+        return bool(self._congested)
+
+    def _congestionChanged(self, watermarks, congested):
+        with self._lock:
+            wasCongested = bool(self._congested)
+            if congested:
+                log.info("Queue of %s is congested", watermarks.name)
+                self._congested.add(watermarks)
+            else:
+                log.info("Queue of %s is not congested anymore",
+                         watermarks.name)
+                self._congested.discard(watermarks)
+            if wasCongested == bool(self._congested):
+                return
+
+            if congested:
+                log.warning("Event queues congested, pausing the reception "
+                            "of routes")
+                self._stallCount += 1
+                self._stalledSince = time.time()
+            else:
+                stallTime = time.time() - self._stalledSince
+                log.warning("Event queues not congested anymore, resuming "
+                            "the reception of routes (paused for %.1fs)",
+                            stallTime)
+                self._stallTime += stallTime
+                self._maxStallTime = max(self._maxStallTime, stallTime)
+                self._stalledSince = None
+
+            for callback in self._listeners:
+                try:
+                    callback(congested)
+                except Exception as e:
+                    log.error("Exception in flow control listener %s: %s",
+                              callback, e)
+
+    def getStats(self):
+        with self._lock:
+            stallTime = self._stallTime
+            if self._stalledSince is not None:
+                stallTime += time.time() - self._stalledSince
+            return {
+                "high_watermark": self.highWatermark,
+                "low_watermark": self.lowWatermark,
+                "congested_queues": sorted(watermarks.name for watermarks
+                                           in self._congested),
+                "stalls": self._stallCount,
+                "stall_time": stallTime,
+                "max_stall_time": self._maxStallTime
+            }
+
+
+_sharedFlowControl = FlowControl()
+
+
+def sharedFlowControl():
+    '''returns the FlowControl shared by all the components of bagpipe-bgp'''
+    return _sharedFlowControl
@@ -17,12 +17,17 @@
 
 import logging
 import traceback
+import time
 
 from threading import Thread
-from Queue import Queue
+from Queue import Empty
 
-from bagpipe.bgp.engine import RouteEvent, Subscription, Unsubscription
-from bagpipe.bgp.engine.worker import Worker
+from collections import OrderedDict
+
+from bagpipe.bgp.engine import RouteEvent, Subscription, Unsubscription, \
+    InternStore, RouteTargetList, attributesKey, routeTargetsKey
+from bagpipe.bgp.engine.worker import Worker, LanesQueue
+from bagpipe.bgp.engine.flow_control import sharedFlowControl
 from bagpipe.bgp.engine.bgp_peer_worker import BGPPeerWorker
 
 from bagpipe.bgp.common.looking_glass import LookingGlass, LGMap
@@ -43,6 +48,53 @@ class WorkerCleanupEvent(object):
         return "WorkerCleanupEvent:%s" % (self.worker.name)
 
 
+class MatchKey(object):
+
+    '''
+    An interned match key (see matchKey): an (afi, safi, routeTarget) tuple,
+    wrapped so that it can be weakly referenced
+    '''
+
+    __slots__ = ('values', '_hash', '__weakref__')
+
+    def __init__(self, values):
+        self.values = values
+        self._hash = hash(values)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return (self is other or
+                (isinstance(other, MatchKey) and self.values == other.values))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(self.values)
+
+
+# interned (afi, safi, routeTarget) keys, see matchKey: keys are forgotten
+# once no subscription or route uses them anymore
+_matchKeys = InternStore(lambda key: key, MatchKey)
+
+
+def matchKey(afi, safi, routeTarget):
+    '''
+    Returns the key under which routes and subscriptions for this
+    afi/safi/routeTarget are indexed by the RouteTableManager, wrapping a
+    tuple of the AFI and SAFI values and of the encoded route target (or
+    None).
+
+    Keys are interned, so that the same key object is used for all
+    routes and subscriptions sharing a key.
+    '''
+    return _matchKeys.intern(
+        (int(afi), int(safi),
+         routeTarget.community if routeTarget is not None else None))
+
+
 class Match(object):
 
     def __init__(self, afi, safi, routeTarget):
@@ -52,10 +104,17 @@ class Match(object):
         self.afi = afi
         self.safi = safi
         self.routeTarget = routeTarget
+        self.key = matchKey(afi, safi, routeTarget)
+        self._hash = hash(self.key)
 
-    # FIXME: use a better hash if needed for performances
     def __hash__(self):
-        return hash(repr(self))
+        return self._hash
+
+    def __eq__(self, other):
+        return isinstance(other, Match) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def __repr__(self):
         return "match:%s/%s,%s" % (self.afi or "*", self.safi or "*",
@@ -77,6 +136,9 @@ class Match(object):
 
 StopEvent = "StopEvent"
 
+# maximum number of events dequeued and processed at once
+MAX_BATCH_SIZE = 1000
+
 
 class RouteTableManager(Thread, LookingGlass):
 
@@ -93,28 +155,61 @@ class RouteTableManager(Thread, LookingGlass):
     """
     class WorkersAndEntries(object):
 
-        def __init__(self):
+        def __init__(self, match):
+            self.match = match
             self.workers = set()
+            # bitmask of the workers, see _workerBit
+            self.workersMask = 0
             self.entries = set()
 
         def __repr__(self):
             return "workers: %s\nentries: %s" % (self.workers,
                                                  self.entries)
 
-    def __init__(self):
-        Thread.__init__(self, name="RouteTableManager")
+    def __init__(self, name="RouteTableManager", attributesStore=None,
+                 routeTargetsStore=None):
+        Thread.__init__(self, name=name)
         self.setDaemon(True)
 
         self._match2workersAndEntries = {}
-        # keys are Matches, values are WorkersAndEntries objects
+        # keys are match keys (see matchKey), values are WorkersAndEntries
+        # objects
         self._worker2matches = {}  # keys are Workers, values are Match objects
+
+        # each subscribed worker is given a bit, to compute the set of
+        # workers interested in a route with a few bitwise ORs
+        self._worker2bit = {}
+        self._bit2worker = {}
+        self._freeBits = []
+        self._nextBit = 0
+        # bitmask of all the BGPPeerWorkers that have a bit
+        self._bgpPeersMask = 0
         self._source_nlri2entry = {}
         # keys are (source,nlri) tuples, values are Entry objects
         self._source2entries = {}
         # dict: keys are event sources, each value is a set() of Entry
         # objects
 
-        self._queue = Queue()
+        # (a single lane: the order of events is always preserved)
+        self._queue = LanesQueue(1, 0)
+        sharedFlowControl().watch(self)
+
+        # batch processing statistics
+        self._batchCount = 0
+        self._batchEventCount = 0
+        self._coalescedEventCount = 0
+        self._lastBatchSize = 0
+        self._lastBatchDuration = 0
+        self._maxBatchDuration = 0
+
+        # identical attributes and lists of Route Targets of the routes we
+        # store are shared, see _internRouteEntry
+        if attributesStore is None:
+            attributesStore = InternStore(attributesKey)
+        if routeTargetsStore is None:
+            routeTargetsStore = InternStore(routeTargetsKey, RouteTargetList)
+        self._attributesStore = attributesStore
+        self._routeTargetsStore = routeTargetsStore
 
     @logDecorator.logInfo
     def stop(self):
@@ -123,72 +218,175 @@ class RouteTableManager(Thread, LookingGlass):
     def run(self):
         while True:
             log.debug("RouteTableManager waiting on queue")
-            event = self._queue.get()
-            log.debug("RouteTableManager received event %s", event)
-            try:
-                if event.__class__ == RouteEvent:
-                    self._receiveRouteEvent(event)
-                elif event.__class__ == Subscription:
-                    self._workerSubscribes(event)
-                elif event.__class__ == Unsubscription:
-                    self._workerUnsubscribes(event)
-                elif event.__class__ == WorkerCleanupEvent:
-                    self._workerCleanup(event.worker)
-                elif event == StopEvent:
-                    log.info("StopEvent => breaking main loop")
+            events = [self._queue.get()]
+            while len(events) < MAX_BATCH_SIZE:
+                try:
+                    events.append(self._queue.get_nowait())
+                except Empty:
                     break
-            except Exception as e:
-                log.error("Exception during processing of event: %s", repr(e))
-                log.error("    event was: %s", event)
-                log.error("%s", traceback.format_exc())
+            log.debug("RouteTableManager received %d event(s)", len(events))
+
+            startTime = time.time()
+            shouldStop = self._processBatch(events)
+            duration = time.time() - startTime
+
+            self._batchCount += 1
+            self._batchEventCount += len(events)
+            self._lastBatchSize = len(events)
+            self._lastBatchDuration = duration
+            self._maxBatchDuration = max(self._maxBatchDuration, duration)
 
-            log.debug("RouteTableManager queue size: %d", self._queue.qsize())
+            log.debug("RouteTableManager processed %d event(s) in %.3fs, "
+                      "queue size: %d", len(events), duration,
+                      self._queue.qsize())
+
+            if shouldStop:
+                break
 
         log.info("Out of main loop")
 
+    def _processBatch(self, events):
+        '''
+        Process a batch of events, coalescing consecutive route events.
+        Other events (subscriptions, cleanups...) have an impact on how route
+        events are dispatched and are thus never reordered with route events.
+
+        Returns True if a StopEvent was found.
+        '''
+        routeEvents = []
+        for event in events:
+            if event.__class__ == RouteEvent:
+                routeEvents.append(event)
+                continue
+
+            self._processRouteEvents(routeEvents)
+            routeEvents = []
+
+            if event == StopEvent:
+                log.info("StopEvent => breaking main loop")
+                return True
+
+            self._processEvent(event)
+
+        self._processRouteEvents(routeEvents)
+        return False
+
+    def _processRouteEvents(self, routeEvents):
+        for event in self._coalesceRouteEvents(routeEvents):
+            self._processEvent(event)
+
+    def _coalesceRouteEvents(self, routeEvents):
+        '''
+        Returns the route events to process to obtain the same result as
+        processing all routeEvents in order: for a given (source, nlri), only
+        the last event matters, and a route advertised and then withdrawn
+        needs no processing at all if it was not known before.
+        '''
+        if len(routeEvents) < 2:
+            return routeEvents
+
+        # values are (last event, number of events) tuples
+        lastEvents = OrderedDict()
+        for event in routeEvents:
+            entry = event.routeEntry
+            key = (entry.source, entry.nlri)
+            (_, count) = lastEvents.get(key, (None, 0))
+            lastEvents[key] = (event, count + 1)
+
+        result = []
+        for (key, (event, count)) in lastEvents.iteritems():
+            if (event.type == RouteEvent.WITHDRAW and count > 1 and
+                    key not in self._source_nlri2entry):
+                log.debug("Route advertised and withdrawn in the same batch,"
+                          " skipping: %s", event.routeEntry)
+                continue
+            result.append(event)
+
+        self._coalescedEventCount += len(routeEvents) - len(result)
+        return result
+
+    def _processEvent(self, event):
+        log.debug("RouteTableManager processing event %s", event)
+        try:
+            if event.__class__ == RouteEvent:
+                self._receiveRouteEvent(event)
+            elif event.__class__ == Subscription:
+                self._workerSubscribes(event)
+            elif event.__class__ == Unsubscription:
+                self._workerUnsubscribes(event)
+            elif event.__class__ == WorkerCleanupEvent:
+                self._workerCleanup(event.worker)
+        except Exception as e:
+            log.error("Exception during processing of event: %s", repr(e))
+            log.error("    event was: %s", event)
+            log.error("%s", traceback.format_exc())
+
     def enqueue(self, event):
         self._queue.put(event)
 
-    def _checkMatch2workersAndEntriesCleanup(self, match):
+    def _checkMatch2workersAndEntriesCleanup(self, key):
         try:
-            item = self._match2workersAndEntries[match]
+            item = self._match2workersAndEntries[key]
         except KeyError:
             log.warning("why are we here ?")
             # nothing to cleanup
             return
 
         if len(item.workers) == 0 and len(item.entries) == 0:
-            del self._match2workersAndEntries[match]
+            del self._match2workersAndEntries[key]
 
     def _match2workersAndEntriesLookupCreate(self, match):
         try:
-            return self._match2workersAndEntries[match]
+            wa = self._match2workersAndEntries[match.key]
+            if wa.match is None:
+                wa.match = match
+            return wa
         except KeyError:
-            wa = RouteTableManager.WorkersAndEntries()
-            self._match2workersAndEntries[match] = wa
+            wa = RouteTableManager.WorkersAndEntries(match)
+            self._match2workersAndEntries[match.key] = wa
             return wa
 
-    def _match2entries(self, match, createIfNone=False, emptyListIfNone=True):
-        if createIfNone:
-            return self._match2workersAndEntriesLookupCreate(match).entries
+    def _match2entries(self, key, emptyListIfNone=True):
         try:
-            return self._match2workersAndEntries[match].entries
+            return self._match2workersAndEntries[key].entries
         except KeyError:
             if emptyListIfNone:
                 return []
             else:
                 raise
 
-    def _match2workers(self, match, createIfNone=False, emptyListIfNone=True):
-        if createIfNone:
-            return self._match2workersAndEntriesLookupCreate(match).workers
+    def _workerBit(self, worker):
         try:
-            return self._match2workersAndEntries[match].workers
+            return self._worker2bit[worker]
         except KeyError:
-            if emptyListIfNone:
-                return []
+            if self._freeBits:
+                index = self._freeBits.pop()
             else:
-                raise
+                index = self._nextBit
+                self._nextBit += 1
+            bit = 1 << index
+            self._worker2bit[worker] = bit
+            self._bit2worker[bit] = worker
+            if isinstance(worker, BGPPeerWorker):
+                self._bgpPeersMask |= bit
+            return bit
+
+    def _releaseWorkerBit(self, worker):
+        try:
+            bit = self._worker2bit.pop(worker)
+        except KeyError:
+            return
+        del self._bit2worker[bit]
+        self._bgpPeersMask &= ~bit
+        self._freeBits.append(bit.bit_length() - 1)
+
+    def _workersForMask(self, mask):
+        workers = []
+        while mask:
+            bit = mask & -mask
+            workers.append(self._bit2worker[bit])
+            mask ^= bit
+        return workers
 
     def _source2entriesAddEntry(self, entry):
         try:
@@ -257,14 +455,16 @@ class RouteTableManager(Thread, LookingGlass):
         match = Match(sub.afi, sub.safi, sub.routeTarget)
 
         # update match2worker
-        self._match2workers(match, createIfNone=True).add(worker)
+        wa = self._match2workersAndEntriesLookupCreate(match)
+        wa.workers.add(worker)
+        wa.workersMask |= self._workerBit(worker)
 
         # update worker2matches
         if worker not in self._worker2matches:
             self._worker2matches[worker] = set()
 
         # re-synthesize events
-        for entry in self._match2entries(match):
+        for entry in wa.entries:
             log.debug("Found a entry for this match: %s", entry)
             event = RouteEvent(RouteEvent.ADVERTISE, entry)
             (shouldDispatch, reason) = self._shouldDispatch(event, worker)
@@ -313,10 +513,10 @@ class RouteTableManager(Thread, LookingGlass):
                             " this is a bug)", sub.worker, match)
 
         # synthesize withdraw events
-        for entry in self._match2entries(match, emptyListIfNone=True):
-            intersect = set(
-                self._matchesFor(entry.afi, entry.safi, entry.routeTargets)
-                ).intersection(self._worker2matches[sub.worker])
+        for entry in self._match2entries(match.key, emptyListIfNone=True):
+            entryKeys = self._matchKeysFor(entry)
+            intersect = [m for m in self._worker2matches[sub.worker]
+                         if m.key in entryKeys]
             if len(intersect) > 0:
                 log.debug("Will not synthesize withdraw event for %s, because"
                           " worker subscribed to %s", entry, intersect)
@@ -334,31 +534,38 @@ class RouteTableManager(Thread, LookingGlass):
                         reason, entry)
 
         # update _match2workersAndEntries
-        if match not in self._match2workersAndEntries:
+        if match.key not in self._match2workersAndEntries:
             log.warning("worker %s unsubscribed from %s but we had no such"
                         " subscription yet", sub.worker, match)
         else:
+            wa = self._match2workersAndEntries[match.key]
             try:
-                self._match2workers(match).remove(sub.worker)
+                wa.workers.remove(sub.worker)
+                wa.workersMask &= ~self._worker2bit.get(sub.worker, 0)
             except KeyError:
                 log.warning("worker %s unsubscribed from %s but was not"
                             " subscribed yet", sub.worker, match)
 
-        self._checkMatch2workersAndEntriesCleanup(match)
+            self._checkMatch2workersAndEntriesCleanup(match.key)
 
         # self._dumpState()
 
-    def _matchesFor(self, afi, safi, routeTargets):
-        # generate all possible match entries for this afi/safi
-        # and these routetargets, with all possible wildcards
+    def _matchKeysFor(self, entry):
+        # all possible match keys for the afi/safi and routetargets of this
+        # entry, with all possible wildcards
         #
-        # There are 4*(n+1) possible Match object (for n routeTargets)
-        for _afi in (Subscription.ANY_AFI, afi):
-            for _safi in (Subscription.ANY_SAFI, safi):
-                yield Match(_afi, _safi, None)
-                if routeTargets is not None:
-                    for rt in routeTargets:
-                        yield Match(_afi, _safi, rt)
+        # There are 4*(n+1) possible keys (for n routeTargets), computed once
+        # and cached in the entry
+        if entry.matchKeys is None:
+            keys = []
+            for _afi in (Subscription.ANY_AFI, entry.afi):
+                for _safi in (Subscription.ANY_SAFI, entry.safi):
+                    keys.append(matchKey(_afi, _safi, None))
+                    if entry.routeTargets is not None:
+                        for rt in entry.routeTargets:
+                            keys.append(matchKey(_afi, _safi, rt))
+            entry.matchKeys = frozenset(keys)
+        return entry.matchKeys
 
     def _propagateRouteEvent(self, routeEvent, exceptWorkers=None):
         '''Propagate routeEvent to workers subscribed to the route RTs
@@ -367,35 +574,23 @@ class RouteTableManager(Thread, LookingGlass):
 
         log.debug("Propagate event to interested workers: %s", routeEvent)
 
-        re = routeEvent.routeEntry
-
-        if exceptWorkers is None:
-            exceptWorkers = []
-
-        targetWorkers = set()
-        for match in self._matchesFor(re.afi, re.safi, re.routeTargets):
-            log.debug("Finding interested workers for match %s", match)
+        mask = 0
+        for key in self._matchKeysFor(routeEvent.routeEntry):
+            try:
+                mask |= self._match2workersAndEntries[key].workersMask
+            except KeyError:
+                pass
 
-            interestedWorkers = self._match2workers(match,
-                                                    emptyListIfNone=True)
-            log.debug("   Workers interested in this match: %s",
-                      interestedWorkers)
+        # see _shouldDispatch
+        mask &= ~self._worker2bit.get(routeEvent.source, 0)
+        if isinstance(routeEvent.source, BGPPeerWorker):
+            mask &= ~self._bgpPeersMask
 
-            for worker in interestedWorkers:
-                (shouldDispatch, reason) = self._shouldDispatch(routeEvent,
-                                                                worker)
-                if shouldDispatch:
-                    if worker not in exceptWorkers:
-                        log.debug("Will dispatch event to %s: %s",
-                                  worker, routeEvent)
-                        targetWorkers.add(worker)
-                    else:
-                        log.debug("Decided not to dispatch to %s, based on "
-                                  "exceptWorkers: %s", worker, routeEvent)
-                else:
-                    log.debug("Decided not to dispatch to %s: %s (%s)",
-                              worker, reason, routeEvent)
+        if exceptWorkers:
+            for worker in exceptWorkers:
+                mask &= ~self._worker2bit.get(worker, 0)
 
+        targetWorkers = self._workersForMask(mask)
         for worker in targetWorkers:
             log.info("Dispatching event to %s: %s", worker, routeEvent)
             worker.enqueue(routeEvent)
@@ -429,6 +624,8 @@ class RouteTableManager(Thread, LookingGlass):
                             "previously advertized by the source, ignoring")
                 return
 
+            self._internRouteEntry(entry)
+
             # propagate event to interested worker
             # and include the info on the route are replaced by this
             # route, if any
@@ -452,26 +649,28 @@ class RouteTableManager(Thread, LookingGlass):
 
             # Update match2entries and source2entries for the
             # replacedRoute
-            for match in self._matchesFor(replacedEntry.afi,
-                                          replacedEntry.safi,
-                                          replacedEntry.routeTargets):
+            for key in self._matchKeysFor(replacedEntry):
                 try:
-                    self._match2entries(match).discard(replacedEntry)
+                    self._match2entries(key, emptyListIfNone=False).discard(
+                        replacedEntry)
                 except KeyError:
                     log.error("Trying to remove a route from a match, but"
                               " match %s not found - not supposed to happen"
-                              " (route: %s)", match, replacedEntry)
-                self._checkMatch2workersAndEntriesCleanup(match)
+                              " (route: %s)", key, replacedEntry)
+                self._checkMatch2workersAndEntriesCleanup(key)
 
             self._source2entriesRemoveEntry(replacedEntry)
 
         if routeEvent.type == RouteEvent.ADVERTISE:
             # Update match2entries and source2entries for the newly
             # advertized route
-            for match in self._matchesFor(entry.afi,
-                                          entry.safi,
-                                          entry.routeTargets):
-                self._match2entries(match, createIfNone=True).add(entry)
+            for key in self._matchKeysFor(entry):
+                try:
+                    wa = self._match2workersAndEntries[key]
+                except KeyError:
+                    wa = RouteTableManager.WorkersAndEntries(None)
+                    self._match2workersAndEntries[key] = wa
+                wa.entries.add(entry)
 
             self._source2entriesAddEntry(entry)
 
@@ -487,6 +686,11 @@ class RouteTableManager(Thread, LookingGlass):
 
         #  self._dumpState()
 
+    def _internRouteEntry(self, entry):
+        entry.attributes = self._attributesStore.intern(entry.attributes)
+        entry.routeTargets = self._routeTargetsStore.intern(
+            entry.routeTargets)
+
     def _shouldDispatch(self, routeEvent, targetWorker):
         '''
         returns a (boolean,string) tuple
@@ -523,11 +727,17 @@ class RouteTableManager(Thread, LookingGlass):
 
         # remove worker from all of its subscriptions
         if worker in self._worker2matches:
+            bit = self._worker2bit.get(worker, 0)
             for match in self._worker2matches[worker]:
-                assert(match in self._match2workersAndEntries)
-                self._match2workers(match).remove(worker)
+                assert(match.key in self._match2workersAndEntries)
+                wa = self._match2workersAndEntries[match.key]
+                wa.workers.remove(worker)
+                wa.workersMask &= ~bit
+                self._checkMatch2workersAndEntriesCleanup(match.key)
             del self._worker2matches[worker]
 
+        self._releaseWorkerBit(worker)
+
         # self._dumpState()
 
     def _dumpState(self):
@@ -553,14 +763,15 @@ class RouteTableManager(Thread, LookingGlass):
         match2workerDump = []
         match2entriesDump = []
 
-        matches = list(self._match2workersAndEntries.keys())
-        matches.sort()
-        for match in matches:
-            match2workerDump.append("  %s" % match)
-            match2entriesDump.append("  %s" % match)
-            for worker in self._match2workers(match):
+        keys = list(self._match2workersAndEntries.keys())
+        keys.sort()
+        for key in keys:
+            wa = self._match2workersAndEntries[key]
+            match2workerDump.append("  %s" % (wa.match or repr(key)))
+            match2entriesDump.append("  %s" % (wa.match or repr(key)))
+            for worker in wa.workers:
                 match2workerDump.append("    %s" % worker)
-            for re in self._match2entries(match):
+            for re in wa.entries:
                 match2entriesDump.append("    %s" % re)
 
         dump.append("\n~~~ Match -> Workers ~~~\n%s\n" %
@@ -577,6 +788,25 @@ class RouteTableManager(Thread, LookingGlass):
 
     # Looking Glass #####
 
+    def getLookingGlassLocalInfo(self, pathPrefix):
+        return {
+            "event_batches": {
+                "count": self._batchCount,
+                "events": self._batchEventCount,
+                "coalesced_events": self._coalescedEventCount,
+                "last_size": self._lastBatchSize,
+                "last_duration": self._lastBatchDuration,
+                "max_duration": self._maxBatchDuration
+            },
+            "queue_length": self._queue.qsize(),
+            "queue_flow_control": self._queue.getWatermarks().getStats(),
+            "interned": {
+                "attributes": self._attributesStore.getStats(),
+                "route_targets": self._routeTargetsStore.getStats(),
+                "match_keys": _matchKeys.getStats()
+            }
+        }
+
     def getLGMap(self):
         return {"workers": (LGMap.COLLECTION,
                 (self.getLGWorkerList, self.getLGWorkerFromPathItem)),
@@ -592,8 +822,8 @@ class RouteTableManager(Thread, LookingGlass):
         match_RTC = Match(AFI(AFI.ipv4), SAFI(SAFI.rtc), Subscription.ANY_RT)
         for match in [match_IPVPN, match_EVPN, match_RTC]:
             matchResult = []
-            if match in self._match2workersAndEntries:
-                for entry in self._match2entries(match):
+            if match.key in self._match2workersAndEntries:
+                for entry in self._match2entries(match.key):
                     matchResult.append(
                         entry.getLookingGlassInfo(pathPrefix))
             result[repr(match)] = matchResult
@@ -611,10 +841,10 @@ class RouteTableManager(Thread, LookingGlass):
     def getAllRoutesButRTC(self):
         try:
             return [re for re in
-                    self._match2workersAndEntries[Match(Subscription.ANY_AFI,
-                                                        Subscription.ANY_SAFI,
-                                                        Subscription.ANY_RT)
-                                                  ].entries
+                    self._match2workersAndEntries[
+                        matchKey(Subscription.ANY_AFI,
+                                 Subscription.ANY_SAFI,
+                                 Subscription.ANY_RT)].entries
                     if not (re.afi == AFI(AFI.ipv4) and
                             re.safi == SAFI(SAFI.rtc))
                     ]
@@ -634,3 +864,105 @@ class RouteTableManager(Thread, LookingGlass):
             count + isinstance(entry.source, BGPPeerWorker),
             self.getAllRoutesButRTC(),
             0)
+
+
+class ShardedRouteTableManager(LookingGlass):
+
+    """
+    Splits the work of the route table manager between a number of
+    RouteTableManager threads (shards), each with its own event queue.
+
+    Route events are dispatched to a shard based on a hash of their
+    (source, nlri): all the events for a given route are then processed in
+    order by the same shard, which can thus track replaced routes.
+
+    Subscriptions, unsubscriptions and worker cleanups are sent to all the
+    shards, so that each shard dispatches the routes it holds to all
+    interested workers (including workers subscribed with wildcards).
+
+    The interface is the same as the one of RouteTableManager.
+    """
+
+    def __init__(self, shardCount):
+        assert(shardCount > 0)
+        # shards share the stores of interned attributes and Route Targets
+        attributesStore = InternStore(attributesKey)
+        routeTargetsStore = InternStore(routeTargetsKey, RouteTargetList)
+        self.shards = [RouteTableManager(name="RouteTableManager-%d" % i,
+                                         attributesStore=attributesStore,
+                                         routeTargetsStore=routeTargetsStore)
+                       for i in range(shardCount)]
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    @logDecorator.logInfo
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+    def join(self):
+        for shard in self.shards:
+            shard.join()
+
+    def _shardFor(self, routeEvent):
+        entry = routeEvent.routeEntry
+        return self.shards[hash((entry.source, entry.nlri)) %
+                           len(self.shards)]
+
+    def enqueue(self, event):
+        if event.__class__ == RouteEvent:
+            self._shardFor(event).enqueue(event)
+        else:
+            for shard in self.shards:
+                shard.enqueue(event)
+
+    def getWorkerSubscriptions(self, worker):
+        # all shards have the same subscriptions
+        return self.shards[0].getWorkerSubscriptions(worker)
+
+    def getWorkerRouteEntries(self, worker):
+        entries = []
+        for shard in self.shards:
+            entries.extend(shard.getWorkerRouteEntries(worker))
+        return entries
+
+    def getAllRoutesButRTC(self):
+        routes = []
+        for shard in self.shards:
+            routes.extend(shard.getAllRoutesButRTC())
+        return routes
+
+    def getLocalRoutesCount(self):
+        return sum(shard.getLocalRoutesCount() for shard in self.shards)
+
+    def _dumpState(self):
+        for shard in self.shards:
+            shard._dumpState()
+
+    def getReceivedRoutesCount(self):
+        return sum(shard.getReceivedRoutesCount() for shard in self.shards)
+
+    # Looking Glass #####
+
+    def getLGMap(self):
+        return {"workers": (LGMap.COLLECTION,
+                (self.shards[0].getLGWorkerList,
+                 self.shards[0].getLGWorkerFromPathItem)),
+                "routes": (LGMap.SUBTREE, self.getLGRoutes),
+                "shards": (LGMap.COLLECTION,
+                (self.getLGShardList, self.getLGShardFromPathItem))}
+
+    def getLGRoutes(self, pathPrefix):
+        result = {}
+        for shard in self.shards:
+            for (match, routes) in shard.getLGRoutes(pathPrefix).iteritems():
+                result.setdefault(match, []).extend(routes)
+        return result
+
+    def getLGShardList(self):
+        return [{"id": str(index)} for index in range(len(self.shards))]
+
+    def getLGShardFromPathItem(self, pathItem):
+        return self.shards[int(pathItem)]
@@ -25,6 +25,18 @@ import logging
 
 import socket
 
+import time
+
+from Queue import Empty
+
+from collections import Counter, OrderedDict, defaultdict
+
+from bisect import bisect_left, bisect_right
+
+from itertools import count
+
+from functools import cmp_to_key
+
 from bagpipe.bgp.engine.worker import Worker
 from bagpipe.bgp.engine import RouteEvent, RouteEntry
 
@@ -45,6 +57,8 @@ keepAttributes_default = [AttributeID.NEXT_HOP,
 
 class FilteredRouteEntry(RouteEntry):
 
+    __slots__ = ()
+
     def __init__(self, re, keepAttributes=None):
         if keepAttributes is None:
             keepAttributes = keepAttributes_default
@@ -58,8 +72,16 @@ class FilteredRouteEntry(RouteEntry):
             self, re.afi, re.safi, re.routeTargets, re.nlri, attributes, None)
 
 
+def filteredRouteEntry(route):
+    '''returns the FilteredRouteEntry for route, with the default attributes
+    to keep, computed once for a given route'''
+    if route.filtered is None:
+        route.filtered = FilteredRouteEntry(route)
+    return route.filtered
+
+
 def filteredRoutes(routes):
-    return [FilteredRouteEntry(route) for route in routes]
+    return [filteredRouteEntry(route) for route in routes]
 
 
 # def _compareRoutes(self, routeA, routeB):
@@ -69,11 +91,42 @@ def filteredRoutes(routes):
 #          - an int<0 if routeB is better than routeA
 #          - else 0
 #         """
+#
+# A comparison function can also provide a sort key factory (see
+# withSortKey), in which case the TrackerWorker selects routes based on
+# their sort keys, computed once per route, instead of comparing routes
+# pairwise.
 
 # TODO: both comparison should first compare local_pref and MAC Mobility
 # if present
 
 
+def withSortKey(sortKeyFactory):
+    '''
+    Decorator for a route comparison function: sortKeyFactory(worker) must
+    return a function giving the sort key of a route for this worker, such
+    that comparing the sort keys of two routes is the same as comparing the
+    routes with the comparison function (a better route has a greater key).
+    '''
+    def decorator(compareRoutes):
+        compareRoutes.sortKeyFactory = sortKeyFactory
+        return compareRoutes
+    return decorator
+
+
+def _noECMPSortKeyFactory(worker):
+    salt = socket.gethostname() + worker.name
+
+    def sortKey(route):
+        # the string is part of the key so that two distinct routes never
+        # have the same key
+        string = "%s %s %s" % (route.nlri, route.attributes.fingerprint(),
+                               route.source)
+        return (hash(salt + string), string)
+    return sortKey
+
+
+@withSortKey(_noECMPSortKeyFactory)
 def compareNoECMP(self, routeA, routeB):
     '''
     This compares the two routes in a consistent fashion, but two routes
@@ -83,37 +136,235 @@ def compareNoECMP(self, routeA, routeB):
     best one.
     '''
     self.log.debug("compareNoECMP used")
-    salt = socket.gethostname() + self.name
-    return cmp([hash(salt + repr(routeA)), routeA],
-               [hash(salt + repr(routeB)), routeB])
+    sortKey = _noECMPSortKeyFactory(self)
+    return cmp(sortKey(routeA), sortKey(routeB))
+
+
+def _ECMPSortKeyFactory(worker):
+    return lambda route: 0
 
 
+@withSortKey(_ECMPSortKeyFactory)
 def compareECMP(self, routeA, routeB):
     self.log.debug("compareECMP used")
     return 0
 
 
+class TrackedRoutes(object):
+
+    """The routes received for a tracked entry.
+
+    Routes are indexed with a dict (a route entry is hashed based on its
+    source, nlri and attributes) giving their sort key, computed once, and
+    are kept sorted on this key, so that adding or removing a route and
+    finding the best routes does not require looking at all the routes.
+
+    Routes with equal sort keys (e.g. with ECMP) are told apart by the
+    order in which they were added, so that a route is found with a
+    bisection, and the number of routes tied with the best one is
+    maintained.
+    """
+
+    def __init__(self, sortKey):
+        self._sortKey = sortKey
+        self._sequence = count()
+        # dict: route -> (sort key, sequence number)
+        self._routes = dict()
+        # (sort key, sequence number) of all routes, in increasing order, the
+        # best routes last, and the routes in the same order:
+        self._sortedKeys = []
+        self._sortedRoutes = []
+        # number of routes with the best sort key, at the end of the lists
+        self._bestCount = 0
+
+    def sortKey(self, route):
+        try:
+            return self._routes[route][0]
+        except KeyError:
+            return self._sortKey(route)
+
+    def add(self, route):
+        if route in self._routes:
+            self.remove(route)
+        key = (self._sortKey(route), next(self._sequence))
+        self._routes[route] = key
+        if not self._sortedKeys or key[0] > self._sortedKeys[-1][0]:
+            self._bestCount = 1
+        elif key[0] == self._sortedKeys[-1][0]:
+            self._bestCount += 1
+        index = bisect_right(self._sortedKeys, key)
+        self._sortedKeys.insert(index, key)
+        self._sortedRoutes.insert(index, route)
+
+    def remove(self, route):
+        '''removes the route equal to route and returns it, raises ValueError
+        if there is no such route'''
+        try:
+            key = self._routes.pop(route)
+        except KeyError:
+            raise ValueError("no such route: %s" % (route,))
+        index = bisect_left(self._sortedKeys, key)
+        if key[0] == self._sortedKeys[-1][0]:
+            self._bestCount -= 1
+        del self._sortedKeys[index]
+        removed = self._sortedRoutes.pop(index)
+        if not self._bestCount and self._sortedKeys:
+            # the best routes are now those with the next best sort key,
+            # (sortKey,) being lower than any (sortKey, sequence number)
+            self._bestCount = len(self._sortedKeys) - bisect_left(
+                self._sortedKeys, (self._sortedKeys[-1][0],))
+        return removed
+
+    def bestRoutes(self):
+        if not self._bestCount:
+            return []
+        return self._sortedRoutes[-self._bestCount:]
+
+    def __iter__(self):
+        # best routes first
+        return reversed(self._sortedRoutes)
+
+    def __len__(self):
+        return len(self._sortedRoutes)
+
+
+class BestRoutes(set):
+
+    """The set of the best routes for a tracked entry, which also tracks the
+    filtered views of these routes (see FilteredRouteEntry), to tell in
+    constant time if an equal route (in the sense of FilteredRouteEntry) is
+    among the best routes.
+    """
+
+    def __init__(self, routes=()):
+        set.__init__(self)
+        # Counter: filtered route -> number of best routes with this
+        # filtered route
+        self._filteredCount = Counter()
+        self.update(routes)
+
+    def add(self, route):
+        if route not in self:
+            set.add(self, route)
+            self._filteredCount[filteredRouteEntry(route)] += 1
+
+    def remove(self, route):
+        set.remove(self, route)
+        filtered = filteredRouteEntry(route)
+        self._filteredCount[filtered] -= 1
+        if not self._filteredCount[filtered]:
+            del self._filteredCount[filtered]
+
+    def discard(self, route):
+        if route in self:
+            self.remove(route)
+
+    def update(self, routes):
+        for route in routes:
+            self.add(route)
+
+    def clear(self):
+        set.clear(self)
+        self._filteredCount.clear()
+
+    def copy(self):
+        return set(self)
+
+    def hasFilteredRoute(self, filteredRoute):
+        return filteredRoute in self._filteredCount
+
+
+def nextHopOf(route):
+    '''returns the IP address of the next hop of a route, or None if the route
+    has no NEXT_HOP attribute'''
+    try:
+        return route.attributes[AttributeID.NEXT_HOP].next_hop.ip
+    except KeyError:
+        return None
+
+
+class NextHopDownEvent(object):
+
+    """Tells a TrackerWorker that a next hop is not reachable anymore, and
+    that all the routes using it should be dropped"""
+
+    __slots__ = ('nextHop',)
+
+    def __init__(self, nextHop):
+        self.nextHop = nextHop
+
+    def __repr__(self):
+        return "[NextHopDownEvent: %s]" % self.nextHop
+
+
 class TrackerWorker(Worker, LookingGlassLocalLogger):
     __metaclass__ = ABCMeta
 
-    def __init__(self, bgpManager, workerName, compareRoutes=compareNoECMP):
+    def __init__(self, bgpManager, workerName, compareRoutes=compareNoECMP,
+                 coalescingWindow=0):
         Worker.__init__(self, bgpManager, workerName)
         LookingGlassLocalLogger.__init__(self)
 
-        # dict: entry -> list of routes:
+        # dict: entry -> TrackedRoutes:
         self.trackedEntry2routes = dict()
-        # dict: entry -> set of bestRoutes:
+        # dict: entry -> BestRoutes:
         self.trackedEntry2bestRoutes = dict()
+        # dict: next hop IP -> dict: route -> entry, for all the routes in
+        # trackedEntry2routes
+        self._nextHop2routes = dict()
+        # dict: next hop IP -> set of the routes dropped when a
+        # NextHopDownEvent was received for this next hop, until their
+        # withdraw (or replacement) is received
+        self._downNextHops = dict()
 
         self._compareRoutes = compareRoutes
+        # the sort key of a route: a better route has a greater key
+        try:
+            self._routeSortKey = compareRoutes.sortKeyFactory(self)
+        except AttributeError:
+            self._routeSortKey = cmp_to_key(
+                lambda routeA, routeB: self._compareRoutes(self, routeA,
+                                                           routeB))
+
+        # if coalescingWindow is not zero, the calls to _newBestRoute and
+        # _bestRouteRemoved are delayed by up to coalescingWindow seconds, and
+        # only the net effect of the calls for a given entry is applied (see
+        # _flushPendingCalls)
+        self._coalescingWindow = coalescingWindow
+        # dict: entry -> OrderedDict: filtered route -> net number of calls
+        # (newBestRoute counting for +1, bestRouteRemoved for -1)
+        self._pendingCalls = OrderedDict()
+        self._pendingCallCount = 0
+        self._coalescingDeadline = None
+        self._coalescingFlushCount = 0
+        self._coalescedCallCount = 0
+        # True while the calls are deferred regardless of coalescingWindow,
+        # see _nextHopDown
+        self._deferringCalls = False
 
     def getBestRoutesForTrackedEntry(self, entry):
         return self.trackedEntry2bestRoutes.get(entry, set())
 
+    def nextHopDown(self, nextHop):
+        '''
+        Drops all the routes having nextHop (an IP address) as next hop, as if
+        they had been withdrawn. Can be called from any thread.
+        '''
+        self.enqueue(NextHopDownEvent(nextHop))
+
+    def _laneFor(self, event):
+        if isinstance(event, NextHopDownEvent):
+            return Worker.CONTROL_LANE
+        return Worker.ROUTES_LANE
+
     @logDecorator.log
     def _onEvent(self, routeEvent):
+        if isinstance(routeEvent, NextHopDownEvent):
+            self._nextHopDown(routeEvent.nextHop)
+            return
+
         newRoute = routeEvent.routeEntry
-        filteredNewRoute = FilteredRouteEntry(newRoute)
+        filteredNewRoute = filteredRouteEntry(newRoute)
 
         entry = self._route2trackedEntry(newRoute)
 
@@ -125,8 +376,11 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
         try:
             allRoutes = self.trackedEntry2routes[entry]
         except KeyError:
+            if routeEvent.type == RouteEvent.WITHDRAW:
+                self._withdrawNoRoute(newRoute)
+                return
             self.log.debug("Initiating trackedEntry2routes[entry]")
-            allRoutes = []
+            allRoutes = TrackedRoutes(self._routeSortKey)
             self.trackedEntry2routes[entry] = allRoutes
 
         self.log.debug("We currently have %d route%s for this entry",
@@ -144,11 +398,17 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
                                    " and bestRoutes: %s",
                                    routeEvent.replacedRoute)
                     try:
-                        allRoutes.remove(routeEvent.replacedRoute)
+                        self._removeRoute(allRoutes,
+                                          routeEvent.replacedRoute)
                     except ValueError:
-                        # we did not have any route for this entry
-                        self.log.error("replacedRoute is an entry for which "
-                                       "we had no route ??? (bug ?)")
+                        if self._forgetDroppedRoute(routeEvent.replacedRoute):
+                            self.log.debug("replacedRoute was already dropped"
+                                           " because its next hop is down")
+                        else:
+                            # we did not have any route for this entry
+                            self.log.error("replacedRoute is an entry for "
+                                           "which we had no route ??? "
+                                           "(bug ?)")
 
                     if routeEvent.replacedRoute in bestRoutes:
                         self.log.debug(
@@ -187,8 +447,9 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
 
                 # let's find if we need to update our best routes
                 if currentBestRoute:
-                    routeComparison = self._compareRoutes(self, newRoute,
-                                                          currentBestRoute)
+                    routeComparison = cmp(
+                        allRoutes.sortKey(newRoute),
+                        allRoutes.sortKey(currentBestRoute))
                 else:
                     routeComparison = 1
 
@@ -219,8 +480,8 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
                     # TODO: explain more on theses BGP attributes
                     #       related to the cases where a route is re-advertized
                     #       with updated attributes
-                    isReallyNew = (FilteredRouteEntry(newRoute) not in
-                                   filteredRoutes(bestRoutes))
+                    isReallyNew = not bestRoutes.hasFilteredRoute(
+                        filteredNewRoute)
 
                     bestRoutes.add(newRoute)
 
@@ -241,19 +502,18 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
 
             except (KeyError, StopIteration) as e:
                 self.log.debug("We had no route for this entry (%s)", e)
-                self.trackedEntry2bestRoutes[entry] = set([newRoute])
-                bestRoutes = set()
+                self.trackedEntry2bestRoutes[entry] = BestRoutes([newRoute])
+                bestRoutes = BestRoutes()
                 self.log.debug("Calling newBestRoute")
                 self._callNewBestRoute(entry, filteredNewRoute)
 
             # We need to call self._bestRouteRemoved for routes that where
             # implicitly withdrawn, but only if they don't have an equal route
             # (in the sense of FilteredRouteEntry) in bestRoutes
-            filteredBestRoutes = filteredRoutes(bestRoutes)
             self.log.debug("Considering implicitly withdrawn best routes")
             for r in withdrawnBestRoutes:
-                filteredR = FilteredRouteEntry(r)
-                if filteredR not in filteredBestRoutes:
+                filteredR = filteredRouteEntry(r)
+                if not bestRoutes.hasFilteredRoute(filteredR):
                     self.log.debug("   calling self._bestRouteRemoved for "
                                    "route: %s (not last)", filteredR)
                     self._callBestRouteRemoved(entry, filteredR, last=False)
@@ -263,7 +523,7 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
 
             # add the route to the list of routes for this entry
             self.log.debug("Adding route to allRoutes for this entry")
-            allRoutes.append(newRoute)
+            self._addRoute(entry, allRoutes, newRoute)
 
         else:  # RouteEvent.WITHDRAW
 
@@ -272,11 +532,10 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
             self.log.debug("Removing route from allRoutes for this entry")
 
             try:
-                allRoutes.remove(withdrawnRoute)
+                withdrawnRoute = self._removeRoute(allRoutes, withdrawnRoute)
             except ValueError:
-                # we did not have any route for this entry
-                self.log.error("Withdraw received for an entry for which we"
-                               " had no route ??? (not supposed to happen)")
+                self._withdrawNoRoute(withdrawnRoute)
+                return
 
             try:
                 bestRoutes = self.trackedEntry2bestRoutes[entry]
@@ -308,9 +567,9 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
                     # We need to call self._bestRouteRemoved, but only if the
                     # withdrawn route does not have an equal route in
                     # bestRoutes (in the sense of FilteredRouteEntry)
-                    filteredWithdrawnRoute = FilteredRouteEntry(withdrawnRoute)
-                    if (filteredWithdrawnRoute not
-                            in filteredRoutes(bestRoutes)):
+                    filteredWithdrawnRoute = filteredRouteEntry(withdrawnRoute)
+                    if not bestRoutes.hasFilteredRoute(
+                            filteredWithdrawnRoute):
                         self.log.debug("Calling bestRouteRemoved: %s(last:%s)",
                                        filteredWithdrawnRoute,
                                        withdrawnRouteIsLast)
@@ -339,45 +598,143 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
 
         self._dumpState()
 
+    def _addRoute(self, entry, allRoutes, route):
+        allRoutes.add(route)
+        nextHop = nextHopOf(route)
+        if nextHop is not None:
+            self._nextHop2routes.setdefault(nextHop, dict())[route] = entry
+            # the route is known again, no withdraw of it is expected anymore
+            self._forgetDroppedRoute(route)
+
+    def _removeRoute(self, allRoutes, route):
+        '''removes route from allRoutes and returns the route removed, raises
+        ValueError if there is no such route'''
+        route = allRoutes.remove(route)
+        nextHop = nextHopOf(route)
+        routes = self._nextHop2routes.get(nextHop)
+        if routes is not None:
+            routes.pop(route, None)
+            if not routes:
+                del self._nextHop2routes[nextHop]
+        return route
+
+    def _withdrawNoRoute(self, route):
+        if self._forgetDroppedRoute(route):
+            self.log.debug("Withdraw received for a route already dropped "
+                           "because its next hop is down")
+        else:
+            # we did not have any route for this entry
+            self.log.error("Withdraw received for an entry for which we"
+                           " had no route ??? (not supposed to happen)")
+
+    def _forgetDroppedRoute(self, route):
+        '''returns True if route had been dropped because its next hop was
+        down, and forgets about it'''
+        nextHop = nextHopOf(route)
+        droppedRoutes = self._downNextHops.get(nextHop)
+        if droppedRoutes is None or route not in droppedRoutes:
+            return False
+        droppedRoutes.remove(route)
+        if not droppedRoutes:
+            del self._downNextHops[nextHop]
+        return True
+
+    def _nextHopDown(self, nextHop):
+        route2entry = self._nextHop2routes.pop(nextHop, None)
+        if not route2entry:
+            self.log.info("Next hop %s down, no route to drop", nextHop)
+            return
+
+        self._downNextHops.setdefault(nextHop, set()).update(route2entry)
+
+        entry2routes = defaultdict(list)
+        for (route, entry) in route2entry.iteritems():
+            entry2routes[entry].append(route)
+
+        self.log.info("Next hop %s down, dropping %d route(s) for %d "
+                      "entries", nextHop, len(route2entry), len(entry2routes))
+
+        # the resulting calls to _newBestRoute and _bestRouteRemoved are done
+        # together once all routes have been dropped
+        self._deferringCalls = True
+        try:
+            for (entry, routes) in entry2routes.iteritems():
+                self._dropRoutes(entry, routes)
+        finally:
+            self._deferringCalls = False
+        if not self._coalescingWindow:
+            self._flushPendingCalls()
+
+        self._dumpState()
+
+    def _dropRoutes(self, entry, routes):
+        '''
+        Removes routes from the routes for entry, and recomputes the best
+        routes for entry only once (routes must already have been removed
+        from _nextHop2routes)
+        '''
+        allRoutes = self.trackedEntry2routes[entry]
+        bestRoutes = self.trackedEntry2bestRoutes[entry]
+
+        withdrawnBestRoutes = []
+        for route in routes:
+            allRoutes.remove(route)
+            if route in bestRoutes:
+                bestRoutes.remove(route)
+                withdrawnBestRoutes.append(route)
+
+        if not withdrawnBestRoutes:
+            return
+
+        last = False
+        if len(bestRoutes) == 0:
+            self._recomputeBestRoutes(allRoutes, bestRoutes)
+            if len(bestRoutes) > 0:
+                self._callNewBestRouteForRoutes(entry, bestRoutes)
+            else:
+                self.log.debug("Cleanup allRoutes and bestRoutes")
+                del self.trackedEntry2bestRoutes[entry]
+                del self.trackedEntry2routes[entry]
+                last = True
+
+        filteredWithdrawnRoutes = [
+            route for route in set(filteredRoutes(withdrawnBestRoutes))
+            if not bestRoutes.hasFilteredRoute(route)]
+        for (index, route) in enumerate(filteredWithdrawnRoutes):
+            self._callBestRouteRemoved(
+                entry, route,
+                last and index == len(filteredWithdrawnRoutes) - 1)
+
     def _recomputeBestRoutes(self, allRoutes, bestRoutes):
         '''update bestRoutes to contain the best routes from allRoutes, based
         on _compareRoutes'''
 
-        newBestRoutes = []
-        for route in allRoutes:
-            if len(newBestRoutes) == 0:
-                # self.log.debug("first route, thus our current best:
-                # %s",route)
-                newBestRoutes = [route]
-                continue
-
-            comparison = self._compareRoutes(self, route, newBestRoutes[0])
-            # self.log.debug("Route comparison: %s vs %s == %d",(route,
-            # newBestRoutes[0],comparison) )
-            if comparison > 0:
-                # self.log.debug("better, replaces our current best: %s",route)
-                newBestRoutes = [route]
-            elif comparison == 0:
-                # self.log.debug("as good as our current best: %s",route)
-                newBestRoutes.append(route)
-            else:
-                # self.log.debug("no better than our current best: %s",route)
-                pass
-
         bestRoutes.clear()
-        bestRoutes.update(newBestRoutes)
+        bestRoutes.update(allRoutes.bestRoutes())
 
         self.log.debug("Recomputed new best routes: %s", bestRoutes)
 
     def _callNewBestRouteForRoutes(self, entry, routes):
         self.log.debug("Calling newBestRoute for routes, without dups")
         self.log.debug("   Routes: %s", routes)
-        routesNoDups = set([FilteredRouteEntry(r) for r in routes])
+        routesNoDups = set(filteredRoutes(routes))
         self.log.debug("   After filtering duplicates: %s", routesNoDups)
         for route in routesNoDups:
             self._callNewBestRoute(entry, route)
 
     def _callNewBestRoute(self, entry, newRoute):
+        if self._coalescingWindow or self._deferringCalls:
+            self._deferCall(entry, newRoute, 1)
+        else:
+            self._doCallNewBestRoute(entry, newRoute)
+
+    def _callBestRouteRemoved(self, entry, oldRoute, last):
+        if self._coalescingWindow or self._deferringCalls:
+            self._deferCall(entry, oldRoute, -1)
+        else:
+            self._doCallBestRouteRemoved(entry, oldRoute, last)
+
+    def _doCallNewBestRoute(self, entry, newRoute):
         try:
             self._newBestRoute(entry, newRoute)
         except Exception as e:
@@ -385,7 +742,7 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
             if self.log.isEnabledFor(logging.WARNING):
                 self.log.info("%s", traceback.format_exc())
 
-    def _callBestRouteRemoved(self, entry, oldRoute, last):
+    def _doCallBestRouteRemoved(self, entry, oldRoute, last):
         try:
             self._bestRouteRemoved(entry, oldRoute, last)
         except Exception as e:
@@ -393,6 +750,84 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
             if self.log.isEnabledFor(logging.WARNING):
                 self.log.info("%s", traceback.format_exc())
 
+    # Coalescing of callbacks ########################
+
+    def _deferCall(self, entry, route, count):
+        if not self._pendingCallCount:
+            self._coalescingDeadline = time.time() + self._coalescingWindow
+        calls = self._pendingCalls.setdefault(entry, OrderedDict())
+        net = calls.pop(route, 0) + count
+        if net:
+            calls[route] = net
+        elif not calls:
+            del self._pendingCalls[entry]
+        self._pendingCallCount += 1
+
+    def _flushPendingCalls(self):
+        '''
+        Calls _newBestRoute and _bestRouteRemoved to apply the net effect of
+        the calls deferred for each entry: a route that was added and then
+        removed, or removed and then added again, results in no call at all.
+        '''
+        pendingCalls = self._pendingCalls
+        pendingCallCount = self._pendingCallCount
+        self._pendingCalls = OrderedDict()
+        self._pendingCallCount = 0
+        self._coalescingDeadline = None
+
+        callCount = 0
+        for (entry, calls) in pendingCalls.iteritems():
+            removedRoutes = []
+            for (route, net) in calls.iteritems():
+                if net > 0:
+                    self._doCallNewBestRoute(entry, route)
+                    callCount += 1
+                else:
+                    removedRoutes.append(route)
+            # as when calls are not coalesced, new best routes are added
+            # before old ones are removed, and only the removal of the last
+            # route for an entry is flagged as such
+            last = entry not in self.trackedEntry2bestRoutes
+            for (index, route) in enumerate(removedRoutes):
+                self._doCallBestRouteRemoved(
+                    entry, route, last and index == len(removedRoutes) - 1)
+                callCount += 1
+
+        self._coalescingFlushCount += 1
+        self._coalescedCallCount += pendingCallCount - callCount
+        self.log.debug("Coalescing: %d call(s) done for %d entries, %d call(s)"
+                       " saved", callCount, len(pendingCalls),
+                       pendingCallCount - callCount)
+
+    def _dequeue(self):
+        # if calls are pending, wait for an event only until the end of the
+        # coalescing window
+        while self._pendingCallCount:
+            timeout = self._coalescingDeadline - time.time()
+            if timeout > 0:
+                try:
+                    event = self._queue.get(timeout=timeout)
+                except Empty:
+                    continue
+                if event is Worker.stopEvent:
+                    self._flushPendingCalls()
+                return event
+            self._flushPendingCalls()
+        return Worker._dequeue(self)
+
+    def _processEvents(self, maxEvents, maxDuration):
+        (running, eventCount) = Worker._processEvents(self, maxEvents,
+                                                      maxDuration)
+        if self._pendingCallCount and (
+                not running or time.time() >= self._coalescingDeadline):
+            self._flushPendingCalls()
+        return (running, eventCount)
+
+    def _wakeupTime(self):
+        if self._pendingCallCount:
+            return self._coalescingDeadline
+        return None
+
     # Callbacks for subclasses ########################
 
     @abstractmethod
@@ -452,7 +887,14 @@ class TrackerWorker(Worker, LookingGlassLocalLogger):
 
     def getLGMap(self):
         return {"received_routes": (LGMap.SUBTREE, self.getLGAllRoutes),
-                "best_routes": (LGMap.SUBTREE, self.getLGBestRoutes)}
+                "best_routes": (LGMap.SUBTREE, self.getLGBestRoutes),
+                "coalescing": (LGMap.SUBITEM, self.getLGCoalescing)}
+
+    def getLGCoalescing(self):
+        return {"window": self._coalescingWindow,
+                "pending_calls": self._pendingCallCount,
+                "flushes": self._coalescingFlushCount,
+                "saved_calls": self._coalescedCallCount}
 
     def getLGAllRoutes(self, pathPrefix):
         return self._getLGRoutes(pathPrefix, self.trackedEntry2routes)
@@ -20,9 +20,13 @@ import logging
 
 import traceback
 
-from Queue import Queue
+import time
 
-from threading import Event
+from collections import deque
+
+from Queue import Empty
+
+from threading import Event, Condition, Lock
 
 from bagpipe.bgp.engine import RouteEntry, RouteEvent, \
     Subscription, Unsubscription
@@ -31,6 +35,95 @@ from bagpipe.bgp.common.looking_glass import LookingGlass, LGMap
 log = logging.getLogger(__name__)
 
 
+class LanesQueue(object):
+
+    """A thread-safe queue made of multiple FIFO lanes, with strict
+    priority between lanes: an item is dequeued from a lane only when all
+    the lanes of higher priority (lower index) are empty.
+
+    The interface is a subset of the interface of Queue.Queue, with an
+    additional lane argument for put().
+    """
+
+    def __init__(self, laneCount, defaultLane):
+        assert(0 <= defaultLane < laneCount)
+        self._lanes = [deque() for _ in range(laneCount)]
+        self._defaultLane = defaultLane
+        self._size = 0
+        self._notEmpty = Condition(Lock())
+        # see setWatermarks
+        self._watermarks = None
+
+    def setWatermarks(self, watermarks):
+        '''
+        Has watermarks.update(length) called each time the length of the
+        queue changes (see flow_control.QueueWatermarks), None to stop
+        '''
+        with self._notEmpty:
+            if self._watermarks is not None:
+                self._watermarks.release()
+            self._watermarks = watermarks
+            if watermarks is not None:
+                watermarks.update(self._size)
+
+    def getWatermarks(self):
+        return self._watermarks
+
+    def put(self, item, lane=None):
+        if lane is None:
+            lane = self._defaultLane
+        with self._notEmpty:
+            self._lanes[lane].append(item)
+            self._size += 1
+            if self._watermarks is not None:
+                self._watermarks.update(self._size)
+            self._notEmpty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self._notEmpty:
+            if not block:
+                if not self._size:
+                    raise Empty
+            elif timeout is None:
+                while not self._size:
+                    self._notEmpty.wait()
+            else:
+                endTime = time.time() + timeout
+                while not self._size:
+                    remaining = endTime - time.time()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self._notEmpty.wait(remaining)
+            for lane in self._lanes:
+                if lane:
+                    self._size -= 1
+                    if self._watermarks is not None:
+                        self._watermarks.update(self._size)
+                    return lane.popleft()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return not self._size
+
+    def laneSizes(self):
+        return [len(lane) for lane in self._lanes]
+
+    def purge(self, lane):
+        '''removes all the items of a lane, and returns their number'''
+        with self._notEmpty:
+            count = len(self._lanes[lane])
+            self._lanes[lane].clear()
+            self._size -= count
+            if self._watermarks is not None:
+                self._watermarks.update(self._size)
+            return count
+
+
 class Worker(LookingGlass):
 
     """This is the base class for objects that interact with the route table
@@ -45,10 +138,19 @@ class Worker(LookingGlass):
 
     stopEvent = object()
 
+    # lanes of the event queue, by decreasing priority
+    CONTROL_LANE = 0
+    ROUTES_LANE = 1
+    laneNames = {CONTROL_LANE: "control",
+                 ROUTES_LANE: "routes"}
+
     def __init__(self, bgpManager, workerName):
         self.bgpManager = bgpManager
-        self._queue = Queue()
+        self._queue = LanesQueue(len(Worker.laneNames), Worker.ROUTES_LANE)
         self._pleaseStop = Event()
+        # set if the events of this worker are processed by a WorkerScheduler
+        # rather than by a thread of its own, see WorkerScheduler.schedule
+        self._scheduler = None
 
         log.debug("Setting worker name to %s", workerName)
         self.name = workerName
@@ -65,7 +167,12 @@ class Worker(LookingGlass):
         Then call _stopped() to let a subclass implement any further work.
         """
         self._pleaseStop.set()
-        self._queue.put(Worker.stopEvent)
+        self._queue.put(Worker.stopEvent, Worker.CONTROL_LANE)
+        # the events left in the queue will not be processed, they must not
+        # be considered for flow control
+        self._queue.setWatermarks(None)
+        if self._scheduler is not None:
+            self._scheduler.wakeup(self)
         self.bgpManager.cleanup(self)
         self._stopped()
 
@@ -88,12 +195,53 @@ class Worker(LookingGlass):
                 self._pleaseStop.set()
                 break
 
-            # log.debug("%s worker calling _onEvent for %s",self.name,event)
+            self._handleEvent(event)
+
+    def _handleEvent(self, event):
+        # log.debug("%s worker calling _onEvent for %s",self.name,event)
+        try:
+            self._onEvent(event)
+        except Exception as e:
+            log.error("Exception raised on subclass._onEvent: %s", e)
+            log.error("%s", traceback.format_exc())
+
+    def _processEvents(self, maxEvents, maxDuration):
+        """
+        Processes, without blocking, the pending events, but no more than
+        maxEvents events and for no longer than about maxDuration seconds:
+        this is how a WorkerScheduler runs the worker instead of
+        _eventQueueProcessorLoop.
+
+        Returns a (running, eventCount) tuple, running being False if the
+        worker was stopped.
+        """
+        endTime = time.time() + maxDuration
+        eventCount = 0
+        while eventCount < maxEvents:
             try:
-                self._onEvent(event)
-            except Exception as e:
-                log.error("Exception raised on subclass._onEvent: %s", e)
-                log.error("%s", traceback.format_exc())
+                event = self._queue.get_nowait()
+            except Empty:
+                break
+
+            if (event == Worker.stopEvent):
+                log.debug("StopEvent, worker %s stopped", self.name)
+                self._pleaseStop.set()
+                return (False, eventCount)
+
+            self._handleEvent(event)
+            eventCount += 1
+
+            if time.time() > endTime:
+                break
+        return (True, eventCount)
+
+    def _wakeupTime(self):
+        """
+        Returns the time at which a WorkerScheduler should run this worker
+        even if no event is received, or None (can be overridden by subclasses
+        needing to do things in a delayed fashion).
+        """
+        return None
 
     def run(self):
         self._eventQueueProcessorLoop()
@@ -108,10 +256,38 @@ class Worker(LookingGlass):
     def _dequeue(self):
         return self._queue.get()
 
+    def _drainQueue(self, eventClass, maxEvents):
+        """
+        Dequeue, without blocking, up to maxEvents pending events of class
+        eventClass.
+
+        Returns a (events, nextEvent) tuple, where nextEvent is the first
+        dequeued event that was not an instance of eventClass (the caller
+        is then responsible for processing it), or None.
+        """
+        events = []
+        while len(events) < maxEvents:
+            try:
+                event = self._queue.get_nowait()
+            except Empty:
+                break
+            if not isinstance(event, eventClass):
+                return (events, event)
+            events.append(event)
+        return (events, None)
+
+    def _laneFor(self, event):
+        '''
+        Returns the queue lane for this event: can be overridden by subclasses
+        having control events that should be processed before pending route
+        events.
+        '''
+        return Worker.ROUTES_LANE
+
     def enqueue(self, event):
-        # TODO(tmmorin): replace Queue by a PriorityQueue and use a higher
-        # priority for ReInit event
-        self._queue.put(event)
+        self._queue.put(event, self._laneFor(event))
+        if self._scheduler is not None:
+            self._scheduler.wakeup(self)
 
     def _subscribe(self, afi, safi, rt=None):
         subobj = Subscription(afi, safi, rt, self)
@@ -145,10 +321,17 @@ class Worker(LookingGlass):
     # Looking glass ###
 
     def getLookingGlassLocalInfo(self, pathPrefix):
+        watermarks = self._queue.getWatermarks()
         return {
             "name": self.name,
             "internals": {
                 "event queue length": self._queue.qsize(),
+                "event queue lanes": dict(
+                    (Worker.laneNames[lane], size) for (lane, size)
+                    in enumerate(self._queue.laneSizes())),
+                "event queue flow control": (
+                    watermarks.getStats() if watermarks is not None
+                    else None),
                 "subscriptions":
                     [repr(sub) for sub in self.getWorkerSubscriptions()],
             }
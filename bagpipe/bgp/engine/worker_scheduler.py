@@ -0,0 +1,210 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs the event loops of many workers on a fixed number of threads, rather
+than having a thread for each worker.
+
+A worker is put in the run queue of the scheduler when it receives an event,
+and one of the threads of the scheduler then processes the events of this
+worker for a limited time slice: a worker is never run by more than one
+thread at a time, so that its events are processed in order, and a worker
+still having events to process at the end of its time slice is put back at
+the end of the run queue, so that all the workers get a fair share of the
+threads.
+"""
+
+import heapq
+
+import logging
+
+import traceback
+
+import time
+
+from collections import deque
+
+from threading import Thread, Condition, Lock
+
+from bagpipe.bgp.common.looking_glass import LookingGlass
+
+log = logging.getLogger(__name__)
+
+# maximum number of events processed, and maximum time spent, by a worker
+# before it gives its thread to the next worker of the run queue
+SLICE_MAX_EVENTS = 50
+SLICE_MAX_DURATION = 0.01
+
+# states of a worker in the scheduler
+_IDLE = 0      # no event to process
+_QUEUED = 1    # in the run queue
+_RUNNING = 2   # being run by one of the threads
+
+
+class WorkerScheduler(LookingGlass):
+
+    def __init__(self, threadCount, name="WorkerScheduler",
+                 sliceMaxEvents=SLICE_MAX_EVENTS,
+                 sliceMaxDuration=SLICE_MAX_DURATION):
+        assert(threadCount > 0)
+        self.name = name
+        self._sliceMaxEvents = sliceMaxEvents
+        self._sliceMaxDuration = sliceMaxDuration
+
+        self._lock = Condition(Lock())
+        # dict: worker -> state (_IDLE, _QUEUED or _RUNNING)
+        self._workers = dict()
+        # workers in _QUEUED state, with the time at which they were queued
+        self._runQueue = deque()
+        # heap of (wakeup time, worker), see Worker._wakeupTime
+        self._timers = []
+        self._stopping = False
+
+        self._threads = [Thread(target=self._run,
+                                name="%s-%d" % (name, index))
+                         for index in range(threadCount)]
+        for thread in self._threads:
+            thread.setDaemon(True)
+
+        # statistics
+        self._maxRunQueueLength = 0
+        self._sliceCount = 0
+        self._preemptedSliceCount = 0
+        self._eventCount = 0
+        self._maxQueuedTime = 0
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        '''
+        Stops the threads once the run queue is empty (workers stopped before
+        will have processed their stop event) and waits for them
+        '''
+        with self._lock:
+            self._stopping = True
+            self._lock.notifyAll()
+        for thread in self._threads:
+            thread.join()
+
+    def schedule(self, worker):
+        '''the events of worker will from now on be processed by the threads
+        of this scheduler (worker.run() must not be called)'''
+        with self._lock:
+            assert(worker._scheduler is None)
+            worker._scheduler = self
+            self._workers[worker] = _IDLE
+        # events may have been queued before worker was scheduled
+        self.wakeup(worker)
+
+    def wakeup(self, worker):
+        '''puts worker in the run queue, unless it already is, or is being
+        run'''
+        with self._lock:
+            if self._workers.get(worker) != _IDLE:
+                return
+            self._queue(worker)
+
+    def _queue(self, worker):
+        # (must be called with self._lock held)
+        self._workers[worker] = _QUEUED
+        self._runQueue.append((worker, time.time()))
+        self._maxRunQueueLength = max(self._maxRunQueueLength,
+                                      len(self._runQueue))
+        self._lock.notify()
+
+    def _nextWorker(self):
+        '''waits for a worker to run, and returns it, or returns None if the
+        scheduler is stopped'''
+        with self._lock:
+            while True:
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    (_, worker) = heapq.heappop(self._timers)
+                    if self._workers.get(worker) == _IDLE:
+                        self._queue(worker)
+
+                if self._runQueue:
+                    (worker, queuedTime) = self._runQueue.popleft()
+                    self._workers[worker] = _RUNNING
+                    self._maxQueuedTime = max(self._maxQueuedTime,
+                                              now - queuedTime)
+                    return worker
+
+                if self._stopping:
+                    return None
+
+                if self._timers:
+                    self._lock.wait(self._timers[0][0] - now)
+                else:
+                    self._lock.wait()
+
+    def _run(self):
+        while True:
+            worker = self._nextWorker()
+            if worker is None:
+                break
+
+            try:
+                (running, eventCount) = worker._processEvents(
+                    self._sliceMaxEvents, self._sliceMaxDuration)
+            except Exception as e:
+                log.error("Exception while running worker %s: %s",
+                          worker.name, e)
+                log.error("%s", traceback.format_exc())
+                (running, eventCount) = (True, 0)
+
+            with self._lock:
+                self._sliceCount += 1
+                self._eventCount += eventCount
+                if not running:
+                    log.debug("Worker %s stopped, unscheduling it",
+                              worker.name)
+                    del self._workers[worker]
+                    worker._scheduler = None
+                    continue
+
+                if not worker._queue.empty():
+                    # let the other workers run before running this one
+                    # again
+                    self._preemptedSliceCount += 1
+                    self._queue(worker)
+                else:
+                    self._workers[worker] = _IDLE
+
+                wakeupTime = worker._wakeupTime()
+                if wakeupTime is not None:
+                    heapq.heappush(self._timers, (wakeupTime, worker))
+                    self._lock.notify()
+
+        log.debug("%s thread stopped", self.name)
+
+    def getStats(self):
+        with self._lock:
+            return {
+                "threads": len(self._threads),
+                "workers": len(self._workers),
+                "run_queue_length": len(self._runQueue),
+                "max_run_queue_length": self._maxRunQueueLength,
+                "max_run_queue_wait": self._maxQueuedTime,
+                "slices": self._sliceCount,
+                "preempted_slices": self._preemptedSliceCount,
+                "events": self._eventCount
+            }
+
+    def getLookingGlassLocalInfo(self, pathPrefix):
+        return self.getStats()
@@ -60,6 +60,7 @@ class RESTAPI(LookingGlass):
         self.bottle.get("/ping", callback=self.ping)
         self.bottle.post("/attach_localport", callback=self.attach_localport)
         self.bottle.post("/detach_localport", callback=self.detach_localport)
+        self.bottle.post("/next_hop_down", callback=self.next_hop_down)
 
         self.bottle.get("/%s<path:path>" %
                         LOOKING_GLASS_BASE, callback=self.looking_glass)
@@ -252,6 +253,37 @@ class RESTAPI(LookingGlass):
             log.info(traceback.format_exc())
             abort(500, 'An error occurred during local port unplug from VPN')
 
+    def next_hop_down(self):
+        """
+        'next_hop': IP address of a BGP next hop known to be unreachable
+                    (e.g. a dead remote hypervisor): the routes using it are
+                    dropped without waiting for their withdraw in BGP
+        """
+        try:
+            params = request.json
+        except Exception:
+            log.error('next_hop_down: No next hop details received')
+            abort(400, 'No next hop details received')
+
+        if not params or 'next_hop' not in params:
+            log.warning("Mandatory parameter 'next_hop' is missing")
+            abort(400, "Mandatory parameter 'next_hop' is missing")
+
+        nextHop = params['next_hop']
+        if not (isinstance(nextHop, basestring) and
+                re.match(r'([12]?\d?\d\.){3}[12]?\d?\d$', nextHop)):
+            abort(400, "'next_hop' must be an IPv4 address")
+
+        try:
+            log.debug('Next hop down received: %s', nextHop)
+            self.vpnManager.nextHopDown(str(nextHop))
+        except Exception as e:
+            log.error('next_hop_down: An error occurred while dropping the '
+                      'routes of next hop %s: %s', nextHop, e)
+            log.info(traceback.format_exc())
+            abort(500, 'An error occurred while dropping the routes of the '
+                  'next hop')
+
     def looking_glass_root(self):
         return self.looking_glass('/')
 
@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+.. module:: test_adj_rib_out
+   :synopsis: module that defines several test cases for the adj_rib_out
+   module.
+"""
+
+import socket
+
+from testtools import TestCase
+
+from bagpipe.bgp.tests import RT1, NH1, NH2
+
+from bagpipe.bgp.engine import RouteEntry, RouteEvent
+from bagpipe.bgp.engine.adj_rib_out import AdjRibOut
+
+from bagpipe.exabgp.structure.address import AFI, SAFI
+from bagpipe.exabgp.structure.ip import Prefix
+from bagpipe.exabgp.structure.vpn import RouteDistinguisher, \
+    VPNLabelledPrefix
+from bagpipe.exabgp.structure.mpls import LabelStackEntry
+from bagpipe.exabgp.message.update.attributes import Attributes
+from bagpipe.exabgp.message.update.attribute.nexthop import NextHop
+from bagpipe.exabgp.message.update.attribute.communities import \
+    ECommunities
+
+RD = RouteDistinguisher(RouteDistinguisher.TYPE_IP_LOC, None,
+                        '11.11.11.1', 42)
+
+
+def _nlri(index, label=16):
+    prefix = Prefix(AFI.ipv4, "10.0.0.%d" % index, 32)
+    return VPNLabelledPrefix(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), prefix, RD,
+                             [LabelStackEntry(label, True)])
+
+
+def _attributes(nh):
+    attributes = Attributes()
+    attributes.add(NextHop(nh))
+    ecoms = ECommunities()
+    ecoms.communities.append(RT1)
+    attributes.add(ecoms)
+    return attributes
+
+
+def _event(eventType, nlri, attributes=None):
+    return RouteEvent(eventType,
+                      RouteEntry(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), [RT1],
+                                 nlri, attributes or Attributes(), None))
+
+
+class TestAdjRibOut(TestCase):
+
+    def setUp(self):
+        super(TestAdjRibOut, self).setUp()
+        self.ribOut = AdjRibOut()
+
+    def testA1_SuppressUnchangedAdvertisement(self):
+        first = _event(RouteEvent.ADVERTISE, _nlri(1), _attributes(NH1))
+        self.assertEqual([first], self.ribOut.filterEvents([first]))
+        # other objects with the same values
+        same = _event(RouteEvent.ADVERTISE, _nlri(1), _attributes(NH1))
+        self.assertEqual([], self.ribOut.filterEvents([same]))
+        self.assertEqual(1, len(self.ribOut))
+        self.assertEqual(
+            1, self.ribOut.getStats()["suppressed_advertisements"])
+
+    def testA2_ChangedAdvertisement(self):
+        self.ribOut.filterEvents(
+            [_event(RouteEvent.ADVERTISE, _nlri(1), _attributes(NH1))])
+        newNextHop = _event(RouteEvent.ADVERTISE, _nlri(1), _attributes(NH2))
+        self.assertEqual([newNextHop], self.ribOut.filterEvents([newNextHop]))
+        # the label is not part of the NLRI key, but must be sent
+        newLabel = _event(RouteEvent.ADVERTISE, _nlri(1, label=17),
+                          _attributes(NH2))
+        self.assertEqual([newLabel], self.ribOut.filterEvents([newLabel]))
+        self.assertEqual(1, len(self.ribOut))
+
+    def testA3_DropWithdrawNotAdvertised(self):
+        self.ribOut.filterEvents(
+            [_event(RouteEvent.ADVERTISE, _nlri(1), _attributes(NH1))])
+        withdraws = [_event(RouteEvent.WITHDRAW, _nlri(index))
+                     for index in (1, 2)]
+        self.assertEqual(withdraws[:1], self.ribOut.filterEvents(withdraws))
+        self.assertEqual(0, len(self.ribOut))
+        # already withdrawn
+        self.assertEqual([], self.ribOut.filterEvents(withdraws[:1]))
+        self.assertEqual(2, self.ribOut.getStats()["dropped_withdraws"])
+
+    def testA4_LastEventWins(self):
+        events = [_event(RouteEvent.ADVERTISE, _nlri(1), _attributes(NH1)),
+                  _event(RouteEvent.ADVERTISE, _nlri(2), _attributes(NH1)),
+                  _event(RouteEvent.ADVERTISE, _nlri(1), _attributes(NH2)),
+                  _event(RouteEvent.WITHDRAW, _nlri(2))]
+        # route 2 was never sent to the peer
+        self.assertEqual(events[2:3], self.ribOut.filterEvents(events))
+
+    def testA5_AdvertiseEvents(self):
+        events = [_event(RouteEvent.ADVERTISE, _nlri(index), _attributes(NH1))
+                  for index in range(3)]
+        self.ribOut.filterEvents(events)
+        self.ribOut.filterEvents([_event(RouteEvent.WITHDRAW, _nlri(1))])
+
+        resent = self.ribOut.advertiseEvents()
+        self.assertEqual(
+            set([events[0].routeEntry, events[2].routeEntry]),
+            set(event.routeEntry for event in resent))
+        for event in resent:
+            self.assertEqual(RouteEvent.ADVERTISE, event.type)
+        self.assertEqual([], self.ribOut.advertiseEvents(AFI(AFI.l2vpn),
+                                                         SAFI(SAFI.evpn)))
+        self.assertEqual(2, len(self.ribOut.advertiseEvents(
+            AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn))))
+
+        self.ribOut.clear()
+        self.assertEqual([], self.ribOut.advertiseEvents())
+        self.assertEqual({}, self.ribOut.getStats()["routes"])
+
+    def testA6_Stats(self):
+        self.ribOut.filterEvents(
+            [_event(RouteEvent.ADVERTISE, _nlri(index), _attributes(NH1))
+             for index in range(3)])
+        self.assertEqual({"%s/%s" % (AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn)): 3},
+                         self.ribOut.getStats()["routes"])
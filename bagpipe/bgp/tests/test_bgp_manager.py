@@ -0,0 +1,82 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+.. module:: test_bgp_manager
+   :synopsis: module that defines several test cases for the bgp_manager
+   module.
+"""
+
+import mock
+
+from testtools import TestCase
+
+from bagpipe.bgp.tests import RT1, RT2
+
+from bagpipe.bgp.engine import Subscription, Unsubscription
+from bagpipe.bgp.engine.bgp_manager import Manager
+from bagpipe.bgp.engine.bgp_peer_worker import BGPPeerWorker
+from bagpipe.bgp.engine.worker import Worker
+
+from bagpipe.exabgp.structure.address import AFI, SAFI
+
+
+class TestManagerRouteRefresh(TestCase):
+
+    def setUp(self):
+        super(TestManagerRouteRefresh, self).setUp()
+        self.manager = Manager({'local_address': '11.11.11.1',
+                                'my_as': '64512',
+                                'peers': '',
+                                'refresh_on_import': 'True'})
+        self.addCleanup(self.manager.stop)
+        self.manager.requestRouteRefresh = mock.Mock()
+
+    def _subUnsub(self, cls, routeTarget, worker):
+        self.manager.routeEventSubUnsub(
+            cls(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), routeTarget, worker))
+
+    def test_refresh_on_first_import(self):
+        workerA = Worker(self.manager, 'Worker-A')
+        workerB = Worker(self.manager, 'Worker-B')
+
+        self._subUnsub(Subscription, RT1, workerA)
+        self.manager.requestRouteRefresh.assert_called_once_with(
+            AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn))
+
+        # the route target is already imported
+        self._subUnsub(Subscription, RT1, workerB)
+        self.assertEqual(1, self.manager.requestRouteRefresh.call_count)
+
+        self._subUnsub(Subscription, RT2, workerB)
+        self.assertEqual(2, self.manager.requestRouteRefresh.call_count)
+
+        # the route target is imported again once no worker imports it
+        self._subUnsub(Unsubscription, RT1, workerA)
+        self._subUnsub(Unsubscription, RT1, workerB)
+        self._subUnsub(Subscription, RT1, workerA)
+        self.assertEqual(3, self.manager.requestRouteRefresh.call_count)
+
+    def test_no_refresh_for_peers(self):
+        peer = mock.Mock(spec=BGPPeerWorker)
+        self._subUnsub(Subscription, RT1, peer)
+        self.assertFalse(self.manager.requestRouteRefresh.called)
+
+    def test_refresh_without_rtc(self):
+        self.manager.config['enable_rtc'] = False
+        self._subUnsub(Subscription, RT1, Worker(self.manager, 'Worker-A'))
+        self.assertEqual(1, self.manager.requestRouteRefresh.call_count)
@@ -0,0 +1,84 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+.. module:: test_encode_cache
+   :synopsis: module that defines several test cases for the encode_cache
+   module.
+"""
+
+from testtools import TestCase
+
+from bagpipe.bgp.tests import RT1, NH1, NH2
+
+from bagpipe.bgp.engine.encode_cache import EncodeCache
+
+from bagpipe.exabgp.message.update.attributes import Attributes
+from bagpipe.exabgp.message.update.attribute.nexthop import NextHop
+from bagpipe.exabgp.message.update.attribute.communities import \
+    ECommunities
+
+
+def _attributes(nh):
+    attributes = Attributes()
+    attributes.add(NextHop(nh))
+    ecoms = ECommunities()
+    ecoms.communities.append(RT1)
+    attributes.add(ecoms)
+    return attributes
+
+
+class TestEncodeCache(TestCase):
+
+    def setUp(self):
+        super(TestEncodeCache, self).setUp()
+        self.cache = EncodeCache(maxSize=2)
+
+    def testA1_SameValuesPackedOnce(self):
+        packed = self.cache.packedAttributes(_attributes(NH1), False, 1, 1)
+        # other objects with the same values
+        self.assertEqual(packed, self.cache.packedAttributes(
+            _attributes(NH1), False, 1, 1))
+        self.assertEqual(_attributes(NH1).bgp_announce(False, 1, 1), packed)
+        stats = self.cache.getStats()
+        self.assertEqual((1, 1), (stats["hits"], stats["misses"]))
+
+    def testA2_EncodingContext(self):
+        attributes = _attributes(NH1)
+        withNextHop = self.cache.packedAttributes(attributes, False, 1, 1)
+        withoutNextHop = self.cache.packedAttributes(attributes, False, 1, 1,
+                                                     False)
+        self.assertNotEqual(withNextHop, withoutNextHop)
+        self.assertEqual(attributes.bgp_announce(False, 1, 1, False),
+                         withoutNextHop)
+        self.assertEqual(2, self.cache.getStats()["misses"])
+
+    def testA3_LeastRecentlyUsedEvicted(self):
+        (attributes1, attributes2) = (_attributes(NH1), _attributes(NH2))
+        self.cache.packedAttributes(attributes1, False, 1, 1)
+        self.cache.packedAttributes(attributes2, False, 1, 1)
+        self.cache.packedAttributes(attributes1, False, 1, 1)
+        # evicts attributes2, the least recently used
+        self.cache.packedAttributes(attributes1, True, 1, 1)
+        self.cache.packedAttributes(attributes1, False, 1, 1)
+        self.cache.packedAttributes(attributes2, False, 1, 1)
+
+        stats = self.cache.getStats()
+        self.assertEqual(2, stats["size"])
+        self.assertEqual(2, stats["hits"])
+        self.assertEqual(4, stats["misses"])
+        self.assertEqual(2, stats["evictions"])
@@ -0,0 +1,712 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+.. module:: test_exabgp_peer_worker
+   :synopsis: module that defines several test cases for the
+              exabgp_peer_worker module.
+   In particular, unit tests for the generation of UPDATE messages by
+   ExaBGPPeerWorker: UPDATEs produced are decoded back with exabgp code, to
+   check that routes are packed in as few messages as possible.
+"""
+
+import socket
+
+import mock
+
+from testtools import TestCase
+
+from bagpipe.bgp.tests import RT1, NH1, NH2
+
+from bagpipe.bgp.engine import RouteEntry, RouteEvent
+from bagpipe.bgp.engine.bgp_manager import Manager
+from bagpipe.bgp.engine.encode_cache import EncodeCache
+from bagpipe.bgp.engine.bgp_peer_worker import Init, ReInit, Reconnect, \
+    SendKeepAlive, FSM, MRAIExpired, RouteRefreshRequested, \
+    SendRouteRefresh, RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY, \
+    RECONNECT_JITTER
+from bagpipe.bgp.engine.exabgp_peer_worker import ExaBGPPeerWorker, \
+    FakePeer, BGP_MAX_MESSAGE_SIZE, _ConnectionHandler
+
+from bagpipe.exabgp.network.connection import Connection
+from bagpipe.exabgp.network.protocol import Protocol
+from bagpipe.exabgp.structure.neighbor import Neighbor
+from bagpipe.exabgp.structure.address import AFI, SAFI
+from bagpipe.exabgp.structure.ip import Prefix
+from bagpipe.exabgp.structure.vpn import RouteDistinguisher, \
+    VPNLabelledPrefix
+from bagpipe.exabgp.structure.mpls import LabelStackEntry
+from bagpipe.exabgp.message.update.attributes import Attributes
+from bagpipe.exabgp.message.update.attribute.nexthop import NextHop
+from bagpipe.exabgp.message.update.attribute.communities import \
+    ECommunities
+from bagpipe.exabgp.message.keepalive import KeepAlive
+from bagpipe.exabgp.message.update import Update
+from bagpipe.exabgp.message.update.route import ReceivedRoute
+from bagpipe.exabgp.message.notification import Notify
+from bagpipe.exabgp.message.open import Capabilities, \
+    RouteRefresh as RouteRefreshCapability, EnhancedRouteRefresh
+from bagpipe.exabgp.message.refresh import RouteRefresh
+
+CONFIG = {'local_address': '11.11.11.1',
+          'my_as': 64512,
+          'peer_as': 64512,
+          'enable_rtc': True}
+
+RD = RouteDistinguisher(RouteDistinguisher.TYPE_IP_LOC, None,
+                        '11.11.11.1', 42)
+
+
+def _nlri(index):
+    prefix = Prefix(AFI.ipv4, socket.inet_ntoa(
+        chr(10) + chr(index >> 16 & 0xFF) + chr(index >> 8 & 0xFF) +
+        chr(index & 0xFF)), 32)
+    return VPNLabelledPrefix(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), prefix, RD,
+                             [LabelStackEntry(index % 1000 + 16, True)])
+
+
+def _attributes(nh):
+    attributes = Attributes()
+    attributes.add(NextHop(nh))
+    ecoms = ECommunities()
+    ecoms.communities.append(RT1)
+    attributes.add(ecoms)
+    return attributes
+
+
+class TestExaBGPPeerWorkerUpdates(TestCase):
+
+    def setUp(self):
+        super(TestExaBGPPeerWorkerUpdates, self).setUp()
+        self.worker = ExaBGPPeerWorker(mock.Mock(spec=Manager), "test",
+                                       "10.0.0.1", CONFIG)
+
+        neighbor = Neighbor()
+        neighbor.peer_address = "10.0.0.1"
+        self.protocol = Protocol(FakePeer(neighbor))
+
+    def _events(self, eventType, indexes, attributes):
+        return [RouteEvent(eventType,
+                           RouteEntry(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn),
+                                      [RT1], _nlri(index), attributes, None))
+                for index in indexes]
+
+    def _decode(self, messages):
+        routes = []
+        for message in messages:
+            self.assertTrue(len(message) <= BGP_MAX_MESSAGE_SIZE)
+            routes.append(self.protocol.UpdateFactory(message[19:]).routes)
+        return routes
+
+    def test_single_advertise(self):
+        attributes = _attributes(NH1)
+        messages = self.worker._updatesForRouteEvents(
+            self._events(RouteEvent.ADVERTISE, [1], attributes))
+
+        decoded = self._decode(messages)
+        self.assertEqual(1, len(decoded))
+        self.assertEqual(1, len(decoded[0]))
+        self.assertEqual(_nlri(1), decoded[0][0].nlri)
+        self.assertEqual('announce', decoded[0][0].action)
+
+    def test_pack_same_attributes(self):
+        attributes = _attributes(NH1)
+        indexes = range(1000)
+        messages = self.worker._updatesForRouteEvents(
+            self._events(RouteEvent.ADVERTISE, indexes, attributes))
+
+        decoded = self._decode(messages)
+        # 1000 routes of 16 bytes can't fit in a single message...
+        self.assertTrue(len(decoded) > 1)
+        # ...but each message is used at the best of its capacity
+        self.assertTrue(len(decoded) <= 1000 * 16 / BGP_MAX_MESSAGE_SIZE + 1)
+
+        nlris = [route.nlri for routes in decoded for route in routes]
+        self.assertEqual([_nlri(index) for index in indexes], nlris)
+        for routes in decoded:
+            for route in routes:
+                self.assertEqual('announce', route.action)
+                self.assertEqual("1.1.1.1", str(route.attributes[
+                    NextHop.ID].next_hop))
+
+    def test_group_by_attributes(self):
+        events = (self._events(RouteEvent.ADVERTISE, [1, 2], _attributes(NH1))
+                  + self._events(RouteEvent.ADVERTISE, [3], _attributes(NH2))
+                  + self._events(RouteEvent.ADVERTISE, [4], _attributes(NH1)))
+        messages = self.worker._updatesForRouteEvents(events)
+
+        decoded = self._decode(messages)
+        self.assertEqual(2, len(decoded))
+        self.assertEqual([_nlri(1), _nlri(2), _nlri(4)],
+                         [route.nlri for route in decoded[0]])
+        self.assertEqual([_nlri(3)], [route.nlri for route in decoded[1]])
+
+    def test_pack_withdraws(self):
+        events = self._events(RouteEvent.WITHDRAW, range(10), Attributes())
+        messages = self.worker._updatesForRouteEvents(events)
+
+        decoded = self._decode(messages)
+        self.assertEqual(1, len(decoded))
+        self.assertEqual([_nlri(index) for index in range(10)],
+                         [route.nlri for route in decoded[0]])
+        for route in decoded[0]:
+            self.assertEqual('withdraw', route.action)
+
+    def test_last_event_wins(self):
+        attributes = _attributes(NH1)
+        events = (self._events(RouteEvent.ADVERTISE, [1, 2], attributes) +
+                  self._events(RouteEvent.WITHDRAW, [1], Attributes()) +
+                  self._events(RouteEvent.WITHDRAW, [3], Attributes()) +
+                  self._events(RouteEvent.ADVERTISE, [3], attributes))
+        messages = self.worker._updatesForRouteEvents(events)
+
+        decoded = self._decode(messages)
+        self.assertEqual(2, len(decoded))
+        self.assertEqual([(_nlri(1), 'withdraw')],
+                         [(route.nlri, route.action) for route in decoded[0]])
+        self.assertEqual([(_nlri(2), 'announce'), (_nlri(3), 'announce')],
+                         [(route.nlri, route.action) for route in decoded[1]])
+
+    def test_attributes_packed_once_for_all_peers(self):
+        otherWorker = ExaBGPPeerWorker(mock.Mock(spec=Manager), "test",
+                                       "10.0.0.2", CONFIG)
+        cache = EncodeCache()
+        self.worker.encodeCache = otherWorker.encodeCache = cache
+        events = self._events(RouteEvent.ADVERTISE, range(10),
+                              _attributes(NH1))
+
+        messages = self.worker._updatesForRouteEvents(events)
+        self.assertEqual(messages, otherWorker._updatesForRouteEvents(events))
+        stats = cache.getStats()
+        self.assertEqual((1, 1), (stats["misses"], stats["hits"]))
+
+    def test_adj_rib_out(self):
+        # (Init was enqueued when the worker was created)
+        self.worker._dequeue()
+        self.worker.fsm.state = FSM.Established
+        self.worker._sendAll = mock.Mock()
+        events = self._events(RouteEvent.ADVERTISE, range(3),
+                              _attributes(NH1))
+        self.worker._onEvent(events[0])
+        # the same routes, with other attributes objects with same values
+        for event in self._events(RouteEvent.ADVERTISE, range(3),
+                                  _attributes(NH1)):
+            self.worker.enqueue(event)
+        self.worker._onEvent(self.worker._dequeue())
+        self.worker._onEvent(
+            self._events(RouteEvent.WITHDRAW, [5], Attributes())[0])
+
+        sent = [data for call in self.worker._sendAll.call_args_list
+                for data in call[0][0]]
+        decoded = self._decode(sent)
+        self.assertEqual([[_nlri(0)], [_nlri(1), _nlri(2)]],
+                         [[route.nlri for route in routes]
+                          for routes in decoded])
+        self.assertEqual(3, len(self.worker.adjRibOut))
+
+        self.worker._sendAll.reset_mock()
+        self.worker._resendAdjRibOut()
+        decoded = self._decode(
+            [data for call in self.worker._sendAll.call_args_list
+             for data in call[0][0]])
+        self.assertEqual(set(_nlri(index) for index in range(3)),
+                         set(route.nlri for routes in decoded
+                             for route in routes))
+
+    def test_decode_truncated_attribute(self):
+        attributes = _attributes(NH1)
+        message = self.worker._updatesForRouteEvents(
+            self._events(RouteEvent.ADVERTISE, [1], attributes))[0]
+        # header, no withdrawn routes, attributes length, attributes
+        attributesData = message[19 + 2 + 2:]
+        self.assertEqual(1, len(
+            self.protocol.UpdateFactory(message[19:]).routes))
+        # the last attribute claims more bytes than what remains
+        self.assertRaises(Notify, self.protocol.AttributesFactory,
+                          attributesData[:-1])
+
+    def test_control_events_first(self):
+        # (Init was enqueued when the worker was created)
+        events = self._events(RouteEvent.ADVERTISE, range(3),
+                              _attributes(NH1))
+        for event in events:
+            self.worker.enqueue(event)
+        self.worker.enqueue(SendKeepAlive)
+
+        self.assertEqual([Init, SendKeepAlive] + events,
+                         [self.worker._dequeue() for _ in range(5)])
+
+
+class TestExaBGPPeerWorkerReconnect(TestCase):
+
+    def setUp(self):
+        super(TestExaBGPPeerWorkerReconnect, self).setUp()
+        self.worker = ExaBGPPeerWorker(mock.Mock(spec=Manager), "test",
+                                       "10.0.0.1", CONFIG)
+        self.worker.timerWheel = mock.Mock()
+        # (Init was enqueued when the worker was created)
+        self.worker._dequeue()
+
+    def _fail(self):
+        self.worker.fsm.state = FSM.Connect
+        self.worker._onEvent(ReInit)
+        (delay, callback, event) = \
+            self.worker.timerWheel.schedule.call_args[0]
+        self.assertEqual(Reconnect, event)
+        self.assertEqual(FSM.Idle, self.worker.fsm.state)
+        # the worker does not connect until the timer expires
+        self.assertTrue(self.worker._queue.empty())
+        self.worker._reconnectTimer = None
+        return delay
+
+    def test_exponential_backoff(self):
+        for expected in (RECONNECT_MIN_DELAY, RECONNECT_MIN_DELAY * 2,
+                         RECONNECT_MIN_DELAY * 4):
+            delay = self._fail()
+            self.assertTrue(expected * (1 - RECONNECT_JITTER) <= delay)
+            self.assertTrue(delay <= expected)
+        for _ in range(10):
+            delay = self._fail()
+        self.assertTrue(delay <= RECONNECT_MAX_DELAY)
+        self.assertEqual(13, self.worker._reconnectAttempts)
+
+        self.worker._toEstablished()
+        self.assertTrue(self._fail() <= RECONNECT_MIN_DELAY)
+
+    def test_purge_route_events(self):
+        events = [RouteEvent(RouteEvent.ADVERTISE,
+                             RouteEntry(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn),
+                                        [RT1], _nlri(index),
+                                        _attributes(NH1), None))
+                  for index in range(3)]
+        # routes already advertised to the peer
+        self.worker.adjRibOut.filterEvents(events)
+        for event in events:
+            self.worker.enqueue(event)
+        self.worker.enqueue(ReInit)
+
+        self.assertEqual(ReInit, self.worker._dequeue())
+        self.worker._onEvent(ReInit)
+        self.assertTrue(self.worker._queue.empty())
+        self.assertEqual(3, self.worker._purgedEventCount)
+        # the routes will be advertised again to the next session
+        self.assertEqual(0, len(self.worker.adjRibOut))
+
+        # a ReInit while the reconnection is pending is ignored
+        self.worker._onEvent(ReInit)
+        self.assertEqual(1, self.worker.timerWheel.schedule.call_count)
+        self.assertEqual(1, self.worker._reconnectAttempts)
+
+    def test_keepalive_expiry_while_paused(self):
+        self.worker.fsm.state = FSM.Established
+        self.worker._setReadPaused(True)
+        self.worker.onKeepAliveExpired()
+        # keepalives were not read, the session is kept
+        self.assertEqual(FSM.Established, self.worker.fsm.state)
+        self.assertTrue(self.worker._queue.empty())
+        self.assertEqual(self.worker.onKeepAliveExpired,
+                         self.worker.timerWheel.schedule.call_args[0][1])
+
+        self.worker._setReadPaused(False)
+        self.worker.onKeepAliveExpired()
+        self.assertEqual(ReInit, self.worker._dequeue())
+
+
+class TestExaBGPPeerWorkerMRAI(TestCase):
+
+    family = (AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn))
+
+    def _worker(self, **options):
+        config = dict(CONFIG, mrai_ipvpn="5", **options)
+        worker = ExaBGPPeerWorker(mock.Mock(spec=Manager), "test",
+                                  "10.0.0.1", config)
+        worker.timerWheel = mock.Mock()
+        worker._sendAll = mock.Mock()
+        # (Init was enqueued when the worker was created)
+        worker._dequeue()
+        worker.fsm.state = FSM.Established
+
+        self.protocol = Protocol(FakePeer(Neighbor()))
+        return worker
+
+    def _event(self, eventType, index, nh=None):
+        attributes = _attributes(nh) if nh else Attributes()
+        return RouteEvent(eventType,
+                          RouteEntry(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn),
+                                     [RT1], _nlri(index), attributes, None))
+
+    def _sent(self, worker):
+        routes = [(route.nlri, route.action) for call
+                  in worker._sendAll.call_args_list for data in call[0][0]
+                  for route in self.protocol.UpdateFactory(data[19:]).routes]
+        worker._sendAll.reset_mock()
+        return routes
+
+    def _expire(self, worker):
+        (delay, callback, event) = worker.timerWheel.schedule.call_args[0]
+        self.assertEqual(5, delay)
+        self.assertTrue(isinstance(event, MRAIExpired))
+        self.assertEqual(self.family, event.family)
+        worker.timerWheel.schedule.reset_mock()
+        worker._onEvent(event)
+
+    def test_hold_during_interval(self):
+        worker = self._worker()
+        self.assertEqual({self.family: 5}, worker.mraiIntervals)
+
+        worker._onEvent(self._event(RouteEvent.ADVERTISE, 1, NH1))
+        self.assertEqual([(_nlri(1), 'announce')], self._sent(worker))
+
+        # a flapping route, only its last state is sent
+        worker._onEvent(self._event(RouteEvent.ADVERTISE, 1, NH2))
+        worker._onEvent(self._event(RouteEvent.WITHDRAW, 2))
+        worker._onEvent(self._event(RouteEvent.ADVERTISE, 2, NH1))
+        worker._onEvent(self._event(RouteEvent.ADVERTISE, 2, NH2))
+        self.assertEqual([], self._sent(worker))
+        self.assertEqual(1, worker._mraiSuppressedCount)
+
+        self._expire(worker)
+        self.assertEqual([(_nlri(1), 'announce'), (_nlri(2), 'announce')],
+                         self._sent(worker))
+        # routes were sent, a new interval started
+        self.assertTrue(worker.timerWheel.schedule.called)
+        self._expire(worker)
+        self.assertFalse(worker.timerWheel.schedule.called)
+
+    def test_withdraw_bypass(self):
+        worker = self._worker()
+        worker._onEvent(self._event(RouteEvent.ADVERTISE, 1, NH1))
+        worker._onEvent(self._event(RouteEvent.ADVERTISE, 2, NH1))
+        self._sent(worker)
+
+        worker._onEvent(self._event(RouteEvent.ADVERTISE, 1, NH2))
+        worker._onEvent(self._event(RouteEvent.WITHDRAW, 1))
+        self.assertEqual([(_nlri(1), 'withdraw')], self._sent(worker))
+
+        worker = self._worker(mrai_withdraw_bypass="False")
+        worker._onEvent(self._event(RouteEvent.ADVERTISE, 1, NH1))
+        self._sent(worker)
+        worker._onEvent(self._event(RouteEvent.WITHDRAW, 1))
+        self.assertEqual([], self._sent(worker))
+        self._expire(worker)
+        self.assertEqual([(_nlri(1), 'withdraw')], self._sent(worker))
+
+    def test_reset_on_reinit(self):
+        worker = self._worker()
+        worker._onEvent(self._event(RouteEvent.ADVERTISE, 1, NH1))
+        worker._onEvent(self._event(RouteEvent.ADVERTISE, 2, NH1))
+        timer = worker.timerWheel.schedule.return_value
+        (_, _, event) = worker.timerWheel.schedule.call_args[0]
+
+        worker._onEvent(ReInit)
+        self.assertTrue(timer.cancel.called)
+        self.assertEqual({}, worker._mraiPending)
+        # an expiry already queued is ignored
+        worker._onEvent(event)
+        self.assertEqual([(_nlri(1), 'announce')], self._sent(worker))
+
+
+class SocketPairConnection(Connection):
+
+    '''exabgp Connection on one end of a socket pair'''
+
+    def __init__(self, io):
+        self.io = io
+        self.peer = "test"
+        self.last_read = 0
+        self.last_write = 0
+        self._init_receive_buffer()
+        self._init_send_buffer()
+
+
+class TestExaBGPPeerWorkerReceive(TestCase):
+
+    def setUp(self):
+        super(TestExaBGPPeerWorkerReceive, self).setUp()
+        (self.ours, self.theirs) = socket.socketpair()
+        self.addCleanup(self.ours.close)
+        self.addCleanup(self.theirs.close)
+
+        neighbor = Neighbor()
+        neighbor.peer_address = "10.0.0.1"
+        neighbor.parse_routes = True
+        self.protocol = Protocol(FakePeer(neighbor),
+                                 SocketPairConnection(self.ours))
+
+        worker = ExaBGPPeerWorker(mock.Mock(spec=Manager), "test",
+                                  "10.0.0.1", CONFIG)
+        events = [RouteEvent(RouteEvent.ADVERTISE,
+                             RouteEntry(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn),
+                                        [RT1], _nlri(index),
+                                        _attributes(NH1), None))
+                  for index in range(300)]
+        self.updates = worker._updatesForRouteEvents(events)
+        self.keepalive = KeepAlive().message()
+
+    def test_read_messages(self):
+        data = self.keepalive + ''.join(self.updates) + self.keepalive
+        # the last keepalive is sent in two parts
+        self.theirs.sendall(data[:-5])
+
+        messages = self.protocol.read_messages()
+        self.assertEqual([KeepAlive.TYPE] + [Update.TYPE] * len(self.updates),
+                         [message.TYPE for message in messages])
+        self.assertEqual(300, sum(len(message.routes)
+                                  for message in messages[1:]))
+
+        self.theirs.sendall(data[-5:])
+        messages = self.protocol.read_messages()
+        self.assertEqual([KeepAlive.TYPE],
+                         [message.TYPE for message in messages])
+        self.assertEqual(len(data), self.protocol.connection.bytes_received)
+
+    def test_read_messages_nothing_received(self):
+        self.assertEqual([], self.protocol.read_messages())
+
+    def test_read_messages_bad_length(self):
+        # a keepalive claiming to be 20 bytes long
+        self.theirs.sendall(self.keepalive[:16] + '\x00\x14' +
+                            self.keepalive[18:] + '\x00')
+        try:
+            self.protocol.read_messages()
+            self.fail("Notify not raised")
+        except Notify as notify:
+            self.assertEqual((1, 2, '\x00\x14'),
+                             (notify.code, notify.subcode, notify.data))
+
+
+class TestExaBGPPeerWorkerSend(TestCase):
+
+    def setUp(self):
+        super(TestExaBGPPeerWorkerSend, self).setUp()
+        # a TCP connection on the loopback interface
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        ours = socket.create_connection(listener.getsockname())
+        (self.theirs, _) = listener.accept()
+        listener.close()
+        ours.setblocking(0)
+        self.addCleanup(ours.close)
+        self.addCleanup(self.theirs.close)
+
+        self.worker = ExaBGPPeerWorker(mock.Mock(spec=Manager), "test",
+                                       "10.0.0.1", CONFIG)
+        self.worker.reactor = mock.Mock()
+        self.worker.connection = SocketPairConnection(ours)
+        self.worker._connectionHandler = _ConnectionHandler(
+            self.worker, self.worker.connection)
+        self.worker._openWaitTimer = mock.Mock()
+        # (Init was enqueued when the worker was created)
+        self.worker._dequeue()
+        self.worker.fsm.state = FSM.Established
+        self.keepalive = KeepAlive().message()
+
+    def _receive(self, size):
+        data = ""
+        while len(data) < size:
+            data += self.theirs.recv(size - len(data))
+        return data
+
+    def test_single_write(self):
+        self.worker.tcpCork = True
+        self.worker._sendAll([self.keepalive] * 1000)
+        self.assertEqual(self.keepalive * 1000,
+                         self._receive(len(self.keepalive) * 1000))
+        connection = self.worker.connection
+        self.assertEqual(1, connection.writes)
+        self.assertEqual(0, connection.pending_output())
+        self.assertEqual(1000, self.worker._sendStats['messages'])
+        self.assertFalse(self.worker.reactor.callFromThread.called)
+
+    def test_partial_writes(self):
+        self.theirs.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+        self.worker.connection.io.setsockopt(socket.SOL_SOCKET,
+                                             socket.SO_SNDBUF, 16384)
+        messages = [chr(index % 256) * BGP_MAX_MESSAGE_SIZE
+                    for index in range(200)]
+        self.worker._sendAll(messages)
+
+        connection = self.worker.connection
+        self.assertTrue(connection.pending_output() > 0)
+        self.worker.reactor.callFromThread.assert_called_once_with(
+            self.worker._updateInterest)
+        self.worker._updateInterest()
+        self.assertTrue(self.worker.reactor.modify.call_args[1]['write'])
+
+        received = []
+        while connection.pending_output():
+            received.append(self.theirs.recv(1024 * 1024))
+            # (called by the reactor once the socket is writable)
+            self.worker._connectionHandler.onWritable()
+        received.append(self._receive(len(messages) * BGP_MAX_MESSAGE_SIZE
+                                      - sum(map(len, received))))
+        self.assertEqual(''.join(messages), ''.join(received))
+        self.assertTrue(connection.partial_writes > 0)
+        # nothing left to send
+        self.assertFalse(self.worker.reactor.modify.call_args[1]['write'])
+
+    def test_write_failure(self):
+        self.worker.connection.io.shutdown(socket.SHUT_WR)
+        self.worker._send(self.keepalive)
+        self.assertEqual(ReInit, self.worker._dequeue())
+        self.assertFalse(self.worker._connectionHandler.active)
+
+
+class TestExaBGPPeerWorkerRouteRefresh(TestCase):
+
+    family = (AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn))
+
+    def setUp(self):
+        super(TestExaBGPPeerWorkerRouteRefresh, self).setUp()
+        self.worker = ExaBGPPeerWorker(mock.Mock(spec=Manager), "test",
+                                       "10.0.0.1", CONFIG)
+        self.worker._sendAll = mock.Mock()
+        # (Init was enqueued when the worker was created)
+        self.worker._dequeue()
+        self.worker.fsm.state = FSM.Established
+        self.worker._activeFamilies = [self.family]
+        self.worker._routeRefresh = True
+        self.worker._enhancedRefresh = True
+
+        neighbor = Neighbor()
+        neighbor.peer_address = "10.0.0.1"
+        neighbor.parse_routes = True
+        self.protocol = Protocol(FakePeer(neighbor))
+
+    def _sent(self):
+        sent = [data for call in self.worker._sendAll.call_args_list
+                for data in call[0][0]]
+        self.worker._sendAll.reset_mock()
+        return [self.protocol._decode_message(
+                self.protocol._check_header(data[:19])[1], data[19:])
+                for data in sent]
+
+    def _receiveRoute(self, index, action="announce"):
+        route = ReceivedRoute(_nlri(index), action)
+        if action == "announce":
+            route.attributes = _attributes(NH1)
+        self.worker._processReceivedRoute(route)
+
+    def test_message(self):
+        data = RouteRefresh(AFI.l2vpn, SAFI.evpn, RouteRefresh.END).message()
+        self.assertEqual(23, len(data))
+        (_, msg) = self.protocol._check_header(data[:19])
+        message = self.protocol._decode_message(msg, data[19:])
+        self.assertEqual((AFI(AFI.l2vpn), SAFI(SAFI.evpn), RouteRefresh.END),
+                         (message.afi, message.safi, message.subtype))
+        # a route refresh message has a fixed length
+        self.assertRaises(Notify, self.protocol._check_header,
+                          data[:16] + chr(0) + chr(24) + data[18])
+
+    def test_capabilities(self):
+        capabilities = Capabilities()
+        capabilities[Capabilities.ROUTE_REFRESH] = RouteRefreshCapability()
+        capabilities[Capabilities.ENHANCED_ROUTE_REFRESH] = \
+            EnhancedRouteRefresh()
+        parsed = self.protocol.CapabilitiesFactory(capabilities.pack())
+        self.assertTrue(parsed.announced(Capabilities.ROUTE_REFRESH))
+        self.assertTrue(parsed.announced(
+            Capabilities.ENHANCED_ROUTE_REFRESH))
+
+    def test_refresh_requested(self):
+        self.worker.adjRibOut.filterEvents(
+            [RouteEvent(RouteEvent.ADVERTISE,
+                        RouteEntry(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), [RT1],
+                                   _nlri(index), _attributes(NH1), None))
+             for index in range(3)])
+
+        self.worker._processReceivedMessage(RouteRefresh(*self.family))
+        event = self.worker._dequeue()
+        self.assertTrue(isinstance(event, RouteRefreshRequested))
+        self.worker._onEvent(event)
+        messages = self._sent()
+        self.assertEqual([RouteRefresh.TYPE, Update.TYPE, RouteRefresh.TYPE],
+                         [message.TYPE for message in messages])
+        self.assertEqual([RouteRefresh.BEGIN, RouteRefresh.END],
+                         [messages[0].subtype, messages[-1].subtype])
+        self.assertEqual(set(_nlri(index) for index in range(3)),
+                         set(route.nlri for route in messages[1].routes))
+
+        # without enhanced route refresh, the routes only
+        self.worker._enhancedRefresh = False
+        self.worker._onEvent(event)
+        self.assertEqual([Update.TYPE],
+                         [message.TYPE for message in self._sent()])
+
+        # not for a family that was not negotiated
+        self.worker._processReceivedMessage(
+            RouteRefresh(AFI.l2vpn, SAFI.evpn))
+        self.assertTrue(self.worker._queue.empty())
+
+    def test_stale_routes_swept(self):
+        for index in range(4):
+            self._receiveRoute(index)
+        self._receiveRoute(3, "withdraw")
+
+        self.worker._processReceivedMessage(
+            RouteRefresh(self.family[0], self.family[1], RouteRefresh.BEGIN))
+        self._receiveRoute(0)
+        self._receiveRoute(2)
+        self.worker.bgpManager._pushEvent.reset_mock()
+        self.worker._processReceivedMessage(
+            RouteRefresh(self.family[0], self.family[1], RouteRefresh.END))
+
+        events = [call[0][0] for call
+                  in self.worker.bgpManager._pushEvent.call_args_list]
+        self.assertEqual([(RouteEvent.WITHDRAW, _nlri(1))],
+                         [(event.type, event.routeEntry.nlri)
+                          for event in events])
+        self.assertEqual(set([_nlri(0), _nlri(2)]),
+                         self.worker._receivedNLRIs[self.family])
+        self.assertEqual(1, self.worker._refreshStats['stale_routes_swept'])
+
+    def test_send_route_refresh(self):
+        self.worker.requestRouteRefresh(*self.family)
+        self.worker.requestRouteRefresh(*self.family)
+        event = self.worker._dequeue()
+        self.assertTrue(isinstance(event, SendRouteRefresh))
+        # a single request while one is pending
+        self.assertTrue(self.worker._queue.empty())
+
+        self.worker._onEvent(event)
+        messages = self._sent()
+        self.assertEqual([(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn),
+                           RouteRefresh.REQUEST)],
+                         [(message.afi, message.safi, message.subtype)
+                          for message in messages])
+
+        # not supported by the peer
+        self.worker._routeRefresh = False
+        self.worker.requestRouteRefresh(*self.family)
+        self.worker._onEvent(self.worker._dequeue())
+        self.assertEqual([], self._sent())
+
+    def test_route_refresh_purged(self):
+        self.worker.timerWheel = mock.Mock()
+        self.worker.requestRouteRefresh(*self.family)
+        # the session goes down before the request is sent
+        self.worker.enqueue(ReInit)
+        self.assertEqual(ReInit, self.worker._dequeue())
+        self.worker._onEvent(ReInit)
+        self.assertTrue(self.worker._queue.empty())
+
+        # a request for the next session is not taken as already pending
+        self.worker.requestRouteRefresh(*self.family)
+        self.assertFalse(self.worker._queue.empty())
+        self.assertTrue(isinstance(self.worker._dequeue(), SendRouteRefresh))
+
@@ -0,0 +1,110 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+.. module:: test_flow_control
+   :synopsis: module that defines several test cases for the flow_control
+   module.
+"""
+
+import mock
+
+from testtools import TestCase
+
+from bagpipe.bgp.engine.flow_control import FlowControl
+from bagpipe.bgp.engine.worker import LanesQueue
+
+
+class Component(object):
+
+    def __init__(self, name):
+        self.name = name
+        self._queue = LanesQueue(2, 1)
+
+
+class TestFlowControl(TestCase):
+
+    def setUp(self):
+        super(TestFlowControl, self).setUp()
+        self.flowControl = FlowControl(highWatermark=4, lowWatermark=2)
+        self.listener = mock.Mock()
+        self.flowControl.addListener(self.listener)
+        self.componentA = Component("A")
+        self.componentB = Component("B")
+        self.flowControl.watch(self.componentA)
+        self.flowControl.watch(self.componentB)
+
+    def _put(self, component, count):
+        for _ in range(count):
+            component._queue.put("event")
+
+    def _get(self, component, count):
+        for _ in range(count):
+            component._queue.get()
+
+    def _calls(self):
+        return [args[0] for (args, _) in self.listener.call_args_list]
+
+    def testA1_Hysteresis(self):
+        self._put(self.componentA, 3)
+        self.assertFalse(self.flowControl.isCongested())
+        self._put(self.componentA, 1)
+        self.assertTrue(self.flowControl.isCongested())
+        self.assertEqual([True], self._calls())
+
+        # still congested between the watermarks
+        self._get(self.componentA, 1)
+        self.assertTrue(self.flowControl.isCongested())
+        self._get(self.componentA, 1)
+        self.assertFalse(self.flowControl.isCongested())
+        self.assertEqual([True, False], self._calls())
+
+        stats = self.componentA._queue.getWatermarks().getStats()
+        self.assertEqual(4, stats["max_length"])
+        self.assertEqual(1, stats["high_watermark_crossings"])
+        self.assertFalse(stats["congested"])
+
+    def testA2_CongestedWhileAnyQueueIs(self):
+        self._put(self.componentA, 4)
+        self._put(self.componentB, 4)
+        self._get(self.componentA, 4)
+        self.assertTrue(self.flowControl.isCongested())
+        self.assertEqual(["B"],
+                         self.flowControl.getStats()["congested_queues"])
+        self._get(self.componentB, 4)
+        self.assertFalse(self.flowControl.isCongested())
+        # listeners only see the transitions of the queues as a whole
+        self.assertEqual([True, False], self._calls())
+        self.assertEqual(1, self.flowControl.getStats()["stalls"])
+
+    def testA3_Release(self):
+        self._put(self.componentA, 4)
+        self.componentA._queue.purge(1)
+        self.assertFalse(self.flowControl.isCongested())
+
+        self._put(self.componentA, 4)
+        self.assertTrue(self.flowControl.isCongested())
+        # e.g. a worker being stopped with events left in its queue
+        self.componentA._queue.setWatermarks(None)
+        self.assertFalse(self.flowControl.isCongested())
+        self.assertEqual([True, False, True, False], self._calls())
+
+    def testA4_Disabled(self):
+        self.flowControl.setWatermarks(0, 0)
+        self._put(self.componentA, 100)
+        self.assertFalse(self.flowControl.isCongested())
+        self.assertRaises(Exception, self.flowControl.setWatermarks, 2, 4)
@@ -0,0 +1,118 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+.. module:: test_reactor
+   :synopsis: module that defines several test cases for the reactor module.
+"""
+
+import socket
+
+import threading
+
+import time
+
+from testtools import TestCase
+
+from bagpipe.bgp.common.reactor import Reactor, _SelectPoller
+
+WAIT_TIME = 0.1
+
+
+class RecordingHandler(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = []
+        self.writableCount = 0
+        self.threads = set()
+
+    def onReadable(self):
+        self.threads.add(threading.currentThread())
+        data = self.sock.recv(4096)
+        if data:
+            self.received.append(data)
+
+    def onWritable(self):
+        self.threads.add(threading.currentThread())
+        self.writableCount += 1
+
+
+class TestReactor(TestCase):
+
+    def setUp(self):
+        super(TestReactor, self).setUp()
+        self.reactor = Reactor()
+        self.reactor.start()
+        self.addCleanup(self.reactor.stop)
+
+        (self.ours, self.theirs) = socket.socketpair()
+        self.addCleanup(self.ours.close)
+        self.addCleanup(self.theirs.close)
+        self.handler = RecordingHandler(self.ours)
+
+    def testA1_Readable(self):
+        self.reactor.register(self.ours.fileno(), self.handler)
+        self.theirs.sendall("foo")
+        time.sleep(WAIT_TIME)
+        self.theirs.sendall("bar")
+        time.sleep(WAIT_TIME)
+
+        self.assertEqual(["foo", "bar"], self.handler.received)
+        self.assertEqual(0, self.handler.writableCount)
+        self.assertEqual(set([self.reactor._thread]), self.handler.threads)
+
+    def testA2_ModifyAndUnregister(self):
+        self.reactor.register(self.ours.fileno(), self.handler, read=True,
+                              write=True)
+        time.sleep(WAIT_TIME)
+        self.assertTrue(self.handler.writableCount > 0)
+
+        self.reactor.modify(self.ours.fileno(), self.handler, read=True)
+        time.sleep(WAIT_TIME)
+        writableCount = self.handler.writableCount
+        time.sleep(WAIT_TIME)
+        self.assertEqual(writableCount, self.handler.writableCount)
+
+        # unregistering another handler does nothing
+        self.reactor.unregister(self.ours.fileno(),
+                                RecordingHandler(self.ours))
+        self.theirs.sendall("foo")
+        time.sleep(WAIT_TIME)
+        self.assertEqual(["foo"], self.handler.received)
+
+        self.reactor.unregister(self.ours.fileno(), self.handler)
+        self.theirs.sendall("bar")
+        time.sleep(WAIT_TIME)
+        self.assertEqual(["foo"], self.handler.received)
+        self.assertEqual(0, self.reactor.getStats()["handlers"])
+
+    def testA3_CallLater(self):
+        called = []
+        self.reactor.callLater(0.05, lambda: called.append(
+            threading.currentThread()))
+        time.sleep(0.3)
+        self.assertEqual([self.reactor._thread], called)
+
+    def testB1_SelectPoller(self):
+        poller = _SelectPoller()
+        poller.register(self.ours.fileno(), True, True)
+        self.assertEqual([(self.ours.fileno(), False, True)], poller.poll())
+        self.theirs.sendall("foo")
+        self.assertEqual([(self.ours.fileno(), True, True)], poller.poll())
+        poller.modify(self.ours.fileno(), True, False)
+        self.assertEqual([(self.ours.fileno(), True, False)], poller.poll())
@@ -60,6 +60,8 @@
 
 import logging
 
+import weakref
+
 import mock
 
 from testtools import TestCase
@@ -74,11 +76,14 @@ from bagpipe.bgp.engine import Unsubscription
 from bagpipe.bgp.engine.worker import Worker
 from bagpipe.bgp.engine.bgp_peer_worker import BGPPeerWorker
 from bagpipe.bgp.engine.route_table_manager import RouteTableManager
-from bagpipe.bgp.engine.route_table_manager import Match
+from bagpipe.bgp.engine.route_table_manager import ShardedRouteTableManager
+from bagpipe.bgp.engine.route_table_manager import Match, matchKey
 from bagpipe.bgp.engine.route_table_manager import WorkerCleanupEvent
+from bagpipe.bgp.engine.route_table_manager import StopEvent
 
 from bagpipe.exabgp.message.update.attributes import Attributes
 from bagpipe.exabgp.structure.address import AFI, SAFI
+from bagpipe.exabgp.message.update.attribute.communities import RouteTarget
 
 log = logging.getLogger()
 
@@ -524,6 +529,28 @@ class TestRouteTableManager(TestCase, BaseTestBagPipeBGP):
         self._checkNoRouteEntry(bgpPeerWorker1, evt1.routeEntry)
         self._checkNoRouteEntry(bgpPeerWorker1, evt2.routeEntry)
 
+    def testD2_WorkerCleanupThenNewWorker(self):
+        # BGPPeerWorker1 subscribes to RT1, then is cleaned up
+        bgpPeerWorker1 = self._newworker("BGPWorker1", BGPPeerWorker)
+        self._workerSubscriptions(bgpPeerWorker1, [RT1])
+        self.routeTableManager.enqueue(WorkerCleanupEvent(bgpPeerWorker1))
+        # Worker1 subscribes to RT1 (and may be dispatched events using
+        # the same internal resources as BGPPeerWorker1)
+        worker1 = self._newworker("Worker-1", Worker)
+        self._workerSubscriptions(worker1, [RT1])
+        # BGPPeerWorker2 advertises a route for RT1
+        bgpPeerWorker2 = self._newworker("BGPWorker2", BGPPeerWorker)
+        evt1 = self._newRouteEvent(RouteEvent.ADVERTISE, NLRI1, [RT1],
+                                   bgpPeerWorker2, NH1)
+        self._wait()
+        # the route is dispatched to Worker1 but not to BGPPeerWorker1
+        self.assertEqual(0, bgpPeerWorker1.enqueue.call_count,
+                         "no route should be dispatched to BGPPeerWorker1")
+        self.assertEqual(1, worker1.enqueue.call_count,
+                         "1 route should be dispatched to Worker1")
+        self._checkEventsCalls(worker1.enqueue.call_args_list,
+                               [evt1.routeEntry], [])
+
     def testE1_DumpState(self):
         # BGPPeerWorker1 advertises a route for RT1 and RT2
         bgpPeerWorker1 = self._newworker("BGPWorker1", BGPPeerWorker)
@@ -571,3 +598,162 @@ class TestRouteTableManager(TestCase, BaseTestBagPipeBGP):
 
         self.assertEqual(1, w1.enqueue.call_count,
                          "1 route advertised should be synthesized to Worker1")
+
+
+class TestShardedRouteTableManager(TestRouteTableManager):
+
+    """Same tests as TestRouteTableManager, with routes split between 3
+    RouteTableManager shards"""
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.routeTableManager = ShardedRouteTableManager(3)
+        self.routeTableManager.start()
+        self.setEventTargetWorker(self.routeTableManager)
+
+
+class TestRouteTableManagerBatches(TestCase, BaseTestBagPipeBGP):
+
+    """Tests of the coalescing of route events processed in a same batch:
+    events are queued before the RouteTableManager main loop is run, and
+    this loop stops at the end of the batch"""
+
+    def setUp(self):
+        super(TestRouteTableManagerBatches, self).setUp()
+        self.routeTableManager = RouteTableManager()
+        self.setEventTargetWorker(self.routeTableManager)
+
+        self.worker1 = mock.Mock(spec=Worker)
+        self.worker1.name = "Worker-1"
+        self.bgpPeerWorker1 = mock.Mock(spec=BGPPeerWorker)
+        self.bgpPeerWorker1.name = "BGPWorker1"
+
+        self.routeTableManager.enqueue(
+            Subscription(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), RT1,
+                         self.worker1))
+
+    def _wait(self):
+        pass
+
+    def _runBatch(self):
+        self.routeTableManager.enqueue(StopEvent)
+        self.routeTableManager.run()
+
+    def _dispatchedEvents(self):
+        return [callArgs[0]
+                for (callArgs, _) in self.worker1.enqueue.call_args_list]
+
+    def testA1_AdvertiseWithdraw(self):
+        self._newRouteEvent(RouteEvent.ADVERTISE, NLRI1, [RT1],
+                            self.bgpPeerWorker1, NH1)
+        self._newRouteEvent(RouteEvent.WITHDRAW, NLRI1, [RT1],
+                            self.bgpPeerWorker1, NH1)
+        self._runBatch()
+
+        self.assertEqual([], self._dispatchedEvents())
+        self.assertEqual(
+            [], self.routeTableManager.getWorkerRouteEntries(
+                self.bgpPeerWorker1))
+        self.assertEqual(2, self.routeTableManager._coalescedEventCount)
+
+    def testA2_AdvertiseTwice(self):
+        self._newRouteEvent(RouteEvent.ADVERTISE, NLRI1, [RT1],
+                            self.bgpPeerWorker1, NH1)
+        evt2 = self._newRouteEvent(RouteEvent.ADVERTISE, NLRI1, [RT1],
+                                   self.bgpPeerWorker1, NH2)
+        evt3 = self._newRouteEvent(RouteEvent.ADVERTISE, NLRI2, [RT1],
+                                   self.bgpPeerWorker1, NH1)
+        self._runBatch()
+
+        self.assertEqual([evt2, evt3], self._dispatchedEvents())
+        self.assertEqual(1, self.routeTableManager._coalescedEventCount)
+
+    def testA3_WithdrawAdvertise(self):
+        evt1 = self._newRouteEvent(RouteEvent.ADVERTISE, NLRI1, [RT1],
+                                   self.bgpPeerWorker1, NH1)
+        self._runBatch()
+        self.assertEqual([evt1], self._dispatchedEvents())
+
+        self._newRouteEvent(RouteEvent.WITHDRAW, NLRI1, [RT1],
+                            self.bgpPeerWorker1, NH1)
+        evt3 = self._newRouteEvent(RouteEvent.ADVERTISE, NLRI1, [RT1],
+                                   self.bgpPeerWorker1, NH2)
+        self._runBatch()
+
+        # the new route replaces the first one, no withdraw is needed
+        self.assertEqual([evt1, evt3], self._dispatchedEvents())
+        self.assertEqual(evt1.routeEntry, evt3.replacedRoute)
+
+    def testA4_AdvertiseThenWithdrawKnownRoute(self):
+        evt1 = self._newRouteEvent(RouteEvent.ADVERTISE, NLRI1, [RT1],
+                                   self.bgpPeerWorker1, NH1)
+        self._runBatch()
+
+        self._newRouteEvent(RouteEvent.ADVERTISE, NLRI1, [RT1],
+                            self.bgpPeerWorker1, NH2)
+        self._newRouteEvent(RouteEvent.WITHDRAW, NLRI1, [RT1],
+                            self.bgpPeerWorker1, NH2)
+        self._runBatch()
+
+        events = self._dispatchedEvents()
+        self.assertEqual(2, len(events))
+        self.assertEqual(RouteEvent.WITHDRAW, events[1].type)
+        self.assertEqual(evt1.routeEntry, events[1].routeEntry)
+
+    def testB1_SubscriptionIsABarrier(self):
+        worker2 = mock.Mock(spec=Worker)
+        worker2.name = "Worker-2"
+
+        self._newRouteEvent(RouteEvent.ADVERTISE, NLRI1, [RT1],
+                            self.bgpPeerWorker1, NH1)
+        self.routeTableManager.enqueue(
+            Subscription(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), RT1, worker2))
+        self._newRouteEvent(RouteEvent.WITHDRAW, NLRI1, [RT1],
+                            self.bgpPeerWorker1, NH1)
+        self._runBatch()
+
+        # worker2 has seen the route advertised then withdrawn
+        self.assertEqual(2, worker2.enqueue.call_count)
+        self.assertEqual(2, len(self._dispatchedEvents()))
+
+    def testC1_IdenticalAttributesAreShared(self):
+        evt1 = self._newRouteEvent(RouteEvent.ADVERTISE, NLRI1, [RT1, RT2],
+                                   self.bgpPeerWorker1, NH1)
+        evt2 = self._newRouteEvent(RouteEvent.ADVERTISE, NLRI2, [RT1, RT2],
+                                   self.bgpPeerWorker1, NH1)
+        evt3 = self._newRouteEvent(RouteEvent.ADVERTISE, NLRI2, [RT1],
+                                   self.worker1, NH2)
+        self._runBatch()
+
+        (entry1, entry2, entry3) = [evt.routeEntry
+                                    for evt in (evt1, evt2, evt3)]
+        self.assertIs(entry1.attributes, entry2.attributes)
+        self.assertIs(entry1.routeTargets, entry2.routeTargets)
+        self.assertEqual([RT1, RT2], entry1.routeTargets)
+        self.assertIsNot(entry1.attributes, entry3.attributes)
+        self.assertIsNot(entry1.routeTargets, entry3.routeTargets)
+
+        stats = self.routeTableManager.getLookingGlassLocalInfo("")[
+            "interned"]
+        self.assertEqual(2, stats["attributes"]["values"])
+        self.assertEqual(1, stats["attributes"]["hits"])
+        self.assertEqual(2, stats["route_targets"]["values"])
+
+
+class TestMatchKey(TestCase):
+
+    def testA1_Interned(self):
+        rt = RouteTarget(64512, None, 4242)
+        key = matchKey(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), rt)
+        self.assertTrue(key is matchKey(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn),
+                                        RouteTarget(64512, None, 4242)))
+        self.assertEqual((AFI.ipv4, SAFI.mpls_vpn, rt.community), key.values)
+
+    def testA2_Forgotten(self):
+        key = matchKey(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn),
+                       RouteTarget(64512, None, 4343))
+        ref = weakref.ref(key)
+        del key
+        # no subscription or route uses the key anymore
+        self.assertTrue(ref() is None)
+
@@ -0,0 +1,83 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+.. module:: test_timer_wheel
+   :synopsis: module that defines several test cases for the timer_wheel
+   module.
+"""
+
+import time
+
+from testtools import TestCase
+
+from bagpipe.bgp.common.timer_wheel import TimerWheel
+
+
+class TestTimerWheel(TestCase):
+
+    def setUp(self):
+        super(TestTimerWheel, self).setUp()
+        # a small wheel, so that timers needing more than one round of the
+        # wheel are tested
+        self.wheel = TimerWheel(tick=0.01, slotCount=8)
+        self.wheel.start()
+        self.fired = []
+
+    def tearDown(self):
+        super(TestTimerWheel, self).tearDown()
+        self.wheel.stop()
+
+    def _callback(self, name):
+        self.fired.append((name, time.time()))
+
+    def testA1_TimersFireInOrder(self):
+        start = time.time()
+        self.wheel.schedule(0.2, self._callback, "C")
+        self.wheel.schedule(0.02, self._callback, "A")
+        self.wheel.schedule(0.1, self._callback, "B")
+        time.sleep(0.3)
+
+        self.assertEqual(["A", "B", "C"], [name for (name, _) in self.fired])
+        for ((_, firedTime), delay) in zip(self.fired, [0.02, 0.1, 0.2]):
+            self.assertGreaterEqual(firedTime, start + delay)
+        stats = self.wheel.getStats()
+        self.assertEqual(3, stats["fired_timers"])
+        self.assertEqual(0, stats["pending_timers"])
+        self.assertLess(stats["max_lag"], 0.1)
+
+    def testA2_Cancel(self):
+        timerA = self.wheel.schedule(0.05, self._callback, "A")
+        self.wheel.schedule(0.05, self._callback, "B")
+        timerA.cancel()
+        time.sleep(0.15)
+        # cancelling an expired timer does nothing
+        timerA.cancel()
+
+        self.assertEqual(["B"], [name for (name, _) in self.fired])
+        stats = self.wheel.getStats()
+        self.assertEqual(1, stats["cancelled_timers"])
+        self.assertEqual(0, stats["pending_timers"])
+
+    def testA3_CallbackException(self):
+        def failingCallback():
+            raise Exception("failure")
+        self.wheel.schedule(0.02, failingCallback)
+        self.wheel.schedule(0.03, self._callback, "A")
+        time.sleep(0.1)
+
+        self.assertEqual(["A"], [name for (name, _) in self.fired])
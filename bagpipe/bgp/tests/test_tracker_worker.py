@@ -43,6 +43,8 @@
 """
 import mock
 
+import time
+
 from copy import copy
 
 from testtools import TestCase
@@ -50,10 +52,14 @@ from threading import Thread
 
 from bagpipe.bgp.tests import BaseTestBagPipeBGP, RT1, RT2, NLRI1, NLRI2, \
     NH1, NH2, NH3, NBR, BRR
-from bagpipe.bgp.engine import RouteEvent
+from bagpipe.bgp.engine import RouteEvent, RouteEntry
 from bagpipe.bgp.engine.worker import Worker
-from bagpipe.bgp.engine.tracker_worker import TrackerWorker
+from bagpipe.bgp.engine.tracker_worker import TrackerWorker, TrackedRoutes, \
+    BestRoutes, filteredRouteEntry, compareECMP, compareNoECMP
+from bagpipe.exabgp.structure.address import AFI, SAFI
 from bagpipe.exabgp.message.update.attribute import AttributeID
+from bagpipe.exabgp.message.update.attributes import Attributes
+from bagpipe.exabgp.message.update.attribute.nexthop import NextHop
 
 import logging
 
@@ -136,6 +142,15 @@ class TestTrackerWorker(TestCase, BaseTestBagPipeBGP):
             if len(expected) >= 3:
                 self.assertEquals(expected[2], callArgs[2], 'wrong last flag')
 
+    def _checkCallsAnyOrder(self, call_args_list, expected_list):
+        def key(routeEntry):
+            return routeEntry.attributes[AttributeID.NEXT_HOP].next_hop.ip
+
+        self.assertEqual(len(expected_list), len(call_args_list))
+        self._checkCalls(
+            sorted(call_args_list, key=lambda call: key(call[0][1])),
+            sorted(expected_list, key=lambda expected: key(expected[1])))
+
     def _callList(self, method):
         def side_effect(*args, **kwargs):
             self._append_call(method)
@@ -759,14 +774,246 @@ class TestTrackerWorker(TestCase, BaseTestBagPipeBGP):
         expectedCalls = ["RE1", NBR, "RE2", "RE3", "RE4", NBR, NBR, NBR, BRR]
         self.assertEqual(expectedCalls, self._calls, 'Wrong call sequence')
 
-        self._checkCalls(self.trackerWorker._newBestRoute.call_args_list,
-                         [(NLRI1, route1.routeEntry),
-                          (NLRI1, route2.routeEntry),
-                             (NLRI1, route3.routeEntry),
-                             (NLRI1, route4.routeEntry)])
-        # FIXME: the order of route2, route3, route4 is not important in the
-        # test above, we should test independently of the order
+        callArgsList = self.trackerWorker._newBestRoute.call_args_list
+        self._checkCalls(callArgsList[:1], [(NLRI1, route1.routeEntry)])
+        # the order of route2, route3, route4 is not important
+        self._checkCallsAnyOrder(callArgsList[1:],
+                                 [(NLRI1, route2.routeEntry),
+                                  (NLRI1, route3.routeEntry),
+                                  (NLRI1, route4.routeEntry)])
 
         self._checkCalls(
             self.trackerWorker._bestRouteRemoved.call_args_list,
             [(NLRI1, route1.routeEntry, False)])
+
+    def testF1_CoalescedCalls(self):
+        # Calls for a same entry within the coalescing window are merged
+        self.trackerWorker._coalescingWindow = 0.5
+        self.trackerWorker._newBestRoute = mock.Mock()
+        self.trackerWorker._bestRouteRemoved = mock.Mock()
+
+        workerA = Worker('BGPManager', 'Worker-A')
+        # A route for NLRI1 advertised and withdrawn, and a route for NLRI2
+        self._newRouteEvent(
+            RouteEvent.ADVERTISE, NLRI1, [RT1, RT2], workerA, NH1, 100)
+        self._newRouteEvent(
+            RouteEvent.WITHDRAW, NLRI1, [RT1, RT2], workerA, NH1, 100)
+        routeNlri2A = self._newRouteEvent(
+            RouteEvent.ADVERTISE, NLRI2, [RT1, RT2], workerA, NH1, 100)
+
+        self.assertEqual(0, self.trackerWorker._newBestRoute.call_count)
+        time.sleep(0.6)
+
+        self._checkCalls(self.trackerWorker._newBestRoute.call_args_list,
+                         [(NLRI2, routeNlri2A.routeEntry)])
+        self.assertEqual(1, self.trackerWorker._newBestRoute.call_count)
+        self.assertEqual(0, self.trackerWorker._bestRouteRemoved.call_count)
+        self.assertEqual(2, self.trackerWorker._coalescedCallCount)
+
+        # The route for NLRI2 flaps
+        self._newRouteEvent(
+            RouteEvent.WITHDRAW, NLRI2, [RT1, RT2], workerA, NH1, 100)
+        self._newRouteEvent(
+            RouteEvent.ADVERTISE, NLRI2, [RT1, RT2], workerA, NH1, 100)
+        time.sleep(0.6)
+
+        self.assertEqual(1, self.trackerWorker._newBestRoute.call_count)
+        self.assertEqual(0, self.trackerWorker._bestRouteRemoved.call_count)
+        self.assertEqual(4, self.trackerWorker._coalescedCallCount)
+
+        # The route for NLRI2 is withdrawn
+        self._newRouteEvent(
+            RouteEvent.WITHDRAW, NLRI2, [RT1, RT2], workerA, NH1, 100)
+        time.sleep(0.6)
+
+        self._checkCalls(
+            self.trackerWorker._bestRouteRemoved.call_args_list,
+            [(NLRI2, routeNlri2A.routeEntry, True)])
+
+    def testG1_NextHopDown(self):
+        # All routes with a given next hop are dropped at once
+        self.trackerWorker._newBestRoute = mock.Mock()
+        self.trackerWorker._bestRouteRemoved = mock.Mock()
+
+        workerA = Worker('BGPManager', 'Worker-A')
+        workerB = Worker('BGPManager', 'Worker-B')
+        routeNlri1A = self._newRouteEvent(
+            RouteEvent.ADVERTISE, NLRI1, [RT1, RT2], workerA, NH1, 200)
+        routeNlri1B = self._newRouteEvent(
+            RouteEvent.ADVERTISE, NLRI1, [RT1, RT2], workerB, NH2, 100)
+        routeNlri2A = self._newRouteEvent(
+            RouteEvent.ADVERTISE, NLRI2, [RT1, RT2], workerA, NH1, 100)
+
+        self.trackerWorker.nextHopDown(NH1.ip)
+        self._wait()
+
+        self._checkCalls(self.trackerWorker._newBestRoute.call_args_list,
+                         [(NLRI1, routeNlri1A.routeEntry),
+                          (NLRI2, routeNlri2A.routeEntry),
+                          (NLRI1, routeNlri1B.routeEntry)])
+        self.assertEqual(3, self.trackerWorker._newBestRoute.call_count)
+        self.assertEqual(2, self.trackerWorker._bestRouteRemoved.call_count)
+        self._checkCalls(
+            sorted(self.trackerWorker._bestRouteRemoved.call_args_list,
+                   key=lambda call: call[0][2]),
+            [(NLRI1, routeNlri1A.routeEntry, False),
+             (NLRI2, routeNlri2A.routeEntry, True)])
+        self.assertNotIn(NLRI2, self.trackerWorker.trackedEntry2routes)
+
+        # Withdraws for the routes dropped are ignored
+        self._newRouteEvent(
+            RouteEvent.WITHDRAW, NLRI1, [RT1, RT2], workerA, NH1, 200)
+        self.assertEqual(2, self.trackerWorker._bestRouteRemoved.call_count)
+        self.assertEqual(set([routeNlri1B.routeEntry]),
+                         self.trackerWorker.getBestRoutesForTrackedEntry(
+                             NLRI1))
+        self.assertIn(NH1.ip, self.trackerWorker._downNextHops)
+
+        # no entry is created for the withdraw of a route dropped
+        self._newRouteEvent(
+            RouteEvent.WITHDRAW, NLRI2, [RT1, RT2], workerA, NH1, 100)
+        self.assertEqual(2, self.trackerWorker._bestRouteRemoved.call_count)
+        self.assertNotIn(NLRI2, self.trackerWorker.trackedEntry2routes)
+        # all the routes dropped have been withdrawn
+        self.assertEqual({}, self.trackerWorker._downNextHops)
+
+    def testG2_NextHopDownReplace(self):
+        # A route dropped because its next hop is down is then replaced by
+        # its source
+        self.trackerWorker._newBestRoute = mock.Mock()
+        self.trackerWorker._bestRouteRemoved = mock.Mock()
+
+        workerA = Worker('BGPManager', 'Worker-A')
+        workerB = Worker('BGPManager', 'Worker-B')
+        routeNlri1A = self._newRouteEvent(
+            RouteEvent.ADVERTISE, NLRI1, [RT1, RT2], workerA, NH1, 200)
+        routeNlri1B = self._newRouteEvent(
+            RouteEvent.ADVERTISE, NLRI1, [RT1, RT2], workerB, NH2, 100)
+
+        self.trackerWorker.nextHopDown(NH1.ip)
+        self._wait()
+        self.assertEqual(1, self.trackerWorker._bestRouteRemoved.call_count)
+
+        with mock.patch.object(self.trackerWorker.log, 'error') as error:
+            routeNlri1A2 = self._newRouteEvent(
+                RouteEvent.ADVERTISE, NLRI1, [RT1, RT2], workerA, NH3, 200,
+                routeNlri1A.routeEntry)
+            self.assertFalse(error.called)
+
+        self._checkCalls(self.trackerWorker._newBestRoute.call_args_list,
+                         [(NLRI1, routeNlri1A.routeEntry),
+                          (NLRI1, routeNlri1B.routeEntry),
+                          (NLRI1, routeNlri1A2.routeEntry)])
+        self.assertEqual(set([routeNlri1A2.routeEntry]),
+                         self.trackerWorker.getBestRoutesForTrackedEntry(
+                             NLRI1))
+        self.assertEqual({}, self.trackerWorker._downNextHops)
+
+
+class TestTrackedRoutes(TestCase):
+
+    def setUp(self):
+        super(TestTrackedRoutes, self).setUp()
+        # routes are (name, preference) tuples, the highest preference is the
+        # best
+        self.routes = TrackedRoutes(lambda route: route[1])
+
+    def test_best_routes(self):
+        self.assertEqual([], self.routes.bestRoutes())
+        for route in [("A", 100), ("B", 300), ("C", 200), ("D", 300)]:
+            self.routes.add(route)
+
+        self.assertEqual(4, len(self.routes))
+        self.assertEqual(set([("B", 300), ("D", 300)]),
+                         set(self.routes.bestRoutes()))
+        self.assertEqual([300, 300, 200, 100],
+                         [route[1] for route in self.routes])
+
+    def test_remove(self):
+        for route in [("A", 100), ("B", 300), ("C", 300)]:
+            self.routes.add(route)
+
+        self.assertEqual(("B", 300), self.routes.remove(("B", 300)))
+        self.assertEqual([("C", 300)], self.routes.bestRoutes())
+        self.routes.remove(("C", 300))
+        self.assertEqual([("A", 100)], self.routes.bestRoutes())
+        self.assertRaises(ValueError, self.routes.remove, ("C", 300))
+
+    def test_remove_ties(self):
+        # many routes with the same sort key, as with ECMP
+        ties = [("R%d" % index, 300) for index in range(10)]
+        for route in [("A", 100)] + ties + [("B", 200)]:
+            self.routes.add(route)
+
+        self.assertEqual(ties[5], self.routes.remove(ties[5]))
+        self.assertEqual(ties[:5] + ties[6:], self.routes.bestRoutes())
+        for route in ties[:5] + ties[6:]:
+            self.routes.remove(route)
+        self.assertEqual([("B", 200)], self.routes.bestRoutes())
+
+        self.routes.add(("C", 200))
+        self.assertEqual([("B", 200), ("C", 200)], self.routes.bestRoutes())
+        self.routes.add(("D", 400))
+        self.assertEqual([("D", 400)], self.routes.bestRoutes())
+        self.routes.remove(("D", 400))
+        self.assertEqual([("B", 200), ("C", 200)], self.routes.bestRoutes())
+        self.routes.remove(("A", 100))
+        self.assertEqual([("C", 200), ("B", 200)], list(self.routes))
+
+    def test_add_twice(self):
+        self.routes.add(("A", 100))
+        self.routes.add(("A", 100))
+        self.assertEqual([("A", 100)], list(self.routes))
+
+    def test_compare_routes_sort_key(self):
+        worker = mock.Mock()
+        worker.name = "worker"
+        attributes = Attributes()
+        attributes.add(NextHop(NH1))
+        routeA = RouteEntry(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), [RT1], NLRI1,
+                            attributes, "A")
+        routeB = RouteEntry(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), [RT1], NLRI1,
+                            attributes, "B")
+
+        sortKey = compareNoECMP.sortKeyFactory(worker)
+        self.assertEqual(sortKey(routeA), sortKey(routeA))
+        self.assertNotEqual(sortKey(routeA), sortKey(routeB))
+        self.assertEqual(cmp(sortKey(routeA), sortKey(routeB)),
+                         compareNoECMP(worker, routeA, routeB))
+
+        sortKey = compareECMP.sortKeyFactory(worker)
+        self.assertEqual(sortKey(routeA), sortKey(routeB))
+
+
+class TestBestRoutes(TestCase):
+
+    def _route(self, source, nh):
+        attributes = Attributes()
+        attributes.add(NextHop(nh))
+        return RouteEntry(AFI(AFI.ipv4), SAFI(SAFI.mpls_vpn), [RT1], NLRI1,
+                          attributes, source)
+
+    def test_filtered_routes(self):
+        routeA = self._route("A", NH1)
+        routeB = self._route("B", NH1)
+        routeC = self._route("C", NH2)
+        self.assertIs(filteredRouteEntry(routeA), filteredRouteEntry(routeA))
+
+        bestRoutes = BestRoutes([routeA, routeB])
+        # the source is not part of the filtered view of a route
+        self.assertTrue(bestRoutes.hasFilteredRoute(
+            filteredRouteEntry(self._route("D", NH1))))
+        self.assertFalse(bestRoutes.hasFilteredRoute(
+            filteredRouteEntry(routeC)))
+
+        bestRoutes.remove(routeA)
+        self.assertTrue(bestRoutes.hasFilteredRoute(
+            filteredRouteEntry(routeA)))
+        bestRoutes.remove(routeB)
+        self.assertFalse(bestRoutes.hasFilteredRoute(
+            filteredRouteEntry(routeA)))
+
+        bestRoutes.update([routeA, routeC])
+        bestRoutes.clear()
+        self.assertFalse(bestRoutes.hasFilteredRoute(
+            filteredRouteEntry(routeC)))
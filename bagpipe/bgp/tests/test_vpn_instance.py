@@ -92,6 +92,7 @@ class TestVPNInstance(TestCase):
         self.mockDataplane.vifUnplugged = mock.Mock()
 
         self.mockDPDriver = mock.Mock()
+        self.mockDPDriver.coalescingWindow = 0
         self.mockDPDriver.initializeDataplaneInstance.returnValue = \
             self.mockDataplane
 
@@ -0,0 +1,154 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# encoding: utf-8
+
+# Copyright 2014 Orange
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+.. module:: test_worker
+   :synopsis: module that defines several test cases for the worker module.
+   In particular, unit tests for the LanesQueue class used for the event
+   queues of workers, and for the WorkerScheduler running workers on a pool
+   of threads.
+"""
+
+import mock
+
+import time
+
+from Queue import Empty
+
+from threading import Lock
+
+from testtools import TestCase
+
+from bagpipe.bgp.engine.worker import LanesQueue, Worker
+from bagpipe.bgp.engine.worker_scheduler import WorkerScheduler
+
+
+class TestLanesQueue(TestCase):
+
+    def setUp(self):
+        super(TestLanesQueue, self).setUp()
+        self.queue = LanesQueue(2, 1)
+
+    def testA1_FIFOInALane(self):
+        for item in range(5):
+            self.queue.put(item)
+        self.assertEqual(5, self.queue.qsize())
+        self.assertEqual([0, 1, 2, 3, 4],
+                         [self.queue.get() for _ in range(5)])
+        self.assertTrue(self.queue.empty())
+
+    def testA2_StrictPriority(self):
+        self.queue.put("route1")
+        self.queue.put("route2")
+        self.queue.put("control1", 0)
+        self.queue.put("route3")
+        self.queue.put("control2", 0)
+        self.assertEqual([2, 3], self.queue.laneSizes())
+        self.assertEqual(["control1", "control2", "route1", "route2",
+                          "route3"],
+                         [self.queue.get() for _ in range(5)])
+
+    def testA3_GetEmpty(self):
+        self.assertRaises(Empty, self.queue.get_nowait)
+        self.assertRaises(Empty, self.queue.get, True, 0.01)
+
+    def testA4_Purge(self):
+        self.queue.put("route1")
+        self.queue.put("control1", 0)
+        self.queue.put("route2")
+        self.assertEqual(2, self.queue.purge(1))
+        self.assertEqual(1, self.queue.qsize())
+        self.assertEqual("control1", self.queue.get())
+        self.assertTrue(self.queue.empty())
+
+
+class RecordingWorker(Worker):
+
+    def __init__(self, name, record, recordLock):
+        Worker.__init__(self, mock.Mock(), name)
+        self.record = record
+        self.recordLock = recordLock
+
+    def _onEvent(self, event):
+        with self.recordLock:
+            self.record.append((self.name, event))
+
+
+class TestWorkerScheduler(TestCase):
+
+    def setUp(self):
+        super(TestWorkerScheduler, self).setUp()
+        self.scheduler = WorkerScheduler(2, sliceMaxEvents=5)
+        self.scheduler.start()
+        self.record = []
+        self.recordLock = Lock()
+
+    def tearDown(self):
+        super(TestWorkerScheduler, self).tearDown()
+        self.scheduler.stop()
+
+    def _worker(self, name):
+        worker = RecordingWorker(name, self.record, self.recordLock)
+        self.scheduler.schedule(worker)
+        return worker
+
+    def _eventsOf(self, name):
+        return [event for (workerName, event) in self.record
+                if workerName == name]
+
+    def testA1_OrderPerWorker(self):
+        workers = [self._worker("W%d" % index) for index in range(4)]
+        for event in range(100):
+            for worker in workers:
+                worker.enqueue(event)
+        time.sleep(0.2)
+
+        for worker in workers:
+            self.assertEqual(range(100), self._eventsOf(worker.name))
+        self.assertEqual(400, self.scheduler.getStats()["events"])
+
+    def testA2_FairSlices(self):
+        scheduler = WorkerScheduler(1, sliceMaxEvents=5)
+        busy = RecordingWorker("busy", self.record, self.recordLock)
+        for event in range(20):
+            busy.enqueue(event)
+        other = RecordingWorker("other", self.record, self.recordLock)
+        other.enqueue("x")
+        scheduler.schedule(busy)
+        scheduler.schedule(other)
+        scheduler.start()
+        time.sleep(0.2)
+        scheduler.stop()
+
+        # the other worker runs once the busy worker has used its time slice
+        names = [name for (name, _) in self.record]
+        self.assertEqual(21, len(names))
+        self.assertEqual(5, names.index("other"))
+        self.assertEqual(range(20), self._eventsOf("busy"))
+        self.assertEqual(3, scheduler.getStats()["preempted_slices"])
+
+    def testA3_Stop(self):
+        worker = self._worker("W")
+        worker.enqueue(1)
+        time.sleep(0.1)
+        worker.stop()
+        time.sleep(0.1)
+        worker.enqueue(2)
+        time.sleep(0.1)
+
+        self.assertEqual([1], self._eventsOf("W"))
+        self.assertEqual(0, self.scheduler.getStats()["workers"])
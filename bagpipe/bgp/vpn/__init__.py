@@ -33,6 +33,9 @@ from bagpipe.bgp.common.run_command import runCommand
 
 from bagpipe.bgp.vpn.label_allocator import LabelAllocator
 
+from bagpipe.bgp.engine.worker_scheduler import WorkerScheduler
+from bagpipe.bgp.engine.flow_control import sharedFlowControl
+
 from bagpipe.exabgp.message.update.attribute.communities import RouteTarget
 
 
@@ -90,6 +93,18 @@ class VPNManager(LookingGlass):
 
         self.lock = Lock()
 
+        # the events of VPN instances can be processed by a fixed number of
+        # threads, rather than by a thread for each VPN instance (the
+        # default)
+        threadCount = int(self.bgpManager.config.get('vpn_instance_threads',
+                                                     0))
+        if threadCount > 0:
+            self.scheduler = WorkerScheduler(threadCount,
+                                             "VPNInstanceScheduler")
+            self.scheduler.start()
+        else:
+            self.scheduler = None
+
     def _formatIpAddressPrefix(self, ipAddress):
         if re.match(r'([12]?\d?\d\.){3}[12]?\d?\d\/[123]?\d', ipAddress):
             address = ipAddress
@@ -294,7 +309,14 @@ class VPNManager(LookingGlass):
             # Update VPN instance list
             self.vpnInstances[externalInstanceId] = vpnInstance
 
-            vpnInstance.start()
+            # routes received from BGP peers stop being read while VPN
+            # instances are late processing them
+            sharedFlowControl().watch(vpnInstance)
+
+            if self.scheduler:
+                self.scheduler.schedule(vpnInstance)
+            else:
+                vpnInstance.start()
 
         # Check if new route target import/export must be updated
         if not ((set(vpnInstance.importRTs) == set(importRTs)) and
@@ -340,6 +362,18 @@ class VPNManager(LookingGlass):
         if vpnInstance.stopIfEmpty():
             del self.vpnInstances[externalInstanceId]
 
+    @utils.synchronized
+    @logDecorator.logInfo
+    def nextHopDown(self, nextHop):
+        '''
+        To be called when nextHop (an IP address) is known to be unreachable,
+        e.g. because the remote hypervisor died, without waiting for the
+        routes using it to be withdrawn in BGP (see the next_hop_down call of
+        the REST API)
+        '''
+        for vpnInstance in self.vpnInstances.itervalues():
+            vpnInstance.nextHopDown(nextHop)
+
     @logDecorator.logInfo
     def stop(self):
         for vpnInstance in self.vpnInstances.itervalues():
@@ -348,8 +382,11 @@ class VPNManager(LookingGlass):
             if (vpnInstance.type == "ipvpn" and
                     self._evpn_ipvpn_ifs.get(vpnInstance)):
                 self._cleanup_evpn2ipvpn(vpnInstance)
-        for vpnInstance in self.vpnInstances.itervalues():
-            vpnInstance.join()
+        if self.scheduler:
+            self.scheduler.stop()
+        else:
+            for vpnInstance in self.vpnInstances.itervalues():
+                vpnInstance.join()
 
     # Looking Glass hooks ####
 
@@ -370,9 +407,16 @@ class VPNManager(LookingGlass):
         return {
             "instances": (LGMap.COLLECTION, (self.getLGVPNList,
                                              self.getLGVPNFromPathItem)),
-            "dataplane": (LGMap.DELEGATE, dataplaneHook)
+            "dataplane": (LGMap.DELEGATE, dataplaneHook),
+            "scheduler": (LGMap.SUBITEM, self.getLGScheduler)
         }
 
+    def getLGScheduler(self):
+        if self.scheduler:
+            return self.scheduler.getStats()
+        else:
+            return {}
+
     def getLGVPNList(self):
         return [{"id": id,
                  "name": instance.name}
@@ -58,6 +58,15 @@ class DataplaneDriver(LookingGlassLocalLogger):
             raise Exception("malformed local_address: '%s'" %
                             self.local_address)
 
+        # delay (in seconds) during which the updates for a given prefix are
+        # coalesced before being applied to the dataplane (0 to disable)
+        try:
+            self.coalescingWindow = float(
+                self.config.get("coalescing_window", 0))
+        except ValueError:
+            raise Exception("malformed coalescing_window: '%s'" %
+                            self.config["coalescing_window"])
+
         # skipped if instantiated with init=False, to be used for cleanup
         if init:
             self._initReal(config)
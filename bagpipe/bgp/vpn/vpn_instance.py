@@ -72,7 +72,8 @@ class VPNInstance(TrackerWorker, Thread, LookingGlassLocalLogger):
 
         TrackerWorker.__init__(self, bgpManager, "%s-%d" %
                                (self.instanceType, self.instanceId),
-                               compareRoutes)
+                               compareRoutes,
+                               dataplaneDriver.coalescingWindow)
 
         LookingGlassLocalLogger.__init__(self,
                                          "%s-%d" % (self.instanceType,
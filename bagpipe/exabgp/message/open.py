@@ -143,7 +143,15 @@ class RouteRefresh (list):
 		return "Route Refresh (unparsed)"
 
 	def extract (self):
-		return []
+		# a capability with no value
+		return ['']
+
+class EnhancedRouteRefresh (list):
+	def __str__ (self):
+		return "Enhanced Route Refresh"
+
+	def extract (self):
+		return ['']
 
 class CiscoRouteRefresh (list):
 	def __str__ (self):
@@ -201,14 +209,15 @@ class Capabilities (dict):
 	DYNAMIC_CAPABILITY       = 0x43 # [Chen]
 	MULTISESSION_BGP_RFC     = 0x44 # [draft-ietf-idr-bgp-multisession]
 	ADD_PATH                 = 0x45 # [draft-ietf-idr-add-paths]
-	# 70-127    Unassigned
+	ENHANCED_ROUTE_REFRESH   = 0x46 # [RFC7313]
+	# 71-127    Unassigned
 	CISCO_ROUTE_REFRESH      = 0x80 # I Can only find reference to this in the router logs
 	# 128-255   Reserved for Private Use [RFC5492]
 	MULTISESSION_BGP         = 0x83 # What Cisco really use for Multisession (yes this is a reserved range in prod !)
 
 	EXTENDED_MESSAGE         = -1 # No yet defined by draft http://tools.ietf.org/html/draft-ietf-idr-extended-messages-02.txt
 
-	unassigned = range(70,128)
+	unassigned = range(71,128)
 	reserved = range(128,256)
 
 	def announced (self,capability):
@@ -224,6 +233,8 @@ class Capabilities (dict):
 				r += ['Route Refresh']
 			elif key == self.CISCO_ROUTE_REFRESH:
 				r += ['Cisco Route Refresh']
+			elif key == self.ENHANCED_ROUTE_REFRESH:
+				r += ['Enhanced Route Refresh']
 			elif key == self.GRACEFUL_RESTART:
 				r += ['Graceful Restart']
 			elif key == self.FOUR_BYTES_ASN:
@@ -7,8 +7,6 @@ Copyright (c) 2009-2012 Exa Networks. All rights reserved.
 Modified by Orange - 2014
 """
 
-from copy import deepcopy
-
 from bagpipe.exabgp.structure.address import AFI,SAFI
 from bagpipe.exabgp.message import Message,prefix
 
@@ -40,6 +38,12 @@ class Update (Message):
 		self.afi = routes[0].nlri.afi
 		self.safi = routes[0].nlri.safi
 
+	@staticmethod
+	def mp_family (afi,safi):
+		"""Tells if the routes of this family are advertised in MP_REACH_NLRI,
+		the next hop being encoded there rather than in a NEXT_HOP attribute"""
+		return not (afi == AFI.ipv4 and safi in [SAFI.unicast, SAFI.multicast])
+
 	# The routes MUST have the same attributes ...
 	def announce (self,asn4,local_asn,remote_asn):
 		if self.afi == AFI.ipv4 and self.safi in [SAFI.unicast, SAFI.multicast]:
@@ -52,24 +56,26 @@ class Update (Message):
 		attr = self.routes[0].attributes.bgp_announce(asn4,local_asn,remote_asn)
 		return self._message(prefix('') + prefix(attr + mp) + nlri)
 
-	def update (self,asn4,local_asn,remote_asn):
+	# attr, if given, is the result of bgp_announce for the attributes of the
+	# routes (with next_hop=False for MP families), e.g. cached by the caller
+	def update (self,asn4,local_asn,remote_asn,attr=None):
 		
-		if self.afi == AFI.ipv4 and self.safi in [SAFI.unicast, SAFI.multicast]:
+		if not Update.mp_family(self.afi,self.safi):
 			nlri = ''.join([route.nlri.pack() for route in self.routes])
 			mp = ''
-			attr = self.routes[0].attributes.bgp_announce(asn4,local_asn,remote_asn)
+			if attr is None:
+				attr = self.routes[0].attributes.bgp_announce(asn4,local_asn,remote_asn)
 		else:
 			nlri = ''
 			#mp = MPURNLRI(self.routes).pack() + MPRNLRI(self.routes).pack()
 			mp = MPRNLRI(self.routes).pack()
-			# remove NEXT_HOP from attributes, because it's already been encoded in the MPNLRI
 			
 			if AttributeID.NEXT_HOP not in self.routes[0].attributes:
 				raise Exception("Routes advertised need a NEXT_HOP attribute")
 
-			attributes = deepcopy(self.routes[0].attributes)
-			del attributes[AttributeID.NEXT_HOP]
-			attr = attributes.bgp_announce(asn4,local_asn,remote_asn)
+			# NEXT_HOP is not packed, it's already been encoded in the MPNLRI
+			if attr is None:
+				attr = self.routes[0].attributes.bgp_announce(asn4,local_asn,remote_asn,False)
 			
 		return self._message(prefix(nlri) + prefix(attr + mp) + nlri)
 
@@ -7,7 +7,8 @@ Copyright (c) 2010-2012 Exa Networks. All rights reserved.
 Modified by Orange - 2014
 """
 
-import collections
+from hashlib import md5
+from struct import pack
 
 from bagpipe.exabgp.structure.address import AFI,SAFI
 from bagpipe.exabgp.structure.asn import AS_TRANS
@@ -47,12 +48,25 @@ class Attributes (dict):
 
 	def __init__ (self):
 		self._str = ''
+		self._fingerprint = None
+
+	def _changed (self):
+		self._str = ''
+		self._fingerprint = None
+
+	def __setitem__ (self,k,v):
+		self._changed()
+		dict.__setitem__(self,k,v)
+
+	def __delitem__ (self,k):
+		self._changed()
+		dict.__delitem__(self,k)
 
 	def has (self,k):
 		return self.has_key(k)
 
 	def add (self,attribute):
-		self._str = ''
+		self._changed()
 		if self.has(attribute.ID):
 			if attribute.MULTIPLE:
 				self[attribute.ID].append(attribute)
@@ -66,6 +80,7 @@ class Attributes (dict):
 			return True
 
 	def remove (self,attrid):
+		self._changed()
 		self.pop(attrid)
 
 	def _as_path (self,asn4,asp):
@@ -90,7 +105,9 @@ class Attributes (dict):
 			message += ASPath(True,asp.asptype,asp.aspsegment).pack()
 		return message
 
-	def bgp_announce (self,asn4,local_asn,peer_asn):
+	def bgp_announce (self,asn4,local_asn,peer_asn,next_hop=True):
+		# next_hop is False for families where the next hop is encoded in
+		# MP_REACH_NLRI rather than in a NEXT_HOP attribute
 		ibgp = (local_asn == peer_asn)
 		# we do not store or send MED
 		message = ''
@@ -112,7 +129,7 @@ class Attributes (dict):
 		else:
 			raise RuntimeError('Generated routes must always have an AS_PATH ')
 
-		if AttributeID.NEXT_HOP in self:
+		if next_hop and AttributeID.NEXT_HOP in self:
 			afi = self[AttributeID.NEXT_HOP].next_hop.afi
 			safi = self[AttributeID.NEXT_HOP].next_hop.safi
 			if afi == AFI.ipv4 and safi in [SAFI.unicast, SAFI.multicast]:
@@ -186,37 +203,39 @@ class Attributes (dict):
 	def __repr__ (self):
 		return str(self)
 	
-	def __hash__(self):
-		return hash(repr(self))  #FIXME: not excellent... :-(
-
-	def sameValuesAs(self,other):
+	@staticmethod
+	def _canonical_pack (attribute):
+		# the order of the values of an attribute made of a list of values
+		# (e.g. communities) does not matter
+		if isinstance(attribute,MultiAttributes):
+			return ''.join(sorted(_.pack() for _ in attribute))
+		if hasattr(attribute,'communities'):
+			return ''.join(sorted(_.pack() for _ in attribute.communities))
+		return attribute.pack()
+
+	def fingerprint (self):
+		"""Returns a digest of the values of the attributes (MP_REACH_NLRI
+		excepted), computed once: an attribute object must not be modified
+		after the fingerprint has been computed"""
+		if self._fingerprint is None:
+			digest = md5()
+			for key in sorted(self.iterkeys()):
+				if key == AttributeID.MP_REACH_NLRI: continue
+				value = self._canonical_pack(self[key])
+				digest.update(pack('!BL',key,len(value)))
+				digest.update(value)
+			self._fingerprint = digest.digest()
+		return self._fingerprint
+
+	def __eq__ (self,other):
+		return isinstance(other,Attributes) and self.fingerprint() == other.fingerprint()
+
+	def __ne__ (self,other):
+		return not self.__eq__(other)
+
+	def __hash__ (self):
+		return hash(self.fingerprint())
+
+	def sameValuesAs (self,other):
 		# test that sets of attributes exactly match
-		# can't rely on __eq__ for this, because __eq__ relies on Attribute.__eq__ which does not look at attributes values
-	
-		for key in set(self.iterkeys()).union(set(other.iterkeys())):
-			
-			if key == AttributeID.MP_REACH_NLRI: continue
-
-			try:
-				sval = self[key]
-				oval = other[key]
-				
-				# In the case where the attribute is, for instance, a list
-				# we want to compare values independently of the order
-				if isinstance(sval, collections.Iterable):
-					if not isinstance(oval, collections.Iterable):
-						return False
-					else:
-						# we sort based on string representation since the items do not
-						# necessarily implement __cmp__
-						sorter=lambda x,y: cmp(repr(x), repr(y))
-						sval = sorted(sval,sorter)
-						oval = set(oval,sorter)
-						
-				if sval != oval: 
-					return False
-			except KeyError:
-				return False
-			
-		return True
-	
+		return self.fingerprint() == other.fingerprint()
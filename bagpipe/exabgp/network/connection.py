@@ -6,7 +6,7 @@ Created by Thomas Mangin on 2009-09-06.
 Copyright (c) 2009-2012 Exa Networks. All rights reserved.
 """
 
-#import os
+import os
 #import sys
 import struct
 import time
@@ -15,6 +15,8 @@ import socket
 import errno
 import select
 #import array
+from collections import deque
+from threading import Lock
 
 from bagpipe.exabgp.utils import hexa,trace
 from bagpipe.exabgp.structure.address import AFI
@@ -27,6 +29,19 @@ logger = Logger()
 # we should never have to wait more than READ_TIMEOUT to be able to read it.
 READ_TIMEOUT = 1
 
+# Size of the buffer used by receive(), and minimum free space we want in it
+# before reading from the socket
+RECEIVE_BUFFER_SIZE = 256*1024
+RECEIVE_MIN_FREE = 4096
+
+# do not block in recv_into, even if the socket is in blocking mode
+RECEIVE_FLAGS = getattr(socket,'MSG_DONTWAIT',0)
+
+# messages queued in the output buffer are sent by flush() with writes of up
+# to SEND_CHUNK_SIZE bytes, without blocking
+SEND_CHUNK_SIZE = 256*1024
+SEND_FLAGS = getattr(socket,'MSG_DONTWAIT',0)
+
 errno_block = set((
 	errno.EINPROGRESS, errno.EALREADY,
 	errno.EAGAIN, errno.EWOULDBLOCK,
@@ -40,7 +55,7 @@ errno_fatal = set((
 ))
 
 class Connection (object):
-	def __init__ (self,peer,local,md5,ttl):
+	def __init__ (self,peer,local,md5,ttl,blocking=True):
 		self.io = None
 		self.last_read = 0
 		self.last_write = 0
@@ -48,6 +63,8 @@ class Connection (object):
 		self._loop_start = None
 
 		self._buffer = []
+		self._init_receive_buffer()
+		self._init_send_buffer()
 
 		logger.wire("Opening connection to %s" % self.peer)
 
@@ -105,12 +122,21 @@ class Connection (object):
 				self.close()
 				raise Failure('This OS does not support IP_TTL (ttl-security), you can not use MD5 : %s' % str(e))
 
+		if peer.afi == AFI.ipv4:
+			address = (peer.ip,179)
+		if peer.afi == AFI.ipv6:
+			address = (peer.ip,179,0,0)
 		try:
-			if peer.afi == AFI.ipv4:
-				self.io.connect((peer.ip,179))
-			if peer.afi == AFI.ipv6:
-				self.io.connect((peer.ip,179,0,0))
-			self.io.setblocking(0)
+			if blocking:
+				self.io.connect(address)
+				self.io.setblocking(0)
+			else:
+				# the connection is established in the background, the socket
+				# becomes writable when done (see connected)
+				self.io.setblocking(0)
+				error = self.io.connect_ex(address)
+				if error and error not in errno_block:
+					raise socket.error(error,os.strerror(error))
 		except socket.error, e:
 			self.close()
 			raise Failure('Could not connect to peer: %s' % str(e))
@@ -125,6 +151,14 @@ class Connection (object):
 		except socket.error, e:
 			self.message_size = None
 
+	def connected (self):
+		"""For a connection created with blocking=False: once the socket is
+		writable, raises Failure if the connection to the peer failed"""
+		error = self.io.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+		if error:
+			self.close()
+			raise Failure('Could not connect to peer: %s' % os.strerror(error))
+
 	def pending (self,reset=False):
 		if reset:
 			self._loop_start = None
@@ -159,6 +193,12 @@ class Connection (object):
 		if not self.io:
 			raise Failure('Trying to read on a closed TCP connection')
 		if number == 0: return ''
+		# data already received by receive() comes first
+		if self._rend > self._rstart:
+			end = min(self._rend,self._rstart+number)
+			r = str(self._rbuffer[self._rstart:end])
+			self._rstart = end
+			return r
 		try:
 			r = self.io.recv(number)
 			self.last_read = time.time()
@@ -171,6 +211,128 @@ class Connection (object):
 			self.close()
 			raise Failure('Problem while reading data from the network:  %s ' % str(e))
 
+	def _init_receive_buffer (self):
+		# data received by receive() and not consumed yet is in
+		# self._rbuffer[self._rstart:self._rend]
+		self._rbuffer = bytearray(RECEIVE_BUFFER_SIZE)
+		self._rstart = 0
+		self._rend = 0
+		self.bytes_received = 0
+
+	def receive (self):
+		"""Reads in the receive buffer the data available on the socket,
+		without blocking, and returns the number of bytes read."""
+		if not self.io:
+			raise Failure('Trying to read on a closed TCP connection')
+		if self._rstart == self._rend:
+			self._rstart = self._rend = 0
+		elif len(self._rbuffer) - self._rend < RECEIVE_MIN_FREE:
+			# move the data not consumed yet at the start of the buffer
+			pending = self._rend - self._rstart
+			self._rbuffer[0:pending] = self._rbuffer[self._rstart:self._rend]
+			self._rstart = 0
+			self._rend = pending
+		try:
+			number = self.io.recv_into(memoryview(self._rbuffer)[self._rend:],0,RECEIVE_FLAGS)
+		except socket.timeout,e:
+			self.close()
+			raise Failure('Timeout while reading data from the network:  %s ' % str(e))
+		except socket.error,e:
+			if e.args[0] in errno_block:
+				return 0
+			self.close()
+			raise Failure('Problem while reading data from the network:  %s ' % str(e))
+		if not number:
+			raise Failure('The TCP connection is closed')
+		self._rend += number
+		self.bytes_received += number
+		self.last_read = time.time()
+		return number
+
+	def received (self):
+		"""Returns a memoryview on the data received and not consumed yet"""
+		return memoryview(self._rbuffer)[self._rstart:self._rend]
+
+	def consume (self,number):
+		"""Marks the first number bytes of received() as consumed"""
+		assert self._rstart + number <= self._rend
+		self._rstart += number
+
+	def _init_send_buffer (self):
+		# data queued and not sent yet, the first item may have been
+		# partially sent already
+		self._wbuffer = deque()
+		self._wpending = 0
+		# queue() and flush() can be called by different threads
+		self._wlock = Lock()
+		self.bytes_sent = 0
+		self.writes = 0
+		self.partial_writes = 0
+
+	def queue (self,data):
+		"""Adds data to the output buffer, to be sent by flush()"""
+		with self._wlock:
+			self._wbuffer.append(data)
+			self._wpending += len(data)
+
+	def pending_output (self):
+		"""Returns the number of bytes of the output buffer not sent yet"""
+		return self._wpending
+
+	def flush (self,cork=False):
+		"""Sends as much of the output buffer as possible without blocking,
+		with as few writes as possible, and returns the number of bytes still
+		to send (the caller should call flush again once the socket is
+		writable). With cork, TCP_CORK is set during the writes, so that no
+		partial segment is sent before the end of the data.
+
+		Raises Failure if the data can't be sent."""
+		with self._wlock:
+			if not self.io:
+				raise Failure('Trying to write on a closed TCP connection')
+			cork = cork and hasattr(socket,'TCP_CORK') and self._wpending > 0
+			if cork:
+				self.io.setsockopt(socket.IPPROTO_TCP,socket.TCP_CORK,1)
+			try:
+				while self._wbuffer:
+					# successive messages are sent in a single write
+					data = self._wbuffer.popleft()
+					if self._wbuffer and len(data) < SEND_CHUNK_SIZE:
+						chunk = [data]
+						size = len(data)
+						while self._wbuffer and size + len(self._wbuffer[0]) <= SEND_CHUNK_SIZE:
+							data = self._wbuffer.popleft()
+							chunk.append(data)
+							size += len(data)
+						data = ''.join(chunk)
+					try:
+						sent = self.io.send(data,SEND_FLAGS)
+					except socket.error,e:
+						if e.args[0] in errno_block:
+							self._wbuffer.appendleft(data)
+							break
+						self.close()
+						logger.wire("%15s %s" % (self.peer,trace()))
+						raise Failure('Problem while writing data to the network: %s' % str(e))
+					self.writes += 1
+					self.bytes_sent += sent
+					self._wpending -= sent
+					self.last_write = time.time()
+					logger.wire(LazyFormat("%15s SENT " % self.peer,hexa,data[:sent]))
+					if sent < len(data):
+						# the socket buffer is full
+						self.partial_writes += 1
+						self._wbuffer.appendleft(data[sent:])
+						break
+			finally:
+				if cork:
+					try:
+						self.io.setsockopt(socket.IPPROTO_TCP,socket.TCP_CORK,0)
+					except socket.error:
+						# closed after a failure
+						pass
+			return self._wpending
+
 	def write (self,data):
 		if not self.io:
 			# We alrady returned a Failure
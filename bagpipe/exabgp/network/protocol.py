@@ -11,7 +11,7 @@ Modified by Orange - 2014
 #import copy
 import time
 import socket
-from struct import unpack
+from struct import pack,unpack,Struct
 
 from bagpipe.exabgp.rib.table import Table
 from bagpipe.exabgp.rib.delta import Delta
@@ -26,10 +26,11 @@ from bagpipe.exabgp.structure.asn        import ASN,AS_TRANS
 from bagpipe.exabgp.network.connection   import Connection
 from bagpipe.exabgp.message              import Message,defix,Failure
 from bagpipe.exabgp.message.nop          import NOP
-from bagpipe.exabgp.message.open         import Open,Unknown,Parameter,Capabilities,RouterID,MultiProtocol,RouteRefresh,CiscoRouteRefresh,MultiSession,Graceful
+from bagpipe.exabgp.message.open         import Open,Unknown,Parameter,Capabilities,RouterID,MultiProtocol,RouteRefresh,CiscoRouteRefresh,EnhancedRouteRefresh,MultiSession,Graceful
 from bagpipe.exabgp.message.update       import Update
 from bagpipe.exabgp.message.update.eor   import EOR
 from bagpipe.exabgp.message.keepalive    import KeepAlive
+from bagpipe.exabgp.message.refresh      import RouteRefresh as RouteRefreshMessage
 from bagpipe.exabgp.message.notification import Notification, Notify #, NotConnected
 from bagpipe.exabgp.message.update.route import ReceivedRoute # ,Route
 from bagpipe.exabgp.message.update.attributes     import Attributes
@@ -52,6 +53,10 @@ logger = Logger()
 
 MAX_BACKLOG = 200000
 
+_struct_H = Struct('!H')
+_struct_L = Struct('!L')
+_struct_HB = Struct('!HB')
+
 # README: Move all the old packet decoding in another file to clean up the includes here, as it is not used anyway
 
 class Protocol (object):
@@ -129,13 +134,53 @@ class Protocol (object):
 				if not data:
 					raise Failure('The TCP connection is closed')
 
-		if data[:16] != Message.MARKER:
+		length,msg = self._check_header(data)
+
+		length -= 19
+		data = ''
+		while length:
+			if self.connection.pending():
+				delta = self.connection.read(length)
+				data += delta
+				length -= len(delta)
+				# The socket is closed
+				if not data:
+					raise Failure('The TCP connection is closed')
+
+		return self._decode_message(msg,data)
+
+	def read_messages (self):
+		"""Reads the data available on the connection and returns the list
+		of the complete messages received (possibly empty). The data of an
+		incomplete message is kept in the connection buffer."""
+		self.connection.receive()
+		data = self.connection.received()
+		available = len(data)
+		offset = 0
+		messages = []
+		while available - offset >= 19:
+			# the header is checked in place, in the connection buffer
+			length,msg = self._check_header(data[offset:offset+19])
+			if available - offset < length:
+				break
+			# the body is copied once, on purpose: the decoders work on
+			# strings, and the objects they build keep slices of it, which
+			# must survive the reuse of the connection buffer
+			body = data[offset+19:offset+length].tobytes()
+			offset += length
+			self.connection.consume(length)
+			messages.append(self._decode_message(msg,body))
+		return messages
+
+	def _check_header (self,header):
+		# header may be a string or a memoryview on the connection buffer
+		if header[:16] != Message.MARKER:
 			# We are speaking BGP - send us a valid Marker
 			raise Notify(1,1,'The packet received does not contain a BGP marker')
 
-		raw_length = data[16:18]
+		raw_length = header[16:18]
 		length = unpack('!H',raw_length)[0]
-		msg = data[18]
+		msg = header[18]
 
 		if ( length < 19 or length > 4096):
 			# BAD Message Length
@@ -145,23 +190,15 @@ class Protocol (object):
 			(msg == Open.TYPE and length < 29) or
 			(msg == Update.TYPE and length < 23) or
 			(msg == Notification.TYPE and length < 21) or
-			(msg == KeepAlive.TYPE and length != 19)
+			(msg == KeepAlive.TYPE and length != 19) or
+			(msg == RouteRefreshMessage.TYPE and length != 23)
 		):
 			# MUST send the faulty length back
-			raise Notify(1,2,raw_length)
-			#(msg == RouteRefresh.TYPE and length != 23)
+			raise Notify(1,2,pack('!H',length))
 
-		length -= 19
-		data = ''
-		while length:
-			if self.connection.pending():
-				delta = self.connection.read(length)
-				data += delta
-				length -= len(delta)
-				# The socket is closed
-				if not data:
-					raise Failure('The TCP connection is closed')
+		return length,msg
 
+	def _decode_message (self,msg,data):
 		if msg == Notification.TYPE:
 			raise Notification(ord(data[0]),ord(data[1]))
 
@@ -171,6 +208,9 @@ class Protocol (object):
 		if msg == Open.TYPE:
 			return self.OpenFactory(data)
 
+		if msg == RouteRefreshMessage.TYPE:
+			return RouteRefreshMessage.unpack(data)
+
 		if msg == Update.TYPE:
 			if self.neighbor.parse_routes:
 				update = self.UpdateFactory(data)
@@ -189,6 +229,11 @@ class Protocol (object):
 		if message.TYPE == NOP.TYPE:
 			return message
 
+		return self.check_open(_open,message)
+
+	def check_open (self,_open,message):
+		"""Checks the first message received from the peer, which must be an
+		open compatible with ours, and returns it"""
 		if message.TYPE != Open.TYPE:
 			raise Notify(5,1,'The first packet received is not an open message (%s)' % message)
 
@@ -436,6 +481,10 @@ class Protocol (object):
 							capabilities[k] = CiscoRouteRefresh()
 							continue
 
+						if k == Capabilities.ENHANCED_ROUTE_REFRESH:
+							capabilities[k] = EnhancedRouteRefresh()
+							continue
+
 						if k == Capabilities.MULTISESSION_BGP:
 							capabilities[k] = MultiSession()
 							continue
@@ -585,189 +634,189 @@ class Protocol (object):
 		return communities
 
 	def _AttributesFactory (self,data):
-		if not data:
-			return self
+		end = len(data)
+		offset = 0
+		while offset < end:
+			# We do not care if the attribute are transitive or not as we do not redistribute
+			flag = ord(data[offset])
+			code = ord(data[offset+1])
+
+			if flag & Flag.EXTENDED_LENGTH:
+				length = _struct_H.unpack_from(data,offset+2)[0]
+				offset += 4
+			else:
+				length = ord(data[offset+2])
+				offset += 3
+
+			if offset + length > end:
+				raise Notify(3,1,'attribute %d is longer than the attribute list' % code)
 
-		# We do not care if the attribute are transitive or not as we do not redistribute
-		flag = Flag(ord(data[0]))
-		code = AttributeID(ord(data[1]))
+			# XXX: This code does not make sure that attributes are unique - or does it ?
 
-		if flag & Flag.EXTENDED_LENGTH:
-			length = unpack('!H',data[2:4])[0]
-			offset = 4
+			decoder = self._attribute_decoders.get(code)
+			if decoder is None:
+				logger.warning("ignoring attributes of type %s %s" % (str(AttributeID(code)),[hex(ord(_)) for _ in data[offset:offset+length]]),'parsing')
+			else:
+				decoder(self,data,offset,length)
+
+			offset += length
+
+		return self
+
+	def _decode_origin (self,data,offset,length):
+		logger.parser('parsing origin')
+		self.attributes.add(Origin(ord(data[offset])))
+
+	def _decode_as_path (self,data,offset,length):
+		logger.parser('parsing as_path')
+		self.attributes.add(self.__new_ASPath(data[offset:offset+length],self._asn4))
+		if not self._asn4 and self.attributes.has(AttributeID.AS4_PATH):
+			self.__merge_attributes()
+
+	def _decode_as4_path (self,data,offset,length):
+		logger.parser('parsing as_path')
+		self.attributes.add(self.__new_AS4Path(data[offset:offset+length]))
+		if not self._asn4 and self.attributes.has(AttributeID.AS_PATH):
+			self.__merge_attributes()
+
+	def _decode_next_hop (self,data,offset,length):
+		logger.parser('parsing next-hop')
+		self.attributes.add(NextHop(Inet(AFI.ipv4,data[offset:offset+4])))
+
+	def _decode_med (self,data,offset,length):
+		logger.parser('parsing med')
+		self.attributes.add(MED(_struct_L.unpack_from(data,offset)[0]))
+
+	def _decode_local_pref (self,data,offset,length):
+		logger.parser('parsing local-preference')
+		self.attributes.add(LocalPreference(_struct_L.unpack_from(data,offset)[0]))
+
+	def _decode_originator_id (self,data,offset,length):
+		logger.parser('parsing originator-id')
+		self.attributes.add(OriginatorId.unpack(data[offset:offset+4]))
+
+	def _decode_pmsi_tunnel (self,data,offset,length):
+		logger.parser('parsing pmsi-tunnel')
+		self.attributes.add(PMSITunnel.unpack(data[offset:offset+length]))
+
+	def _decode_atomic_aggregate (self,data,offset,length):
+		logger.parser('ignoring atomic-aggregate')
+
+	def _decode_aggregator (self,data,offset,length):
+		logger.parser('ignoring aggregator')
+
+	def _decode_as4_aggregator (self,data,offset,length):
+		logger.parser('ignoring as4_aggregator')
+
+	def _decode_communities (self,data,offset,length):
+		logger.parser('parsing communities')
+		self.attributes.add(self.__new_communities(data[offset:offset+length]))
+
+	def _decode_extended_communities (self,data,offset,length):
+		logger.parser('parsing communities')
+		self.attributes.add(self.__new_extended_communities(data[offset:offset+length]))
+
+	def _check_mp_family (self,afi,safi):
+		# See RFC 5549 for better support
+		if not afi in (AFI.ipv4,AFI.ipv6,AFI.l2vpn) or (not safi in (SAFI.unicast,SAFI.mpls_vpn,SAFI.rtc,SAFI.evpn)):
+			#self.log.out('we only understand IPv4/IPv6 and should never have received this MP_(UN)REACH_NLRI (%s %s)' % (afi,safi))
+			raise Exception("Unsupported AFI/SAFI received !! not supposed to happen here...")
+
+	def _decode_nlris (self,afi,safi,data,offset,end):
+		# each NLRI is decoded from a string of its exact length
+		while offset < end:
+			if safi == SAFI.evpn:
+				# route type, length, value
+				size = 2 + ord(data[offset+1])
+			else:
+				# length in bits, value
+				size = 1 + (ord(data[offset]) + 7) / 8
+			nlri_data = data[offset:offset+size]
+			offset += size
+
+			if safi == SAFI.unicast:
+				yield BGPPrefix(afi,nlri_data)
+			elif (afi == AFI.ipv4 and safi == SAFI.mpls_vpn):
+				yield VPNLabelledPrefix.unpack(afi,safi,nlri_data)
+			elif (afi == AFI.ipv4 and safi == SAFI.rtc):
+				yield RouteTargetConstraint.unpack(afi,safi,nlri_data)
+			elif (afi == AFI.l2vpn and safi == SAFI.evpn):
+				yield EVPNNLRI.unpack(nlri_data)
+			else:
+				raise Exception("Unsupported AFI/SAFI combination !!")
+
+	def _decode_mp_unreach_nlri (self,data,offset,length):
+		logger.parser('parsing multi-protocol nlri unreacheable')
+		end = offset + length
+		afi,safi = _struct_HB.unpack_from(data,offset)
+		offset += 3
+		self._check_mp_family(afi,safi)
+
+		for nlri in self._decode_nlris(afi,safi,data,offset,end):
+			self.mp_routes.append(ReceivedRoute(nlri,'withdraw'))
+
+	def _decode_mp_reach_nlri (self,data,offset,length):
+		logger.parser('parsing multi-protocol nlri reacheable')
+		end = offset + length
+		afi,safi = _struct_HB.unpack_from(data,offset)
+		offset += 3
+		self._check_mp_family(afi,safi)
+
+		len_nh = ord(data[offset])
+		offset += 1
+		if afi == AFI.ipv4 and safi in (SAFI.unicast,) and not len_nh == 4:
+			# We are not following RFC 4760 Section 7 (deleting route and possibly tearing down the session)
+			#self.log.out('bad IPv4 next-hop length (%d)' % len_nh)
+			return
+		if afi == AFI.ipv6 and safi in (SAFI.unicast,) and not len_nh in (16,32):
+			# We are not following RFC 4760 Section 7 (deleting route and possibly tearing down the session)
+			#self.log.out('bad IPv6 next-hop length (%d)' % len_nh)
+			return
+		nh = data[offset:offset+len_nh]
+		offset += len_nh
+		if len_nh == 32:
+			# we have a link-local address in the next-hop we ideally need to ignore
+			if nh[0] == chr(0xfe): nh = nh[16:]
+			elif nh[16] == chr(0xfe): nh = nh[:16]
+			# We are not following RFC 4760 Section 7 (deleting route and possibly tearing down the session)
+			else: return
+		if len_nh >= 16: nh = socket.inet_ntop(socket.AF_INET6,nh)
 		else:
-			length = ord(data[2])
-			offset = 3
-
-		data = data[offset:]
-
-#		if not length:
-#			return self._AttributesFactory(data[length:])
-
-		# XXX: This code does not make sure that attributes are unique - or does it ?
-
-		if code == AttributeID.ORIGIN:
-			logger.parser('parsing origin')
-			self.attributes.add(Origin(ord(data[0])))
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.AS_PATH:
-			logger.parser('parsing as_path')
-			self.attributes.add(self.__new_ASPath(data[:length],self._asn4))
-			if not self._asn4 and self.attributes.has(AttributeID.AS4_PATH):
-				self.__merge_attributes()
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.AS4_PATH:
-			logger.parser('parsing as_path')
-			self.attributes.add(self.__new_AS4Path(data[:length]))
-			if not self._asn4 and self.attributes.has(AttributeID.AS_PATH):
-				self.__merge_attributes()
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.NEXT_HOP:
-			logger.parser('parsing next-hop')
-			self.attributes.add(NextHop(Inet(AFI.ipv4,data[:4])))
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.MED:
-			logger.parser('parsing med')
-			self.attributes.add(MED(unpack('!L',data[:4])[0]))
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.LOCAL_PREF:
-			logger.parser('parsing local-preference')
-			self.attributes.add(LocalPreference(unpack('!L',data[:4])[0]))
-			return self._AttributesFactory(data[length:])
-		
-		if code == AttributeID.ORIGINATOR_ID:
-			logger.parser('parsing originator-id')
-			self.attributes.add(OriginatorId.unpack(data[:4]))
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.PMSI_TUNNEL:
-			logger.parser('parsing pmsi-tunnel')
-			self.attributes.add(PMSITunnel.unpack(data[:length]))
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.ATOMIC_AGGREGATE:
-			logger.parser('ignoring atomic-aggregate')
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.AGGREGATOR:
-			logger.parser('ignoring aggregator')
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.AS4_AGGREGATOR:
-			logger.parser('ignoring as4_aggregator')
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.COMMUNITY:
-			logger.parser('parsing communities')
-			self.attributes.add(self.__new_communities(data[:length]))
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.EXTENDED_COMMUNITY:
-			logger.parser('parsing communities')
-			self.attributes.add(self.__new_extended_communities(data[:length]))
-			return self._AttributesFactory(data[length:])
-
-		if code == AttributeID.MP_UNREACH_NLRI:
-			logger.parser('parsing multi-protocol nlri unreacheable')
-			next_attributes = data[length:]
-			data = data[:length]
-			afi,safi = unpack('!HB',data[:3])
-			offset = 3
-			# See RFC 5549 for better support
-			if not afi in (AFI.ipv4,AFI.ipv6,AFI.l2vpn) or (not safi in (SAFI.unicast, SAFI.mpls_vpn, SAFI.rtc,SAFI.evpn)):
-				#self.log.out('we only understand IPv4/IPv6 and should never have received this MP_UNREACH_NLRI (%s %s)' % (afi,safi))
-				raise Exception("Unsupported AFI/SAFI received !! not supposed to happen here...")
-				return self._AttributesFactory(next_attributes)
-			data = data[offset:]
-			while data:
-				
-				if safi == SAFI.unicast:
-					route = ReceivedRoute(BGPPrefix(afi,data),'withdraw')
-				elif (afi == AFI.ipv4 and safi == SAFI.mpls_vpn):
-					route = ReceivedRoute(VPNLabelledPrefix.unpack(afi,safi,data),'withdraw')
-				elif (afi == AFI.ipv4 and safi == SAFI.rtc):
-					route = ReceivedRoute(RouteTargetConstraint.unpack(afi,safi,data),'withdraw')
-				elif (afi == AFI.l2vpn and safi == SAFI.evpn):
-					route = ReceivedRoute(EVPNNLRI.unpack(data) ,'withdraw')
-				else:
-					raise Exception("Unsupported AFI/SAFI combination !!")
-					return self._AttributesFactory(next_attributes)
-				
-				data = data[len(route.nlri):]
-				self.mp_routes.append(route)
-			return self._AttributesFactory(next_attributes)
-
-		if code == AttributeID.MP_REACH_NLRI:
-			logger.parser('parsing multi-protocol nlri reacheable')
-			next_attributes = data[length:]
-			data = data[:length]
-			afi,safi = unpack('!HB',data[:3])
-			offset = 3
-			
-			if not afi in (AFI.ipv4,AFI.ipv6,AFI.l2vpn) or (not safi in (SAFI.unicast,SAFI.mpls_vpn,SAFI.rtc,SAFI.evpn)):
-				#self.log.out('we only understand IPv4/IPv6 and should never have received this MP_REACH_NLRI (%s %s)' % (afi,safi))
-				raise Exception("Unsupported AFI/SAFI received !! not supposed to happen here...")
-				return self._AttributesFactory(next_attributes)
-			len_nh = ord(data[offset])
-			offset += 1
-			if afi == AFI.ipv4 and safi in (SAFI.unicast,) and not len_nh == 4: 
-				# We are not following RFC 4760 Section 7 (deleting route and possibly tearing down the session)
-				#self.log.out('bad IPv4 next-hop length (%d)' % len_nh)
-				return self._AttributesFactory(next_attributes)
-			if afi == AFI.ipv6 and safi in (SAFI.unicast,) and not len_nh in (16,32):
-				# We are not following RFC 4760 Section 7 (deleting route and possibly tearing down the session)
-				#self.log.out('bad IPv6 next-hop length (%d)' % len_nh)
-				return self._AttributesFactory(next_attributes)
-			nh = data[offset:offset+len_nh]
-			offset += len_nh
-			if len_nh == 32:
-				# we have a link-local address in the next-hop we ideally need to ignore
-				if nh[0] == chr(0xfe): nh = nh[16:]
-				elif nh[16] == chr(0xfe): nh = nh[:16]
-				# We are not following RFC 4760 Section 7 (deleting route and possibly tearing down the session)
-				else: return self._AttributesFactory(next_attributes)
-			if len_nh >= 16: nh = socket.inet_ntop(socket.AF_INET6,nh)
+			if (safi in (SAFI.mpls_vpn,)):
+				# the next-hop is preceded by an rdtype and a 6-byte RD, we don't care about the RD yet
+				nh = socket.inet_ntop(socket.AF_INET,nh[8:])
 			else:
-				
-				if (safi in (SAFI.mpls_vpn,)):
-					# the next-hop is preceded by an rdtype and a 6-byte RD, we don't care about the RD yet
-					nh = socket.inet_ntop(socket.AF_INET,nh[8:])
-				else:
-					nh = socket.inet_ntop(socket.AF_INET,nh)
-			
-			nb_snpa = ord(data[offset])
-			offset += 1
-			snpas = []
-			for _ in range(nb_snpa):
-				len_snpa = ord(offset)
-				offset += 1
-				snpas.append(data[offset:offset+len_snpa])
-				offset += len_snpa
-			data = data[offset:]
-			while data:
-				if safi == SAFI.unicast:
-					route = ReceivedRoute(BGPPrefix(afi,data),'announce')
-				elif (afi == AFI.ipv4 and safi == SAFI.mpls_vpn):
-					route = ReceivedRoute(VPNLabelledPrefix.unpack(afi,safi,data) ,'announce')
-				elif (afi == AFI.ipv4 and safi == SAFI.rtc):
-					route = ReceivedRoute(RouteTargetConstraint.unpack(afi,safi,data) ,'announce')
-				elif (afi == AFI.l2vpn and safi == SAFI.evpn):
-					route = ReceivedRoute(EVPNNLRI.unpack(data) ,'announce')
-				else:
-					raise Exception("Unsupported AFI/SAFI combination !!")
-					return self._AttributesFactory(next_attributes)
-										
-				data = data[len(route.nlri):]
-				route.attributes = self.attributes
-				route.attributes.add(NextHop(to_IP(nh)))
-				self.mp_routes.append(route)
-			return self._AttributesFactory(next_attributes)
-
-		logger.warning("ignoring attributes of type %s %s" % (str(code),[hex(ord(_)) for _ in data]),'parsing')
-		return self._AttributesFactory(data[length:])
+				nh = socket.inet_ntop(socket.AF_INET,nh)
 
+		# SNPAs are skipped
+		nb_snpa = ord(data[offset])
+		offset += 1
+		for _ in range(nb_snpa):
+			offset += 1 + ord(data[offset])
+
+		routes = False
+		for nlri in self._decode_nlris(afi,safi,data,offset,end):
+			route = ReceivedRoute(nlri,'announce')
+			route.attributes = self.attributes
+			self.mp_routes.append(route)
+			routes = True
+		if routes:
+			self.attributes.add(NextHop(to_IP(nh)))
+
+	_attribute_decoders = {
+		AttributeID.ORIGIN: _decode_origin,
+		AttributeID.AS_PATH: _decode_as_path,
+		AttributeID.AS4_PATH: _decode_as4_path,
+		AttributeID.NEXT_HOP: _decode_next_hop,
+		AttributeID.MED: _decode_med,
+		AttributeID.LOCAL_PREF: _decode_local_pref,
+		AttributeID.ORIGINATOR_ID: _decode_originator_id,
+		AttributeID.PMSI_TUNNEL: _decode_pmsi_tunnel,
+		AttributeID.ATOMIC_AGGREGATE: _decode_atomic_aggregate,
+		AttributeID.AGGREGATOR: _decode_aggregator,
+		AttributeID.AS4_AGGREGATOR: _decode_as4_aggregator,
+		AttributeID.COMMUNITY: _decode_communities,
+		AttributeID.EXTENDED_COMMUNITY: _decode_extended_communities,
+		AttributeID.MP_UNREACH_NLRI: _decode_mp_unreach_nlri,
+		AttributeID.MP_REACH_NLRI: _decode_mp_reach_nlri,
+	}
@@ -89,8 +89,8 @@ class EthernetSegmentIdentifier(object):
         else:
             return -1
         
-    def __hash__(self): #FIXME: improve for better performance?
-        return hash( ":".join(self.bytes))
+    def __hash__(self):
+        return hash(tuple(self.bytes))
 
     @staticmethod
     def unpack(data):
@@ -184,8 +184,8 @@ class MAC(object):
         else:
             return -1
         
-    def __hash__(self): #FIXME: improve for better performance?
-        return hash( self.__str__() )
+    def __hash__(self):
+        return hash(tuple(self.bytes))
     
     @staticmethod
     def unpack(data):
@@ -213,9 +213,13 @@ class EVPNNLRI(object):
     afi = AFI(AFI.l2vpn)
     safi = SAFI(SAFI.evpn)
     
+    # EVPN NLRIs are compared and hashed based on a key computed from their
+    # packed form, see _computeKey
+
     def __init__(self,subtype,packedValue=None):
         self.subtype = subtype
         self.packedValue = packedValue
+        self._key = None
 
     def __str__ (self):
         if self.subtype in EVPN_types_to_class:
@@ -241,29 +245,30 @@ class EVPNNLRI(object):
             self._computePackedValue()
         return len(self.packedValue)+2
     
-    def __cmp__(self,other):
+    def _computeKey(self):
         #
         # For subtype 2, we will have to ignore a part of the route, so this method will be overridden 
         #
         if self.packedValue is None:
             self._computePackedValue()
-        if other.packedValue is None:
-            other._computePackedValue()
-            
-        if (isinstance(other,EVPNNLRI) and
-            self.subtype == other.subtype and
-            self.packedValue == other.packedValue):
-            return 0
-        else:
-            return -1
-        
-    def __hash__(self):  #FIXME: improve for better performance?
-        #
-        # same as above: need to ignore label and ESI for subtype 2
-        #
-        if self.packedValue is None:
-            self._computePackedValue()
-        return hash("%s:%s:%s:%s" % (self.afi,self.safi,self.subtype,self.packedValue))
+        return chr(self.subtype) + self.packedValue
+
+    def _getKey(self):
+        if self._key is None:
+            self._key = self._computeKey()
+            self._hash = hash(self._key)
+        return self._key
+
+    def __eq__(self,other):
+        return (isinstance(other,EVPNNLRI) and
+                self._getKey() == other._getKey())
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        self._getKey()
+        return self._hash
         
     @staticmethod
     def unpack(data):
@@ -277,9 +282,12 @@ class EVPNNLRI(object):
         data=data[1:length+1]
         
         if typeid in EVPN_types_to_class:
-            return EVPN_types_to_class[typeid].unpack(data)
+            nlri = EVPN_types_to_class[typeid].unpack(data)
+            # keep the bytes we decoded the NLRI from, to avoid packing it again
+            nlri.packedValue = data
+            return nlri
         else:
-            return EVPNNLRI
+            return EVPNNLRI(typeid,data)
 
 
 
@@ -335,22 +343,10 @@ class EVPNMACAdvertisement(EVPNNLRI):
                                              self.label)
         return "%s:%s" % (EVPNNLRI.__str__(self), desc) 
     
-    def __cmp__(self,other):
-        if (isinstance(other,self.__class__)
-            and self.rd == other.rd
-            #and self.esi == other.esi  ## must *not* be part of the test
-            and self.etag == other.etag
-            and self.mac == other.mac
-            and self.ip == other.ip
-            #and self.label == other.label ## must *not* be part of the test 
-            ):
-            return 0
-        else:
-            return -1
-        
-    def __hash__(self):
-        # esi and label must *not* be part of the hash
-        return hash("%s:%s:%s:%s" % (self.rd,self.etag,self.mac,self.ip))
+    def _computeKey(self):
+        # esi and label must *not* be part of the key
+        return (chr(self.subtype) + self.rd.pack() + self.etag.pack() +
+                self.mac.pack() + (self.ip or ""))
     
     def _computePackedValue(self):
         
@@ -445,19 +441,6 @@ class EVPNMulticast(EVPNNLRI):
         desc = "[rd:%s][etag:%s][%s]" % (self.rd, self.etag, self.ip)
         return EVPNNLRI.__str__(self) + ":" + desc
     
-    def __cmp__(self,other):
-        if (isinstance(other,self.__class__)
-            and self.rd == other.rd
-            and self.etag == other.etag
-            and self.ip == other.ip 
-            ):
-            return 0
-        else:
-            return -1
-    
-    def __hash__(self):  #FIXME: improve for better performance?
-        return hash("%s:%s:%s:%s:%s:%s" % (self.afi,self.safi,self.subtype,self.rd,self.etag,self.ip))
-    
     def _computePackedValue(self):
 
         encoded_ip = socket.inet_pton( socket.AF_INET, self.ip )
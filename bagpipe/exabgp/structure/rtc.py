@@ -48,6 +48,7 @@ class RouteTargetConstraint(object):
         self.safi = SAFI(safi)
         self.origin_as = origin_as
         self.route_target = route_target
+        self._packed = None
         
     def __len__(self):
         if self.route_target is None:
@@ -64,14 +65,13 @@ class RouteTargetConstraint(object):
     def __repr__(self):
         return self.__str__() 
     
-    def __cmp__(self,other):
-        if (isinstance(other,RouteTargetConstraint) and
-            self.origin_as == other.origin_as and
-            self.route_target == other.route_target):
-            return 0
-        else:
-            return -1
-        
+    def __eq__(self,other):
+        return (isinstance(other,RouteTargetConstraint) and
+                self.pack() == other.pack())
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
     def __hash__(self):
         return hash(self.pack())
 
@@ -80,6 +80,11 @@ class RouteTargetConstraint(object):
         return chr(ord(char) & ~(0x40))
 
     def pack(self):
+        if self._packed is None:
+            self._packed = self._pack()
+        return self._packed
+
+    def _pack(self):
         if self.route_target ==  None:
             return pack("!B",0)
         else:
@@ -51,137 +51,209 @@ class RouteDistinguisher(object):
     TYPE_IP_LOC  = 1    # Format IP address:AN(2bytes)
     TYPE_AS4_LOC = 2    # Format AS(4bytes):AN(2bytes)
 
-    def __init__(self,rdtype,asn,ip,loc):
-        self.type = rdtype
+    # An RD is kept in its packed form, which is used to compare and hash it.
+    # When decoded from the wire, its fields are only decoded when accessed.
 
+    def __init__(self,rdtype,asn,ip,loc):
         if rdtype in (self.TYPE_AS2_LOC, self.TYPE_AS4_LOC):
-            self.asn = asn
-            self.loc = loc 
-            self.ip = ""
+            self._fields = (rdtype, asn, "", loc)
         elif rdtype == self.TYPE_IP_LOC:
-            self.ip = ip
-            self.loc = loc
-            self.asn = 0
+            self._fields = (rdtype, 0, ip, loc)
         else: 
             raise Exception("unsupported rd rdtype")
-        
+        self._packed = self._pack()
+        self._hash = hash(self._packed)
+        self._str = None
+
+    def _decode(self):
+        rdtype = unpack( '!H', self._packed[0:2] )[0]
+        data = self._packed[2:]
+
+        if rdtype == RouteDistinguisher.TYPE_AS2_LOC:
+            asn,loc = unpack("!HL",data )
+            ip = ""
+        elif rdtype == RouteDistinguisher.TYPE_IP_LOC:
+            ip = socket.inet_ntop(socket.AF_INET, data[0:4])
+            loc = unpack( '!H', data[4:])[0]
+            asn = 0
+        elif rdtype == RouteDistinguisher.TYPE_AS4_LOC:
+            asn,loc = unpack("!LH",data )
+            ip = ""
+        self._fields = (rdtype, asn, ip, loc)
+        return self._fields
+
+    def _getFields(self):
+        return self._fields or self._decode()
+
+    type = property(lambda self: self._getFields()[0])
+    asn = property(lambda self: self._getFields()[1])
+    ip = property(lambda self: self._getFields()[2])
+    loc = property(lambda self: self._getFields()[3])
+
     def __str__ (self):
-        if self.type in(self.TYPE_AS2_LOC,self.TYPE_AS4_LOC):
-            return "%s:%s" % (self.asn, self.loc)
-        elif self.type == self.TYPE_IP_LOC:
-            return "%s:%s" % (self.ip, self.loc)
-        else:
-            raise "BROKEN RD / UNKNOWN TYPE"
+        if self._str is None:
+            if self.type in(self.TYPE_AS2_LOC,self.TYPE_AS4_LOC):
+                self._str = "%s:%s" % (self.asn, self.loc)
+            else:
+                self._str = "%s:%s" % (self.ip, self.loc)
+        return self._str
 
     def __len__(self):
         return 8
 
     def __repr__ (self):
         return str(self)
-    
-    def __cmp__(self,other):
-        if (isinstance(other,RouteDistinguisher) 
-            and self.type == other.type and
-            self.asn == other.asn and
-            self.ip == other.ip and
-            self.loc == other.loc ):
-            return 0
+
+    def __eq__(self,other):
+        return (isinstance(other,RouteDistinguisher) and
+                self._packed == other._packed)
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return self._hash
+
+    def _pack(self):
+        rdtype, asn, ip, loc = self._fields
+        if rdtype == self.TYPE_AS2_LOC:
+            return pack( '!HHL', rdtype, asn, loc)
+        elif rdtype == self.TYPE_IP_LOC:
+            encoded_ip = socket.inet_pton(socket.AF_INET, ip )
+            return pack( '!H4sH', rdtype, encoded_ip, loc)
+        elif rdtype == self.TYPE_AS4_LOC:
+            return pack( '!HLH', rdtype, asn, loc)
         else:
-            return -1
-    
+            raise Exception("Incorrect RD type %d // not supposed to happen !!" % rdtype)
+
     def pack(self):
-        if self.type == self.TYPE_AS2_LOC:
-            return pack( '!HHL', self.type, self.asn, self.loc)
-        elif self.type == self.TYPE_IP_LOC:
-            encoded_ip = socket.inet_pton(socket.AF_INET, self.ip )
-            return pack( '!H4sH', self.type, encoded_ip, self.loc)
-        elif self.type == self.TYPE_AS4_LOC:
-            return pack( '!HLH', self.type, self.asn, self.loc)
-        else:
-            raise Exception("Incorrect RD type %d // not supposed to happen !!" % self.type)
-        
+        return self._packed
+
     @staticmethod
     def unpack(data):
         rdtype = unpack( '!H', data[0:2] )[0]
-        data = data[2:]
-    
-        if rdtype == RouteDistinguisher.TYPE_AS2_LOC:
-            asn,loc = unpack("!HL",data )
-            ip = None
-        elif rdtype == RouteDistinguisher.TYPE_IP_LOC:
-            ip = socket.inet_ntop(socket.AF_INET, data[0:4])
-            loc = unpack( '!H', data[4:])[0]
-            asn = None
-        elif rdtype == RouteDistinguisher.TYPE_AS4_LOC:
-            asn,loc = unpack("!LH",data )
-            ip = None
-        else: 
+        if rdtype not in (RouteDistinguisher.TYPE_AS2_LOC,
+                          RouteDistinguisher.TYPE_IP_LOC,
+                          RouteDistinguisher.TYPE_AS4_LOC):
             raise Exception("unsupported rd rdtype: %d" % rdtype)
-        
-        return RouteDistinguisher(rdtype,asn,ip,loc)
+
+        rd = RouteDistinguisher.__new__(RouteDistinguisher)
+        rd._packed = str(data[0:8])
+        rd._hash = hash(rd._packed)
+        rd._fields = None
+        rd._str = None
+        return rd
 
 
 class VPNLabelledPrefix(object):
 
+    # The key used to compare and hash a VPNLabelledPrefix is made of the
+    # prefix length, the RD and the prefix bytes: it does not include the
+    # label stack, so that an advertise and a withdraw for the same RD:prefix
+    # result in objects that are equal for Python.
+    # When decoded from the wire, the label stack, RD and prefix are only
+    # decoded when accessed.
+
     def __init__(self,afi,safi,prefix,rd,labelStack):
         self.afi = AFI(afi)
         self.safi = SAFI(safi)
-        self.rd = rd
-        self.labelStack = labelStack  # an array of LabelStackEntry's
         if type(labelStack) != list or len(labelStack)==0:
             raise Exception("Labelstack has to be a non-empty array")
-        self.prefix = prefix
-    
+        self._rd = rd
+        self._labelStack = labelStack  # an array of LabelStackEntry's
+        self._prefix = prefix
+        self._data = None
+        self._packed = None
+        self._str = None
+        self._setKey(chr(prefix.mask) + rd.pack() + prefix.raw[:len_to_bytes[prefix.mask]])
+
+    def _setKey(self,key):
+        self._key = key
+        self._hash = hash(key)
+
+    def _decode(self):
+        # self._data is: label stack, rd, prefix
+        labelStack,consummed = unpackLabelStack(self._data)
+        self._labelStack = labelStack
+        self._rd = RouteDistinguisher.unpack(self._data[consummed:consummed+8])
+        mask = ord(self._key[0])
+        raw = self._key[9:]
+        self._prefix = _Prefix(self.afi, raw + '\0'*(Inet._length[self.afi]-len(raw)), mask)
+        self._data = None
+
+    def _getLabelStack(self):
+        if self._data is not None:
+            self._decode()
+        return self._labelStack
+
+    def _getRD(self):
+        if self._data is not None:
+            self._decode()
+        return self._rd
+
+    def _getPrefix(self):
+        if self._data is not None:
+            self._decode()
+        return self._prefix
+
+    labelStack = property(_getLabelStack)
+    rd = property(_getRD)
+    prefix = property(_getPrefix)
+
     def __str__ (self):
-        return "RD:%s %s MPLS:[%s]" % (self.rd, self.prefix, "|".join(map(str,self.labelStack)))
+        if self._str is None:
+            self._str = "RD:%s %s MPLS:[%s]" % (self.rd, self.prefix, "|".join(map(str,self.labelStack)))
+        return self._str
 
     def __repr__(self):
         return self.__str__() 
 
     def pack(self):
-        bitlen = (len(self)-len(self.prefix))*8 + self.prefix.mask
-        
-        stack = ''.join( map(lambda x:x.pack(), self.labelStack ) )
-        
-        return chr(bitlen) + stack + self.rd.pack() + self.prefix.pack()[1:]
-        
+        if self._packed is None:
+            stack = ''.join( map(lambda x:x.pack(), self.labelStack ) )
+            self._packed = chr(len(stack)*8 + 64 + ord(self._key[0])) + stack + self._key[1:]
+        return self._packed
+
     def __len__(self):
-        # returns the length in bits!
-        return    len(self.labelStack) * len(self.labelStack[0]) + len(self.rd) + len(self.prefix)
-        
-        
-    def __cmp__(self,other):
-        #
-        # Note well: we need an advertise and a withdraw for the same RD:prefix to result in 
-        # objects that are equal for Python, this is why the test below does not look at self.labelstack
-        #
-        if (isinstance(other,VPNLabelledPrefix) and
-            self.rd == other.rd and
-            self.prefix == other.prefix):
-            return 0
-        else:
-            return -1
-        
-    def __hash__(self):  #FIXME: improve for better performance?
-        return hash("%s:%s" % (self.rd,self.prefix))
-    
+        return len(self.pack())
+
+    def __eq__(self,other):
+        return (isinstance(other,VPNLabelledPrefix) and
+                self._key == other._key)
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return self._hash
+
     @staticmethod
     def unpack(afi,safi,data):
-                
+
         # prefix len
         bitlen = ord(data[0]) 
         data=data[1:]
-        initial_len = len(data)
-        
+
         # data is supposed to be: label stack, rd, prefix
-        labelStack,consummed = unpackLabelStack(data)
-        data=data[consummed:]
-        
-        rd = RouteDistinguisher.unpack(data[:8])
-        data=data[8:]
-        
-        prefix_len_in_bits = bitlen - (initial_len - len(data))*8
+        # only the end of the label stack needs to be found to build the key,
+        # with the same rules as unpackLabelStack (bottom of stack bit set, or
+        # withdraw label)
+        consummed = 0
+        while len(data) - consummed > 3:
+            label = data[consummed:consummed+3]
+            consummed += 3
+            if ord(label[2]) & 1 or (label[:2] == '\0\0' and not ord(label[2]) & 0xF0):
+                break
+
+        prefix_len_in_bits = bitlen - (consummed+8)*8
         last_byte = len_to_bytes[prefix_len_in_bits]
-        prefix = _Prefix(afi, data[0:last_byte] + '\0'*(Inet._length[afi]-last_byte) , prefix_len_in_bits )
-        
-        return VPNLabelledPrefix(afi,safi,prefix,rd,labelStack)
+        end = consummed+8+last_byte
+
+        nlri = VPNLabelledPrefix.__new__(VPNLabelledPrefix)
+        nlri.afi = AFI(afi)
+        nlri.safi = SAFI(safi)
+        nlri._data = data[:consummed+8]
+        nlri._packed = chr(bitlen) + data[:end]
+        nlri._str = None
+        nlri._setKey(chr(prefix_len_in_bits) + data[consummed:end])
+        return nlri